@@ -1,13 +1,20 @@
 # stdlib
-from collections import defaultdict
-from subprocess import check_output, CalledProcessError
+from collections import defaultdict, deque
+from multiprocessing.pool import ThreadPool
+from subprocess import check_output, CalledProcessError, Popen, PIPE
+import errno
 import re
 import os
+import select
+import socket
+import struct
+import threading
+import time
 
 # 3rd party
 
 # project
-from checks.network_checks import NetworkCheck, Status
+from checks.network_checks import NetworkCheck, Status, FAILURE
 
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'snmpwalk'
@@ -15,6 +22,227 @@ EVENT_TYPE = SOURCE_TYPE_NAME = 'snmpwalk'
 class BinaryUnavailable(Exception):
     pass
 
+class WalkAbandoned(Exception):
+    pass
+
+class WalkJob(object):
+    '''
+    The walks of a single device, as handed over to the `WalkPoller`.
+    `callback` is called from the poller thread with a list of
+    (output, error) tuples, in the order of `cmds`, once they are all done.
+    '''
+    def __init__(self, cmds, max_concurrent_walks, subnet, callback):
+        self.cmds = cmds
+        self.max_concurrent_walks = max_concurrent_walks
+        self.subnet = subnet
+        self.callback = callback
+        self.results = [None] * len(cmds)
+        self.next = 0
+        self.running = 0
+        self.failed = False
+        self.completed = False
+
+    def started(self):
+        return self.failed or self.next == len(self.cmds)
+
+    def done(self):
+        return self.running == 0 and self.started()
+
+    def get(self):
+        # NetworkCheck keeps track of its jobs through their AsyncResult,
+        # our jobs report their outcome through the callback instead
+        return None
+
+
+class WalkPoller(object):
+    '''
+    Drives the snmpwalk processes of many devices from a single thread,
+    polling their output pipes instead of blocking a thread on each of them.
+
+    The number of walks in flight is capped globally, per subnet and per
+    device (`WalkJob.max_concurrent_walks`). Jobs are started in submission
+    order, a failing walk stops the remaining walks of its device.
+    '''
+    READ_SIZE = 65536
+    ERROR_DELAY = 0.1
+
+    def __init__(self, max_walks, max_walks_per_subnet, log):
+        self.max_walks = max_walks
+        self.max_walks_per_subnet = max_walks_per_subnet
+        self.log = log
+        self.lock = threading.Lock()
+        self.pending = deque()
+        # fd -> (job, position, process, chunks)
+        self.running = {}
+        self.subnet_walks = defaultdict(int)
+        self.stopped = False
+
+        self.poll = select.poll()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poll.register(self.wakeup_r, select.POLLIN)
+        self.thread = threading.Thread(target=self.run, name='snmpwalk-poller')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, job):
+        with self.lock:
+            self.pending.append(job)
+        os.write(self.wakeup_w, 'x')
+
+    def stop(self):
+        self.stopped = True
+        os.write(self.wakeup_w, 'x')
+        self.thread.join()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self._run_once()
+            except Exception:
+                # a dead poller would leave every device hanging, keep going
+                self.log.exception("Unexpected error in the snmpwalk poller")
+                time.sleep(self.ERROR_DELAY)
+        self.abandon()
+
+    def _run_once(self):
+        self._start_walks()
+        try:
+            events = self.poll.poll(1000)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, _ in events:
+            if fd == self.wakeup_r:
+                os.read(fd, self.READ_SIZE)
+                continue
+            try:
+                self._read(fd)
+            except Exception as e:
+                self.log.exception("Failed to read the output of a walk")
+                self._finish_walk(fd, None, e)
+
+    def abandon(self):
+        '''
+        Fail the walks still running or pending, once the poller stopped.
+        '''
+        jobs = []
+        for fd in self.running.keys():
+            job = self.running[fd][0]
+            self._finish_walk(fd, None, WalkAbandoned("walk abandoned"), complete=False)
+            jobs.append(job)
+        with self.lock:
+            jobs.extend(self.pending)
+            self.pending = deque()
+        for job in jobs:
+            if not job.failed and None in job.results:
+                job.results[job.results.index(None)] = (None, WalkAbandoned("walk abandoned"))
+                job.failed = True
+            if job.done() and not job.completed:
+                self._complete(job)
+
+    def _start_walks(self):
+        with self.lock:
+            pending, self.pending = self.pending, deque()
+
+        waiting = deque()
+        while pending:
+            job = pending.popleft()
+            while (not job.started()
+                   and job.running < job.max_concurrent_walks
+                   and len(self.running) < self.max_walks
+                   and self.subnet_walks[job.subnet] < self.max_walks_per_subnet):
+                self._spawn(job)
+            if job.done():
+                self._complete(job)
+            elif not job.started():
+                waiting.append(job)
+
+        with self.lock:
+            waiting.extend(self.pending)
+            self.pending = waiting
+
+    def _spawn(self, job):
+        position = job.next
+        job.next += 1
+        try:
+            process = Popen(job.cmds[position], stdout=PIPE, close_fds=True)
+        except Exception as e:
+            job.results[position] = (None, e)
+            job.failed = True
+            return
+        fd = process.stdout.fileno()
+        self.running[fd] = (job, position, process, [])
+        job.running += 1
+        self.subnet_walks[job.subnet] += 1
+        try:
+            self.poll.register(fd, select.POLLIN)
+        except Exception as e:
+            self._finish_walk(fd, None, e, complete=False)
+
+    def _read(self, fd):
+        chunks = self.running[fd][3]
+        try:
+            chunk = os.read(fd, self.READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        if chunk:
+            chunks.append(chunk)
+        else:
+            # EOF, the walk is over
+            self._finish_walk(fd, ''.join(chunks), None)
+
+    def _finish_walk(self, fd, output, error, complete=True):
+        '''
+        Record the outcome of a walk, killing its process when it failed
+        before the end of its output.
+        '''
+        entry = self.running.pop(fd, None)
+        if entry is None:
+            return
+        job, position, process, _ = entry
+        try:
+            self.poll.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+        process.stdout.close()
+        if error is not None:
+            try:
+                process.kill()
+            except OSError:
+                pass
+        retcode = process.wait()
+        if error is None and retcode:
+            error = CalledProcessError(retcode, job.cmds[position], output=output)
+
+        if error is not None:
+            job.results[position] = (None, error)
+            job.failed = True
+        else:
+            job.results[position] = (output, None)
+
+        job.running -= 1
+        self.subnet_walks[job.subnet] -= 1
+        if not self.subnet_walks[job.subnet]:
+            del self.subnet_walks[job.subnet]
+        if complete and job.done():
+            self._complete(job)
+
+    def _complete(self, job):
+        job.completed = True
+        try:
+            job.callback(job.results)
+        except Exception:
+            self.log.exception("Failed to process the walks of %s", job.cmds)
+
+
 class SnmpwalkCheck(NetworkCheck):
     '''
     This is a work-alike for checks.d/snmp.py that makes use of snmpwalk for
@@ -26,8 +254,13 @@ class SnmpwalkCheck(NetworkCheck):
           integer.
     '''
     DEFAULT_SNMPWALK_PATH = '/usr/bin/snmpwalk'
+    DEFAULT_SNMPBULKWALK_PATH = '/usr/bin/snmpbulkwalk'
     DEFAULT_RETRIES = 2
     DEFAULT_TIMEOUT = 1
+    DEFAULT_MAX_CONCURRENT_WALKS = 1
+    DEFAULT_POLLER_MAX_WALKS = 128
+    DEFAULT_POLLER_MAX_WALKS_PER_SUBNET = 16
+    DEFAULT_POLLER_SUBNET_PREFIX_LENGTH = 24
     COUNTER_TYPES = frozenset(('Counter32', 'Counter64', 'ZeroBasedCounter64'))
     GAUGE_TYPES = frozenset(('Gauge32', 'Unsigned32', 'CounterBasedGauge64',
                              'INTEGER', 'Integer32'))
@@ -43,8 +276,23 @@ class SnmpwalkCheck(NetworkCheck):
         if os.path.isfile(self.expected_bin):
             self.binary = self.expected_bin
 
+        self.bulk_binary = None
+        self.expected_bulk_bin = init_config.get('bulk_binary',
+                                                 self.DEFAULT_SNMPBULKWALK_PATH)
+        if os.path.isfile(self.expected_bulk_bin):
+            self.bulk_binary = self.expected_bulk_bin
+
         self.mib_dirs = init_config.get('mibs_folder')
 
+        # instance name -> {walk command: symbols it returned last time}
+        self.walk_symbols = {}
+
+        self.poller = None
+        self.use_poller = init_config.get('event_loop_poller', False)
+        self.poller_subnet_prefix_length = int(init_config.get(
+            'poller_subnet_prefix_length',
+            self.DEFAULT_POLLER_SUBNET_PREFIX_LENGTH))
+
         for instance in instances:
             # if we don't have a name add one, but mark skip_event so that we
             # don't emit the event
@@ -54,6 +302,11 @@ class SnmpwalkCheck(NetworkCheck):
 
         NetworkCheck.__init__(self, name, init_config, agentConfig, instances)
 
+        if self.use_poller and not hasattr(select, 'poll'):
+            self.log.warning("event_loop_poller is not supported on this "
+                             "platform, falling back to the thread pool")
+            self.use_poller = False
+
     def _get_instance_addr(self, instance):
         host = instance.get('host', None)
         ip = instance.get('ip_address', None)
@@ -69,60 +322,229 @@ class SnmpwalkCheck(NetworkCheck):
 
         return key
 
+    def _get_subnet(self, instance):
+        '''
+        Group devices by subnet for the poller's per-subnet cap. Anything that
+        isn't an IPv4 address makes up a group of its own.
+        '''
+        host = instance.get('host') or instance.get('ip_address')
+        try:
+            address = struct.unpack('!I', socket.inet_aton(host))[0]
+        except (socket.error, TypeError):
+            return host
+        mask = (0xffffffff << (32 - self.poller_subnet_prefix_length)) & 0xffffffff
+        return '{}/{}'.format(socket.inet_ntoa(struct.pack('!I', address & mask)),
+                              self.poller_subnet_prefix_length)
+
+    def _get_max_concurrent_walks(self, instance):
+        return int(instance.get(
+            'max_concurrent_walks',
+            self.init_config.get('max_concurrent_walks',
+                                 self.DEFAULT_MAX_CONCURRENT_WALKS)))
+
+    def check(self, instance):
+        if not self.use_poller:
+            return NetworkCheck.check(self, instance)
+
+        if self.poller is not None and not self.poller.is_alive():
+            self.log.warning("The snmpwalk poller died, restarting it")
+            self.poller.abandon()
+            self.poller = None
+        if self.poller is None:
+            self.poller = WalkPoller(
+                int(self.init_config.get('poller_max_walks',
+                                         self.DEFAULT_POLLER_MAX_WALKS)),
+                int(self.init_config.get('poller_max_walks_per_subnet',
+                                         self.DEFAULT_POLLER_MAX_WALKS_PER_SUBNET)),
+                self.log)
+
+        # Same bookkeeping as NetworkCheck.check, except that the walks go to
+        # the poller rather than tying up a thread of the pool each
+        if not self.pool_started:
+            self.start_pool()
+        self._process_results()
+        self._clean()
+
+        name = instance['name']
+        if name in self.jobs_status:
+            self.log.error("Instance: %s skipped because it's already running.", name)
+            return
+
+        cmds = self._get_walk_commands(instance)
+        job = WalkJob(cmds,
+                      self._get_max_concurrent_walks(instance),
+                      self._get_subnet(instance),
+                      lambda results: self._process_poller_results(instance, cmds, results))
+        self.jobs_status[name] = time.time()
+        self.jobs_results[name] = job
+        self.poller.submit(job)
+
+    def _process_poller_results(self, instance, cmds, results):
+        try:
+            for sc_name, status, msg in self._process_walks(instance, cmds, results):
+                self.resultsq.put((status, msg, sc_name, instance))
+        except Exception:
+            self.log.exception("Failed to process the walks of %s", instance['name'])
+            self.resultsq.put((FAILURE, FAILURE, FAILURE, instance))
+
+    def stop(self):
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
+        NetworkCheck.stop(self)
+
     def _check(self, instance):
-        if not self.binary:
-            raise BinaryUnavailable("Cannot find executable: {}".format(self.expected_bin))
+        cmds = self._get_walk_commands(instance)
+        results = self._run_walks(cmds, self._get_max_concurrent_walks(instance))
+        return self._process_walks(instance, cmds, results)
+
+    def _get_walk_commands(self, instance):
+        bulk = instance.get('bulk_walk', self.init_config.get('bulk_walk', False))
+        if bulk:
+            # snmpbulkwalk takes the same options and prints the same output
+            # as snmpwalk, but fetches max_repetitions rows per GETBULK
+            # request instead of one per GETNEXT
+            if not self.bulk_binary:
+                raise BinaryUnavailable("Cannot find executable: {}"
+                                        .format(self.expected_bulk_bin))
+            binary = self.bulk_binary
+        else:
+            if not self.binary:
+                raise BinaryUnavailable("Cannot find executable: {}".format(self.expected_bin))
+            binary = self.binary
 
         ip_address = self._get_instance_addr(instance)
         metrics = instance.get('metrics', [])
         community_string = instance.get('community_string', 'public')
         timeout = int(instance.get('timeout', self.DEFAULT_TIMEOUT))
         retries = int(instance.get('retries', self.DEFAULT_RETRIES))
+        max_repetitions = instance.get('max_repetitions',
+                                       self.init_config.get('max_repetitions'))
+        walk_columns = instance.get('walk_columns',
+                                    self.init_config.get('walk_columns', False))
 
-        hostname = instance.get('metric_host', None)
+        def base_cmd(repetitions):
+            cmd = [binary, '-c{}'.format(community_string),
+                   '-v2c', '-t', str(timeout), '-r', str(retries)]
+            if bulk and repetitions is not None:
+                cmd.append('-Cr{}'.format(int(repetitions)))
+            if self.mib_dirs:
+                cmd.extend(['-M', self.mib_dirs])
+            return cmd
 
-        # Build up our dataset
-        data = defaultdict(dict)
-        types = {}
+        if walk_columns:
+            cmds = self._get_column_walk_commands(instance, base_cmd(max_repetitions),
+                                                  ip_address)
+            return self._prune_overlapping_walks(instance, cmds)
+
+        # Metrics splitting the symbols of a table across tag sets share a
+        # single walk of it, the parsed columns are available to all of them
+        cmds = []
+        tables = set()
         for metric in metrics:
             mib = metric['MIB']
             table = metric['table']
-            cmd = [self.binary, '-c{}'.format(community_string),
-                   '-v2c', '-t', str(timeout), '-r', str(retries)]
-            if self.mib_dirs:
-                cmd.extend(['-M', self.mib_dirs])
+            if (mib, table) in tables:
+                continue
+            tables.add((mib, table))
+            cmd = base_cmd(metric.get('max_repetitions', max_repetitions))
             cmd.extend([ip_address, '{}:{}'.format(mib, table)])
+            cmds.append(cmd)
 
-            try:
-                output = check_output(cmd)
-            except CalledProcessError as e:
+        return self._prune_overlapping_walks(instance, cmds)
+
+    def _prune_overlapping_walks(self, instance, cmds):
+        '''
+        Skip the walks whose symbols were all returned by another walk of the
+        device last time, e.g. IF-MIB:ifEntry next to IF-MIB:ifTable, or
+        IF-MIB:ifTable next to IF-MIB:interfaces. Of two walks returning the
+        same symbols, the first one is kept.
+
+        Walks that haven't completed yet, or that returned nothing, are
+        always run.
+        '''
+        seen = self.walk_symbols.get(instance['name'])
+        if not seen:
+            return cmds
+
+        keys = [tuple(cmd) for cmd in cmds]
+        pruned = []
+        for i, key in enumerate(keys):
+            symbols = seen.get(key)
+            covered = False
+            if symbols:
+                for j, other in enumerate(keys):
+                    other_symbols = seen.get(other)
+                    if j == i or other_symbols is None:
+                        continue
+                    if symbols < other_symbols or (symbols == other_symbols and j < i):
+                        covered = True
+                        break
+            if covered:
+                self.log.debug("Skipping %s, covered by another walk", cmds[i])
+            else:
+                pruned.append(cmds[i])
+        return pruned
+
+    def _get_column_walk_commands(self, instance, cmd, ip_address):
+        '''
+        Walk only the columns the metrics of a device need, i.e. their
+        symbols and the columns their tags are read from, rather than whole
+        tables.
+
+        Since a metric may use columns fetched for another one, the columns
+        are walked by name with all the MIBs of the device loaded, instead of
+        guessing which MIB each of them belongs to.
+        '''
+        mibs = []
+        columns = []
+        for metric in instance.get('metrics', []):
+            if metric['MIB'] not in mibs:
+                mibs.append(metric['MIB'])
+            needed = list(metric.get('symbols', []))
+            needed.extend(metric_tag['column']
+                          for metric_tag in metric.get('metric_tags', [])
+                          if 'column' in metric_tag)
+            for column in needed:
+                if column not in columns:
+                    columns.append(column)
+
+        if not columns:
+            return []
+
+        cmd = cmd + ['-m', '+' + os.pathsep.join(mibs), ip_address]
+        multiple_oids = instance.get(
+            'multiple_oids_per_walk',
+            self.init_config.get('multiple_oids_per_walk', False))
+        if multiple_oids:
+            return [cmd + columns]
+        return [cmd + [column] for column in columns]
+
+    def _process_walks(self, instance, cmds, results):
+        '''
+        Turn the results of the walks of a device into metrics.
+
+        :param cmds: list of the walk commands that were run
+        :param results: iterable of (output, error) tuples, one per command
+        :rtype: list of (service check name, status, message) tuples
+        '''
+        ip_address = self._get_instance_addr(instance)
+        metrics = instance.get('metrics', [])
+        hostname = instance.get('metric_host', None)
+
+        # Build up our dataset, merging the walks back in metric order no
+        # matter which one finished first
+        data = defaultdict(dict)
+        types = {}
+        walk_symbols = dict(self.walk_symbols.get(instance['name'], {}))
+        for cmd, (output, e) in zip(cmds, results):
+            if e is not None:
                 error = "Fail to collect metrics for {0} - {1}" \
                     .format(instance['name'], e)
                 self.log.warning(error)
                 return [(self.SC_NAME, Status.CRITICAL, error)]
-
-            for line in output.split('\n'):
-                if line == '':
-                    continue
-                match = self.output_re.match(line)
-                if match is not None:
-                    symbol = match.group('symbol')
-                    index = int(match.group('index'))
-                    value = match.group('value')
-                    typ = match.group('type')
-                    types[symbol] = typ
-                    if typ == 'INTEGER':
-                        try:
-                            value = int(value)
-                        except ValueError:
-                            pass
-                    elif value == '':
-                        value = None
-                    data[symbol][index] = value
-                else:
-                    # TODO: remove this
-                    self.log.warning('Problem parsing output of snmp walk: %s',
-                                     line)
+            walk_symbols[tuple(cmd)] = self._parse_walk_output(output, data, types)
+        self.walk_symbols[instance['name']] = walk_symbols
 
         # Get any base configured tags and add our primary tag
         tags = instance.get('tags', []) + [
@@ -203,6 +625,70 @@ class SnmpwalkCheck(NetworkCheck):
 
         return [(self.SC_NAME, Status.UP, None)]
 
+    def _walk(self, cmd):
+        '''
+        Run a single walk, returning its output along with the error it
+        failed with, if any.
+        '''
+        try:
+            return check_output(cmd), None
+        except CalledProcessError as e:
+            return None, e
+
+    def _run_walks(self, cmds, max_concurrent_walks):
+        '''
+        Run the walks for a device, at most `max_concurrent_walks` of them at
+        the same time so that we don't overload the agent on the other end.
+
+        :param cmds: list of snmpwalk command lines
+        :param max_concurrent_walks: per-device concurrency cap
+        :rtype: iterable of (output, error) tuples, in the order of `cmds`
+        '''
+        if max_concurrent_walks <= 1 or len(cmds) <= 1:
+            # lazily, so that the caller can bail out on the first failure
+            # without running the remaining walks
+            return (self._walk(cmd) for cmd in cmds)
+
+        pool = ThreadPool(min(max_concurrent_walks, len(cmds)))
+        try:
+            return pool.map(self._walk, cmds)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _parse_walk_output(self, output, data, types):
+        '''
+        Parse the output of a walk into `data` (symbol -> index -> value) and
+        `types` (symbol -> type).
+
+        :rtype: frozenset of the symbols found in the output
+        '''
+        symbols = set()
+        for line in output.split('\n'):
+            if line == '':
+                continue
+            match = self.output_re.match(line)
+            if match is not None:
+                symbol = match.group('symbol')
+                index = int(match.group('index'))
+                value = match.group('value')
+                typ = match.group('type')
+                types[symbol] = typ
+                if typ == 'INTEGER':
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        pass
+                elif value == '':
+                    value = None
+                data[symbol][index] = value
+                symbols.add(symbol)
+            else:
+                # TODO: remove this
+                self.log.warning('Problem parsing output of snmp walk: %s',
+                                 line)
+        return frozenset(symbols)
+
     def report_as_service_check(self, sc_name, status, instance, msg=None):
         sc_tags = ['snmp_device:{0}'.format(instance['name'])]
         custom_tags = instance.get('tags', [])
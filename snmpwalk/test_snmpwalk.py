@@ -5,10 +5,17 @@
 # stdlib
 import os
 import copy
+from collections import defaultdict
+import select
+import shutil
+import tempfile
+import subprocess
+import threading
 import time
 
 # 3p
 from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
 
 # project
 from checks import AgentCheck
@@ -17,6 +24,15 @@ from tests.checks.common import AgentCheckTest
 
 RESULTS_TIMEOUT = 10
 
+# Stand-in for snmpwalk, called as `<binary> <device> <oid>`
+FAKE_SNMPWALK = '''#!/bin/sh
+sleep 0.05
+if [ "$2" = "fail" ]; then
+    exit 1
+fi
+echo "IF-MIB::ifDescr.1 = STRING: $1 $2"
+'''
+
 @attr(requires='snmpwalk')
 class TestSnmpwalk(AgentCheckTest):
     """Basic Test for snmpwrap integration."""
@@ -108,6 +124,186 @@ class TestSnmpwalk(AgentCheckTest):
 
         self.coverage_report()
 
+    def test_concurrent_walks(self):
+        """
+        Walks running concurrently are merged into the same dataset.
+        """
+        metrics = self.TABULAR_OBJECTS + [{
+            'MIB': "IF-MIB",
+            'table': "ifXTable",
+            'symbols': ["ifHCInOctets"],
+            'metric_tags': [
+                {
+                    'tag': "interface",
+                    'column': "ifDescr"
+                }
+            ]
+        }]
+        instance = self.generate_instance_config(metrics)
+        instance['max_concurrent_walks'] = 2
+        config = {
+            'instances': [instance]
+        }
+        self.run_check_n(config, repeat=3, sleep=2)
+        self.service_checks = self.wait_for_async('get_service_checks', 'service_checks', 1)
+
+        # ifHCInOctets is tagged with a column coming from the other walk
+        for symbol in ["ifInOctets", "ifOutOctets", "ifHCInOctets"]:
+            metric_name = '{}.{}'.format(self.CHECK_NAME, symbol)
+            self.assertMetric(metric_name, at_least=1)
+            self.assertMetricTagPrefix(metric_name, 'interface', at_least=1)
+
+        svcchk_name = '{}.can_check'.format(self.CHECK_NAME)
+        self.assertServiceCheck(svcchk_name, status=AgentCheck.OK,
+                                tags=[':'.join(self.CHECK_TAGS[0].split(':')[:-1])], count=1)
+
+    def test_event_loop_poller(self):
+        """
+        Walks driven by the event loop poller.
+        """
+        config = {
+            'init_config': {'event_loop_poller': True, 'poller_max_walks_per_subnet': 1},
+            'instances': [self.generate_instance_config(self.TABULAR_OBJECTS)]
+        }
+        self.run_check_n(config, repeat=3, sleep=2)
+        self.service_checks = self.wait_for_async('get_service_checks', 'service_checks', 1)
+
+        for symbol in self.TABULAR_OBJECTS[0]['symbols']:
+            metric_name = '{}.{}'.format(self.CHECK_NAME, symbol)
+            self.assertMetric(metric_name, at_least=1)
+            self.assertMetricTag(metric_name, self.CHECK_TAGS[0], at_least=1)
+            self.assertMetricTagPrefix(metric_name, 'interface', at_least=1)
+
+        svcchk_name = '{}.can_check'.format(self.CHECK_NAME)
+        self.assertServiceCheck(svcchk_name, status=AgentCheck.OK,
+                                tags=[':'.join(self.CHECK_TAGS[0].split(':')[:-1])], at_least=1)
+
+    def test_bulk_walk(self):
+        """
+        Tables walked with snmpbulkwalk yield the same metrics.
+        """
+        instance = self.generate_instance_config(self.TABULAR_OBJECTS)
+        instance['bulk_walk'] = True
+        instance['max_repetitions'] = 5
+        config = {
+            'instances': [instance]
+        }
+        self.run_check_n(config, repeat=3, sleep=2)
+        self.service_checks = self.wait_for_async('get_service_checks', 'service_checks', 1)
+
+        for symbol in self.TABULAR_OBJECTS[0]['symbols']:
+            metric_name = '{}.{}'.format(self.CHECK_NAME, symbol)
+            self.assertMetric(metric_name, at_least=1)
+            self.assertMetricTag(metric_name, self.CHECK_TAGS[0], at_least=1)
+            self.assertMetricTagPrefix(metric_name, 'interface', at_least=1)
+
+        svcchk_name = '{}.can_check'.format(self.CHECK_NAME)
+        self.assertServiceCheck(svcchk_name, status=AgentCheck.OK,
+                                tags=[':'.join(self.CHECK_TAGS[0].split(':')[:-1])], count=1)
+
+    def test_bulk_walk_benchmark(self):
+        """
+        PDUs sent and latency of snmpwalk against snmpbulkwalk for a few max_repetitions.
+        """
+        def _walk(instance, repeat=5):
+            # -d dumps every packet sent, as 'Sending <n> bytes to ...'
+            cmd = self.check._get_walk_commands(instance)[0]
+            cmd.insert(1, '-d')
+            timings = []
+            for _ in range(repeat):
+                start = time.time()
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output, dump = process.communicate()
+                timings.append(time.time() - start)
+                self.assertEquals(0, process.returncode)
+            data = defaultdict(dict)
+            self.check._parse_walk_output(output, data, {})
+            pdus = len([line for line in dump.splitlines() if line.startswith('Sending ')])
+            return pdus, sorted(timings)[repeat // 2], data
+
+        instance = self.generate_instance_config(self.TABULAR_OBJECTS)
+        self.load_check({'instances': [instance]})
+        pdus, latency, expected = _walk(instance)
+        print 'snmpwalk: {} PDUs, {:.1f}ms'.format(pdus, latency * 1000)
+        self.assertTrue(expected['ifInOctets'])
+
+        for max_repetitions in (5, 10, 25, 50):
+            instance = self.generate_instance_config(self.TABULAR_OBJECTS)
+            instance['bulk_walk'] = True
+            instance['max_repetitions'] = max_repetitions
+            bulk_pdus, bulk_latency, data = _walk(instance)
+            print 'snmpbulkwalk -Cr{}: {} PDUs, {:.1f}ms'.format(max_repetitions, bulk_pdus, bulk_latency * 1000)
+            # same symbols and indexes, the counters moved on in between
+            self.assertEquals(sorted((symbol, sorted(values)) for symbol, values in expected.items()),
+                              sorted((symbol, sorted(values)) for symbol, values in data.items()))
+            self.assertLess(bulk_pdus, pdus)
+
+    def test_walk_columns(self):
+        """
+        Walking only the needed columns yields the same metrics.
+        """
+        instance = self.generate_instance_config(self.TABULAR_OBJECTS)
+        instance['walk_columns'] = True
+        config = {
+            'instances': [instance]
+        }
+        self.load_check(config)
+        cmds = self.check._get_walk_commands(instance)
+        self.assertEquals([cmd[-1] for cmd in cmds],
+                          ["ifInOctets", "ifOutOctets", "ifDescr"])
+
+        self.run_check_n(config, repeat=3, sleep=2)
+        self.service_checks = self.wait_for_async('get_service_checks', 'service_checks', 1)
+
+        for symbol in self.TABULAR_OBJECTS[0]['symbols']:
+            metric_name = '{}.{}'.format(self.CHECK_NAME, symbol)
+            self.assertMetric(metric_name, at_least=1)
+            self.assertMetricTag(metric_name, self.CHECK_TAGS[0], at_least=1)
+            self.assertMetricTagPrefix(metric_name, 'interface', at_least=1)
+
+        svcchk_name = '{}.can_check'.format(self.CHECK_NAME)
+        self.assertServiceCheck(svcchk_name, status=AgentCheck.OK,
+                                tags=[':'.join(self.CHECK_TAGS[0].split(':')[:-1])], count=1)
+
+    def test_walk_plan(self):
+        """
+        Duplicate and overlapping walks are run only once.
+        """
+        metrics = self.TABULAR_OBJECTS + [{
+            'MIB': "IF-MIB",
+            'table': "ifTable",
+            'symbols': ["ifInUcastPkts"],
+            'metric_tags': [
+                {
+                    'tag': "port",
+                    'column': "ifDescr"
+                }
+            ]
+        }, {
+            'MIB': "IF-MIB",
+            'table': "ifEntry",
+            'symbols': ["ifOutUcastPkts"]
+        }]
+        instance = self.generate_instance_config(metrics)
+        config = {
+            'instances': [instance]
+        }
+        self.load_check(config)
+        cmds = self.check._get_walk_commands(instance)
+        self.assertEquals([cmd[-1] for cmd in cmds], ["IF-MIB:ifTable", "IF-MIB:ifEntry"])
+
+        self.run_check_n(config, repeat=3, sleep=2)
+        self.service_checks = self.wait_for_async('get_service_checks', 'service_checks', 1)
+
+        # ifEntry returned the same columns as ifTable, it's not walked anymore
+        cmds = self.check._get_walk_commands(instance)
+        self.assertEquals([cmd[-1] for cmd in cmds], ["IF-MIB:ifTable"])
+
+        for symbol in ["ifInOctets", "ifOutOctets", "ifInUcastPkts", "ifOutUcastPkts"]:
+            metric_name = '{}.{}'.format(self.CHECK_NAME, symbol)
+            self.assertMetric(metric_name, at_least=1)
+        self.assertMetricTagPrefix('{}.ifInUcastPkts'.format(self.CHECK_NAME), 'port', at_least=1)
+
     def test_unavailable_binary(self):
         """
         Should raise exception if binary is unavailable.
@@ -122,3 +318,176 @@ class TestSnmpwalk(AgentCheckTest):
             Exception,
             lambda: self.wait_for_async('get_service_checks', 'service_checks', 1)
         )
+
+
+@attr('poller')
+class TestWalkPoller(AgentCheckTest):
+    """WalkPoller tests, against a stand-in snmpwalk binary."""
+    CHECK_NAME = 'snmpwalk'
+
+    def setUp(self):
+        if not hasattr(select, 'poll'):
+            raise SkipTest("select.poll is not available")
+        self.tmp_dir = tempfile.mkdtemp()
+        self.binary = os.path.join(self.tmp_dir, 'snmpwalk')
+        with open(self.binary, 'w') as f:
+            f.write(FAKE_SNMPWALK)
+        os.chmod(self.binary, 0755)
+        self.config = {
+            'init_config': {'binary': self.binary, 'event_loop_poller': True},
+            'instances': [{
+                'ip_address': "localhost",
+                'name': "localhost",
+                'metrics': [{'MIB': "IF-MIB", 'table': "ifTable", 'symbols': []}],
+            }]
+        }
+        self.load_check(self.config)
+        self.module = __import__(self.check.__class__.__module__)
+        self.pollers = []
+
+    def tearDown(self):
+        for poller in self.pollers:
+            poller.stop()
+        if self.check:
+            self.check.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def start_poller(self, max_walks, max_walks_per_subnet, read_errors=0):
+        """
+        Start a poller recording the peak number of walks in flight, globally, per subnet and per device.
+        """
+        WalkPoller = self.module.WalkPoller
+        peaks = {'global': 0, 'subnet': 0, 'device': 0}
+        errors = [read_errors]
+
+        class RecordingPoller(WalkPoller):
+            def _spawn(self, job):
+                WalkPoller._spawn(self, job)
+                peaks['global'] = max(peaks['global'], len(self.running))
+                peaks['subnet'] = max([peaks['subnet']] + self.subnet_walks.values())
+                peaks['device'] = max(peaks['device'], job.running)
+
+            def _read(self, fd):
+                if errors[0]:
+                    errors[0] -= 1
+                    raise RuntimeError("unexpected")
+                WalkPoller._read(self, fd)
+
+        poller = RecordingPoller(max_walks, max_walks_per_subnet, self.check.log)
+        self.pollers.append(poller)
+        return poller, peaks
+
+    def submit(self, poller, device, subnet, oids, max_concurrent_walks=1):
+        done = threading.Event()
+        results = []
+
+        def _callback(job_results):
+            results.extend(job_results)
+            done.set()
+
+        cmds = [[self.binary, device, oid] for oid in oids]
+        poller.submit(self.module.WalkJob(cmds, max_concurrent_walks, subnet, _callback))
+        return done, results
+
+    def wait(self, done):
+        self.assertTrue(done.wait(RESULTS_TIMEOUT))
+
+    def test_concurrency_caps(self):
+        """
+        Walks in flight never exceed the global, per subnet and per device caps, and results reach their device.
+        """
+        poller, peaks = self.start_poller(8, 3)
+        oids = ['a', 'b', 'c', 'd']
+        jobs = dict((device, self.submit(poller, device, 'subnet{}'.format(i % 3), oids, max_concurrent_walks=2))
+                    for i, device in enumerate('device{}'.format(i) for i in range(24)))
+
+        for device, (done, results) in jobs.items():
+            self.wait(done)
+            self.assertEquals([('IF-MIB::ifDescr.1 = STRING: {} {}\n'.format(device, oid), None) for oid in oids],
+                              results)
+        self.assertEquals(2, peaks['device'])
+        self.assertLessEqual(peaks['subnet'], 3)
+        self.assertLessEqual(peaks['global'], 8)
+        self.assertGreater(peaks['global'], 3)
+        self.assertEquals({}, poller.running)
+        self.assertEquals({}, dict(poller.subnet_walks))
+
+    def test_failed_walk(self):
+        """
+        A failed walk stops the remaining walks of its device, and only of its device.
+        """
+        poller, _ = self.start_poller(8, 8)
+        failed, failed_results = self.submit(poller, 'device0', 'subnet', ['a', 'fail', 'b'])
+        done, results = self.submit(poller, 'device1', 'subnet', ['a', 'b'])
+        self.wait(failed)
+        self.wait(done)
+
+        self.assertIsNone(failed_results[0][1])
+        self.assertEquals(1, failed_results[1][1].returncode)
+        self.assertIsNone(failed_results[2])
+        self.assertEquals([None, None], [error for _, error in results])
+
+    def test_unexpected_errors(self):
+        """
+        Unexpected errors fail the affected walk without killing the poller.
+        """
+        poller, _ = self.start_poller(8, 8, read_errors=1)
+        done, results = self.submit(poller, 'device0', 'subnet', ['a'])
+        self.wait(done)
+        self.assertIsInstance(results[0][1], RuntimeError)
+
+        # an argument Popen chokes on
+        done, results = self.submit(poller, None, 'subnet', ['a'])
+        self.wait(done)
+        self.assertIsInstance(results[0][1], TypeError)
+
+        done, results = self.submit(poller, 'device1', 'subnet', ['a'])
+        self.wait(done)
+        self.assertEquals([('IF-MIB::ifDescr.1 = STRING: device1 a\n', None)], results)
+        self.assertTrue(poller.is_alive())
+
+    def test_restart_dead_poller(self):
+        """
+        The check fails the walks of a dead poller and starts a new one.
+        """
+        instance = self.config['instances'][0]
+        self.check.check(instance)
+        poller = self.check.poller
+        poller.stop()
+        self.assertFalse(poller.is_alive())
+
+        self.check.check(instance)
+        self.assertIsNot(poller, self.check.poller)
+        self.assertTrue(self.check.poller.is_alive())
+
+        statuses = []
+        for _ in range(RESULTS_TIMEOUT * 10):
+            self.check._process_results()
+            statuses.extend(sc['status'] for sc in self.check.get_service_checks())
+            if AgentCheck.OK in statuses:
+                break
+            time.sleep(0.1)
+        self.assertEquals([AgentCheck.CRITICAL, AgentCheck.OK], statuses)
+
+    @attr(requires='benchmark')
+    def test_throughput(self):
+        """
+        Walks per second through the poller, against the 50ms stand-in.
+        """
+        walks = {}
+        for max_walks, max_walks_per_subnet in ((8, 8), (64, 16), (64, 64)):
+            poller, peaks = self.start_poller(max_walks, max_walks_per_subnet)
+            start = time.time()
+            jobs = [self.submit(poller, 'device{}'.format(i), 'subnet{}'.format(i % 4), ['a', 'b', 'c', 'd'],
+                                max_concurrent_walks=2)
+                    for i in range(100)]
+            for done, results in jobs:
+                self.wait(done)
+                self.assertEquals([None] * 4, [error for _, error in results])
+            walks[max_walks, max_walks_per_subnet] = 400 / (time.time() - start)
+            self.assertLessEqual(peaks['global'], max_walks)
+            self.assertLessEqual(peaks['subnet'], max_walks_per_subnet)
+
+        for (max_walks, max_walks_per_subnet), rate in sorted(walks.items()):
+            print 'max_walks={} max_walks_per_subnet={}: {:.0f} walks/s'.format(max_walks, max_walks_per_subnet,
+                                                                                rate)
@@ -3,15 +3,41 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from collections import deque, OrderedDict
+import fnmatch
+import functools
+import gzip
+import heapq
+import io
+import json
+from multiprocessing.pool import ThreadPool
+import re
+import threading
+import time
+import urllib
+import urlparse
+import zlib
 
 # 3rd party
 import requests
+from requests.packages.urllib3.response import HTTPResponse
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    from tornado import gen, httpclient, ioloop
+except ImportError:
+    gen = httpclient = ioloop = None
 
 # project
 from checks import AgentCheck
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'storm'
 
+# Result of a request that was not sent because the run deadline had passed
+SKIPPED = object()
+
 
 def _g(stat_map, default, func, *components):
     """ Helper method to return value, tag tuple from a stat map get.
@@ -189,6 +215,887 @@ def _get_dict(stat_map, *components):
     return val
 
 
+def _debug_flag(v):
+    """Convert a debug mode value to the 1/0 flag reported for it
+
+    :param v: value
+    :rtype: int
+    """
+    return 1 if _bool(v) else 0
+
+
+def _compile_extractor(default, func, *components):
+    """ Compile a `_g` lookup into a single callable taking the stat map.
+
+    The returned callable behaves like `_g(stat_map, default, func, *components)`, but the traversal is resolved
+    once up front instead of inspecting the component types on every call.
+
+    :param default: default value
+    :param func: function to apply after getting the value.
+    :param components: components in order to traverse
+    :return: extractor taking a stat map and returning the stat value
+    :rtype: callable
+    """
+    if len(components) == 1:
+        key = components[0]
+
+        def _extract(stat_map):
+            try:
+                value = stat_map[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+            if value is None or value == '':
+                return default
+            if func is None:
+                return value
+            try:
+                return func(value)
+            except Exception:
+                return default
+    else:
+        def _extract(stat_map):
+            value = stat_map
+            try:
+                for component in components:
+                    value = value[component]
+            except (KeyError, IndexError, TypeError):
+                return default
+            if value is None or value == '':
+                return default
+            if func is None:
+                return value
+            try:
+                return func(value)
+            except Exception:
+                return default
+
+    return _extract
+
+
+def _compile_plan(spec):
+    """ Compile a metric extraction spec into a plan of (metric name, extractor) tuples.
+
+    :param spec: (metric name, default, func, *components) tuples
+    :type spec: tuple
+    :return: (metric name, extractor) tuples in spec order
+    :rtype: tuple
+    """
+    return tuple((entry[0], _compile_extractor(*entry[1:])) for entry in spec)
+
+
+# Metric extraction specs: (metric name, default, conversion function, *path components)
+TOPOLOGY_STATS_SPEC = (
+    ('acked', 0, _long, 'topologyStats', 0, 'acked'),
+    ('assignedCpu', 0.0, _float, 'assignedCpu'),
+    ('assignedMemOffHeap', 0, _long, 'assignedMemOffHeap'),
+    ('assignedMemOnHeap', 0, _long, 'assignedMemOnHeap'),
+    ('assignedTotalMem', 0, _long, 'assignedTotalMem'),
+    ('completeLatency', 0.0, _float, 'topologyStats', 0, 'completeLatency'),
+    ('debug', 0, _debug_flag, 'debug'),
+    ('emitted', 0, _long, 'topologyStats', 0, 'emitted'),
+    ('executorsTotal', 0, _long, 'executorsTotal'),
+    ('failed', 0, _long, 'topologyStats', 0, 'failed'),
+    ('msgTimeout', 0, _long, 'msgTimeout'),
+    ('numBolts', 0, len, 'bolts'),
+    ('numSpouts', 0, len, 'spouts'),
+    ('replicationCount', 0, _long, 'replicationCount'),
+    ('requestedCpu', 0.0, _float, 'requestedCpu'),
+    ('requestedMemOffHeap', 0.0, _float, 'requestedMemOffHeap'),
+    ('requestedMemOnHeap', 0.0, _float, 'requestedMemOnHeap'),
+    ('samplingPct', 0.0, _float, 'samplingPct'),
+    ('tasksTotal', 0, _long, 'tasksTotal'),
+    ('transferred', 0, _long, 'topologyStats', 0, 'transferred'),
+    ('uptimeSeconds', 0, _long, 'uptimeSeconds'),
+    ('workersTotal', 0, _long, 'workersTotal'),
+)
+
+BOLT_STATS_SPEC = tuple(
+    [(metric_name, 0, _long, metric_name) for metric_name in [
+        'acked', 'emitted', 'executed', 'executors', 'failed', 'requestedMemOffHeap', 'requestedMemOnHeap', 'tasks',
+        'transferred']] +
+    [(metric_name, 0, _float, metric_name) for metric_name in [
+        'capacity', 'executeLatency', 'processLatency', 'requestedCpu']] +
+    [('errorLapsedSecs', 1E10, _float, 'errorLapsedSecs')]
+)
+
+SPOUT_STATS_SPEC = tuple(
+    [(metric_name, 0, _long, metric_name) for metric_name in [
+        'acked', 'emitted', 'executors', 'failed', 'requestedMemOffHeap', 'requestedMemOnHeap', 'tasks',
+        'transferred']] +
+    [(metric_name, 0, _float, metric_name) for metric_name in ['completeLatency', 'requestedCpu']] +
+    [('errorLapsedSecs', 1E10, _float, 'errorLapsedSecs')]
+)
+
+WORKER_STATS_SPEC = (
+    ('assignedCpu', 0, _float, 'assignedCpu'),
+    ('assignedMemOffHeap', 0, _long, 'assignedMemOffHeap'),
+    ('assignedMemOnHeap', 0, _long, 'assignedMemOnHeap'),
+    ('executorsTotal', 0, _long, 'executorsTotal'),
+    ('uptimeSeconds', 0, _long, 'uptimeSeconds'),
+)
+
+# Fields of the extraction specs that only change when a topology is redeployed or rebalanced
+TOPOLOGY_STATIC_FIELDS = frozenset([
+    'assignedCpu', 'assignedMemOffHeap', 'assignedMemOnHeap', 'assignedTotalMem', 'debug', 'executorsTotal',
+    'msgTimeout', 'numBolts', 'numSpouts', 'replicationCount', 'requestedCpu', 'requestedMemOffHeap',
+    'requestedMemOnHeap', 'samplingPct', 'tasksTotal', 'workersTotal'])
+BOLT_STATIC_FIELDS = SPOUT_STATIC_FIELDS = frozenset([
+    'executors', 'requestedCpu', 'requestedMemOffHeap', 'requestedMemOnHeap', 'tasks'])
+WORKER_STATIC_FIELDS = frozenset(['assignedCpu', 'assignedMemOffHeap', 'assignedMemOnHeap', 'executorsTotal'])
+
+TOPOLOGY_METRICS_STREAM_STATS = ('acked', 'complete_ms_avg', 'emitted', 'executed', 'executed_ms_avg', 'failed',
+                                 'process_ms_avg', 'transferred')
+TOPOLOGY_METRICS_COMPONENT_TYPES = ('bolts', 'spouts')
+
+# Cumulative counters, and averages weighted by one of those counters, derived per interval from all-time stats
+TOPOLOGY_COUNTERS = ('acked', 'emitted', 'failed', 'transferred')
+TOPOLOGY_AVERAGES = {'completeLatency': 'acked'}
+BOLT_COUNTERS = ('acked', 'emitted', 'executed', 'failed', 'transferred')
+BOLT_AVERAGES = {'executeLatency': 'executed', 'processLatency': 'acked'}
+SPOUT_COUNTERS = ('acked', 'emitted', 'failed', 'transferred')
+SPOUT_AVERAGES = {'completeLatency': 'acked'}
+STREAM_COUNTERS = ('acked', 'emitted', 'executed', 'failed', 'transferred')
+STREAM_AVERAGES = {'complete_ms_avg': 'acked', 'executed_ms_avg': 'executed', 'process_ms_avg': 'acked'}
+
+
+def _counter_sample(stat_map, counters, averages):
+    """ Take a sample of the cumulative counters and averages of a stat map.
+
+    :param stat_map: stat map
+    :param counters: counter fields
+    :param averages: average fields mapped to the counter they are weighted by
+    :return: sample
+    :rtype: dict
+    """
+    sample = {}
+    for field in counters:
+        sample[field] = _get_float(stat_map, 0.0, field)
+    for field in averages:
+        sample[field] = _get_float(stat_map, 0.0, field)
+    return sample
+
+
+def _derive_window(current, previous, elapsed, window, counters, averages):
+    """ Derive the values over a window from two cumulative samples taken `elapsed` seconds apart.
+
+    Counter deltas are scaled from `elapsed` to `window` seconds, averages are re-weighted by their counter's delta.
+
+    :param current: current sample
+    :param previous: previous sample
+    :param elapsed: seconds between both samples
+    :param window: window in seconds
+    :param counters: counter fields
+    :param averages: average fields mapped to the counter they are weighted by
+    :return: derived values
+    :rtype: dict
+    """
+    scale = float(window) / elapsed
+    derived = {}
+    for field in counters:
+        derived[field] = long(round(max(current[field] - previous[field], 0) * scale))
+    for field, weight in averages.items():
+        count = current[weight] - previous[weight]
+        if count > 0:
+            derived[field] = max((current[field] * current[weight] - previous[field] * previous[weight]) / count, 0.0)
+        else:
+            derived[field] = 0.0
+    return derived
+
+
+class SampleHistory(object):
+    """ Bounded history of cumulative samples, kept per (topology, component, stream) key.
+
+    Each interval keeps at most `samples_per_interval` + 1 samples spaced at least interval / `samples_per_interval`
+    seconds apart, so once warmed up there is always a sample about one interval old.
+    """
+
+    def __init__(self, samples_per_interval):
+        self.samples_per_interval = samples_per_interval
+        # topology id -> key -> [last sample timestamp, {interval: deque of (timestamp, sample)}]
+        self.topologies = {}
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.topologies.values())
+
+    def add(self, topology_id, key, timestamp, sample, intervals):
+        """ Record a sample for each interval whose spacing allows it. """
+        entry = self.topologies.setdefault(topology_id, {}).get(key)
+        if entry is None:
+            entry = self.topologies[topology_id][key] = [timestamp, {}]
+        entry[0] = timestamp
+        for interval in intervals:
+            samples = entry[1].get(interval)
+            if samples is None:
+                samples = entry[1][interval] = deque(maxlen=self.samples_per_interval + 1)
+            if not samples or timestamp - samples[-1][0] >= float(interval) / self.samples_per_interval:
+                samples.append((timestamp, sample))
+
+    def find(self, topology_id, key, interval, timestamp):
+        """ Find the newest sample at least `interval` seconds older than `timestamp`.
+
+        :return: (sample timestamp, sample), or (None, None) if there is none yet
+        :rtype: tuple
+        """
+        entry = self.topologies.get(topology_id, {}).get(key)
+        if entry is not None:
+            for sample_timestamp, sample in reversed(entry[1].get(interval, ())):
+                if timestamp - sample_timestamp >= interval:
+                    return sample_timestamp, sample
+        return None, None
+
+    def expire(self, topology_ids, timestamp, max_age):
+        """ Drop the topologies not in `topology_ids` and the keys without a sample in the last `max_age` seconds. """
+        for topology_id in self.topologies.keys():
+            if topology_id not in topology_ids:
+                del self.topologies[topology_id]
+                continue
+            keys = self.topologies[topology_id]
+            for key in [key for key, entry in keys.items() if timestamp - entry[0] > max_age]:
+                del keys[key]
+
+
+class TopologyActivity(object):
+    """ Per topology activity tracker, backing off the polling of idle topologies exponentially.
+
+    A topology is idle when it is not ACTIVE, or when its all-time acked and emitted counts did not move since its
+    previous poll. Each consecutive idle poll doubles the delay before the next one, from `backoff` up to
+    `max_backoff` seconds, and any activity resets it.
+    """
+
+    def __init__(self, backoff, max_backoff):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # topology id -> [acked + emitted total, consecutive idle polls, next poll timestamp]
+        self.topologies = {}
+
+    def should_poll(self, topology_id, timestamp):
+        """ Whether the topology is due for polling at `timestamp`. """
+        entry = self.topologies.get(topology_id)
+        return entry is None or timestamp >= entry[2]
+
+    def update(self, topology_id, status, total, timestamp):
+        """ Record a poll of the topology and schedule its next one.
+
+        :param status: Topology status
+        :type status: str
+        :param total: All-time acked + emitted count, or None if unknown
+        :type total: long
+        :return: True if the topology was idle
+        :rtype: bool
+        """
+        entry = self.topologies.get(topology_id)
+        if entry is None:
+            entry = self.topologies[topology_id] = [None, 0, timestamp]
+        idle = status != 'ACTIVE' or (total is not None and total == entry[0])
+        entry[0] = total
+        if idle:
+            entry[1] += 1
+            entry[2] = timestamp + min(self.backoff * 2 ** (entry[1] - 1), self.max_backoff)
+        else:
+            entry[1] = 0
+            entry[2] = timestamp
+        return idle
+
+    def expire(self, topology_ids):
+        """ Drop the topologies not in `topology_ids`. """
+        for topology_id in self.topologies.keys():
+            if topology_id not in topology_ids:
+                del self.topologies[topology_id]
+
+
+class StaticSeriesCache(object):
+    """ Bounded last-value cache of the static attribute series of topologies.
+
+    A series is emitted when its value changes, or when it was last emitted `heartbeat` seconds ago or more. The
+    cache keeps the `max_series` most recently seen series, and forgets the topologies that disappear.
+    """
+
+    def __init__(self, max_series, heartbeat):
+        self.max_series = max_series
+        self.heartbeat = heartbeat
+        # (topology, metric name, tags) -> [last emitted value, last emission timestamp], least recently seen first
+        self.series = OrderedDict()
+        self.suppressed = 0
+
+    def __len__(self):
+        return len(self.series)
+
+    def should_emit(self, topology, metric_name, tags, value, timestamp):
+        """ Whether a static series should be emitted, recording its emission if so.
+
+        :rtype: bool
+        """
+        key = (topology, metric_name, tuple(tags))
+        entry = self.series.pop(key, None)
+        if entry is not None and entry[0] == value and timestamp - entry[1] < self.heartbeat:
+            self.series[key] = entry
+            self.suppressed += 1
+            return False
+        self.series[key] = [value, timestamp]
+        if len(self.series) > self.max_series:
+            self.series.popitem(last=False)
+        return True
+
+    def expire(self, topologies):
+        """ Forget the series of the topologies not in `topologies`. """
+        for key in [key for key in self.series if key[0] not in topologies]:
+            del self.series[key]
+
+
+def _compile_topology_rules(rules):
+    """ Compile topology name rules into a single regex source.
+
+    A rule is a glob matching the whole topology name, or a regex searched in the topology name when prefixed with
+    `re:`.
+
+    :param rules: Topology name rules
+    :type rules: list
+    :return: regex source, or None without rules
+    :rtype: str
+    """
+    patterns = []
+    for rule in rules:
+        if rule.startswith('re:'):
+            pattern = rule[3:]
+        else:
+            pattern = fnmatch.translate(rule)
+            if pattern.endswith('\\Z(?ms)'):
+                pattern = pattern[:-len('\\Z(?ms)')]
+            pattern = '^(?:{})\\Z'.format(pattern)
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise AssertionError("Invalid topology rule {!r}: {}".format(rule, e))
+        patterns.append('(?:{})'.format(pattern))
+    return '|'.join(patterns) if patterns else None
+
+
+class TopologyFilter(object):
+    """ Topology name filter with include and exclude rules, compiled once into one regex each.
+
+    Topologies are kept when they match an include rule (or there is none), and neither match an exclude rule nor are
+    in the exact `excluded` names. Decisions are memoized per topology name, up to `max_names` names.
+    """
+    MAX_NAMES = 10000
+
+    def __init__(self, include=(), exclude=(), excluded=(), max_names=MAX_NAMES):
+        self.rules = (tuple(include), tuple(exclude), tuple(excluded))
+        include_pattern = _compile_topology_rules(include)
+        exclude_pattern = _compile_topology_rules(exclude)
+        self.include = re.compile(include_pattern, re.S) if include_pattern else None
+        self.exclude = re.compile(exclude_pattern, re.S) if exclude_pattern else None
+        self.excluded = frozenset(excluded)
+        self.max_names = max_names
+        self.decisions = {}
+
+    def is_included(self, topology_name):
+        """ Whether a topology is collected.
+
+        :rtype: bool
+        """
+        decision = self.decisions.get(topology_name)
+        if decision is None:
+            decision = (topology_name not in self.excluded and
+                        (self.include is None or self.include.search(topology_name) is not None) and
+                        (self.exclude is None or self.exclude.search(topology_name) is None))
+            if len(self.decisions) >= self.max_names:
+                self.decisions.clear()
+            self.decisions[topology_name] = decision
+        return decision
+
+
+class CircuitBreakers(object):
+    """ Per endpoint circuit breakers.
+
+    An endpoint's breaker opens after `threshold` consecutive failed requests, and the endpoint is not requested
+    again until its back-off has elapsed. The breaker is then half-open and lets a single probe request through, which
+    closes it on success, or reopens it for twice the back-off on failure, up to `max_backoff` seconds. A probe whose
+    outcome is never recorded is given up on after the back-off, and another one is let through.
+    """
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, threshold, backoff, max_backoff):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        # endpoint -> [state, consecutive failures, back-off, open (or probing) until timestamp]
+        self.endpoints = {}
+
+    def allow(self, endpoint, timestamp):
+        """ Whether a request to the endpoint may be sent at `timestamp`. """
+        with self.lock:
+            entry = self.endpoints.get(endpoint)
+            if entry is None or entry[0] == CircuitBreakers.CLOSED:
+                return True
+            if timestamp >= entry[3]:
+                # open past its back-off, or half-open with a probe that was lost
+                entry[0] = CircuitBreakers.HALF_OPEN
+                entry[3] = timestamp + entry[2]
+                return True
+            # open, or half-open with its probe in flight
+            return False
+
+    def record_success(self, endpoint):
+        """ Record a successful request, closing the endpoint's breaker. """
+        with self.lock:
+            entry = self.endpoints.get(endpoint)
+            if entry is not None:
+                entry[:] = [CircuitBreakers.CLOSED, 0, 0, 0]
+
+    def record_failure(self, endpoint, timestamp):
+        """ Record a failed request.
+
+        :return: Back-off in seconds if the failure opened the endpoint's breaker, else None
+        :rtype: float
+        """
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, [CircuitBreakers.CLOSED, 0, 0, 0])
+            entry[1] += 1
+            if entry[0] == CircuitBreakers.HALF_OPEN:
+                backoff = min(entry[2] * 2, self.max_backoff)
+            elif entry[1] >= self.threshold:
+                backoff = self.backoff
+            else:
+                return None
+            entry[:] = [CircuitBreakers.OPEN, entry[1], backoff, timestamp + backoff]
+            return backoff
+
+    def states(self):
+        """ Get the breaker state of every endpoint with a recent failure, and forget the endpoints that recovered.
+
+        :return: endpoint mapped to its breaker state
+        :rtype: dict
+        """
+        with self.lock:
+            states = dict((endpoint, entry[0]) for endpoint, entry in self.endpoints.items())
+            for endpoint in [endpoint for endpoint, entry in self.endpoints.items() if entry[1] == 0]:
+                del self.endpoints[endpoint]
+        return states
+
+
+class ServerHealth(object):
+    """ Health of the replicas of a Storm UI, ordering the servers a request is tried against.
+
+    A server that fails a request is demoted for `BACKOFF` seconds, doubling on each consecutive failure up to
+    `MAX_BACKOFF`. Available servers come first, ordered by smoothed latency, or, when an affinity key is given,
+    starting from the one a stable hash of the key picks. Demoted servers come last, as a last resort.
+    """
+
+    BACKOFF = 30
+    MAX_BACKOFF = 300
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # server -> [consecutive failures, smoothed latency, demoted until timestamp]
+        self.servers = {}
+
+    def order(self, servers, timestamp, affinity=None):
+        """ Order `servers` by health.
+
+        :param affinity: Key spreading requests across the available servers, or None to prefer the fastest
+        :type affinity: basestring
+        :return: servers in the order to try them
+        :rtype: list
+        """
+        with self.lock:
+            entries = [(server, list(self.servers.get(server, (0, 0.0, 0)))) for server in servers]
+        available = [server for server, entry in entries if entry[2] <= timestamp]
+        demoted = [server for server, entry in sorted(entries, key=lambda e: e[1][2]) if entry[2] > timestamp]
+        if affinity is not None and available:
+            if isinstance(affinity, unicode):
+                affinity = affinity.encode('utf-8')
+            start = zlib.crc32(affinity) % len(available)
+            available = available[start:] + available[:start]
+        else:
+            latencies = dict((server, entry[1]) for server, entry in entries)
+            available.sort(key=lambda server: latencies[server])
+        return available + demoted
+
+    def record_success(self, server, latency):
+        """ Record a successful request and its latency, restoring the server. """
+        with self.lock:
+            entry = self.servers.get(server)
+            if entry is None:
+                self.servers[server] = [0, latency, 0]
+            else:
+                entry[:] = [0, entry[1] + ServerHealth.LATENCY_WEIGHT * (latency - entry[1]), 0]
+
+    def record_failure(self, server, timestamp):
+        """ Record a failed request, demoting the server. """
+        with self.lock:
+            entry = self.servers.setdefault(server, [0, 0.0, 0])
+            entry[0] += 1
+            entry[2] = timestamp + min(ServerHealth.BACKOFF * 2 ** (entry[0] - 1), ServerHealth.MAX_BACKOFF)
+
+    def is_healthy(self, server, timestamp):
+        """ Whether the server is not demoted at `timestamp`. """
+        with self.lock:
+            entry = self.servers.get(server)
+            return entry is None or entry[2] <= timestamp
+
+
+class PhaseTimer(object):
+    """ Accumulates the time spent in each phase of a check run, overall and per topology.
+
+    Phases are added to from the fetching threads too, hence the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # phase -> [seconds, calls]
+        self.phases = {}
+        # topology id -> {phase: seconds}
+        self.topologies = {}
+
+    def add_topology(self, topology, phase, seconds):
+        """ Add time spent on behalf of a topology only, outside of the run's phases. """
+        with self.lock:
+            phases = self.topologies.setdefault(topology, {})
+            phases[phase] = phases.get(phase, 0) + seconds
+
+    def add(self, phase, seconds, topology=None):
+        """ Add time spent in a phase, on behalf of `topology` if set. """
+        with self.lock:
+            entry = self.phases.get(phase)
+            if entry is None:
+                self.phases[phase] = [seconds, 1]
+            else:
+                entry[0] += seconds
+                entry[1] += 1
+            if topology is not None:
+                phases = self.topologies.setdefault(topology, {})
+                phases[phase] = phases.get(phase, 0) + seconds
+
+    def slowest_topologies(self, count):
+        """ Get the `count` topologies the run spent the most time on.
+
+        :return: (topology id, total seconds, {phase: seconds}) tuples, slowest first
+        :rtype: list
+        """
+        return heapq.nlargest(count, ((topology, sum(phases.values()), phases)
+                                      for topology, phases in self.topologies.items()), key=lambda t: t[1])
+
+
+class ResponseArchive(object):
+    """ Compressed archive of Storm UI responses, recorded from and replayed to the check's HTTP sessions.
+
+    The archive is a gzip stream of entries, each a JSON header line followed by the raw response body, and every
+    check run starts with a header without url. Recording appends entries, and replaying reads them forward one at a
+    time, so captures of any size are never held in memory. Replay serves the responses of one recorded run per check
+    run, in any order, and starts over from the first run at the end of the archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.writer = None
+        self.reader = None
+        # Entries of the current run read ahead of their request: key -> deque of (status, content type, body)
+        self.pending = {}
+        self.run_ended = True
+        self.eof = True
+
+    @staticmethod
+    def get_key(url):
+        """ Get the archive key of a url: its path and sorted query, so replays work against any server.
+
+        :rtype: str
+        """
+        parsed = urlparse.urlsplit(url)
+        query = urllib.urlencode(sorted(urlparse.parse_qsl(parsed.query, keep_blank_values=True)))
+        return '{}?{}'.format(parsed.path, query) if query else parsed.path
+
+    def _write(self, header, body=''):
+        self.writer.write(json.dumps(header) + '\n')
+        self.writer.write(body)
+        self.writer.write('\n')
+
+    def _read(self):
+        """ Read the next entry.
+
+        :return: (header, body), or None at the end of the archive
+        :rtype: tuple
+        """
+        line = self.reader.readline()
+        if not line:
+            return None
+        header = json.loads(line)
+        body = self.reader.read(header.get('length', 0))
+        self.reader.read(1)
+        return header, body
+
+    def start_run(self, recording):
+        """ Start a check run: mark it in the archive when recording, or move to the next recorded run. """
+        with self.lock:
+            if recording:
+                if self.writer is None:
+                    self.writer = gzip.open(self.path, 'ab')
+                else:
+                    self.writer.flush()
+                self._write({'run': time.time()})
+                return
+            self.pending.clear()
+            while not self.run_ended:
+                entry = self._read()
+                self.run_ended = entry is None or 'url' not in entry[0]
+                self.eof = entry is None
+            if self.eof:
+                if self.reader is not None:
+                    self.reader.close()
+                self.reader = gzip.open(self.path, 'rb')
+                # the first entry marks the first run
+                self.eof = self._read() is None
+            self.run_ended = self.eof
+
+    def record(self, url, status, content_type, body):
+        with self.lock:
+            self._write({'url': self.get_key(url), 'status': status, 'content_type': content_type,
+                         'length': len(body)}, body)
+
+    def replay(self, url):
+        """ Get the recorded response of a url in the current run.
+
+        :return: (status, content type, body), or None when the run has no response left for the url
+        :rtype: tuple
+        """
+        key = self.get_key(url)
+        with self.lock:
+            entries = self.pending.get(key)
+            if entries:
+                return entries.popleft()
+            while not self.run_ended:
+                entry = self._read()
+                if entry is None or 'url' not in entry[0]:
+                    self.run_ended = True
+                    self.eof = entry is None
+                    break
+                header, body = entry
+                response = (header['status'], header.get('content_type'), body)
+                if header['url'] == key:
+                    return response
+                self.pending.setdefault(header['url'], deque()).append(response)
+            return None
+
+    def close(self):
+        with self.lock:
+            for f in (self.writer, self.reader):
+                if f is not None:
+                    f.close()
+            self.writer = self.reader = None
+            self.run_ended = self.eof = True
+
+
+def _build_archived_response(adapter, request, status, content_type, body):
+    """ Build a response to `request` from an archived body, readable both at once and as a stream.
+
+    :rtype: requests.Response
+    """
+    headers = {'Content-Type': content_type} if content_type else {}
+    raw = HTTPResponse(body=io.BytesIO(body), headers=headers, status=status, preload_content=False)
+    return adapter.build_response(request, raw)
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    """ HTTP adapter recording every response it receives to a response archive. """
+
+    def __init__(self, archive, *args, **kwargs):
+        self.archive = archive
+        super(RecordingAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        response = super(RecordingAdapter, self).send(request, **kwargs)
+        # streamed responses are read in full too, and served back from the recorded body
+        body = response.content
+        content_type = response.headers.get('Content-Type')
+        self.archive.record(request.url, response.status_code, content_type, body)
+        return _build_archived_response(self, request, response.status_code, content_type, body)
+
+
+class ReplayAdapter(requests.adapters.HTTPAdapter):
+    """ HTTP adapter serving the responses of a response archive, without any network. """
+
+    NOT_RECORDED = json.dumps({'error': 'Response not recorded'})
+
+    def __init__(self, archive, *args, **kwargs):
+        self.archive = archive
+        super(ReplayAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        recorded = self.archive.replay(request.url)
+        if recorded is None:
+            recorded = (404, 'application/json', ReplayAdapter.NOT_RECORDED)
+        return _build_archived_response(self, request, *recorded)
+
+
+def _timed(phase):
+    """ Decorate a StormCheck method to add its duration to the run's phase timer, when phase timing is enabled.
+
+    :param phase: Phase name
+    :type phase: str
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(self, *args, **kwargs):
+            timer = self.phase_timer
+            if timer is None:
+                return func(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                timer.add(phase, time.time() - start)
+        return _wrapper
+    return _decorator
+
+
+def _log_request_failure(log, breakers, endpoint, url, error_message, exception=None):
+    """ Log a failed request, and record it in the endpoint's circuit breaker.
+
+    The exception is only logged while the breaker stays closed, an opened breaker logs its back-off instead.
+
+    :param breakers: Circuit breakers, or None when disabled
+    :type breakers: CircuitBreakers
+    :param endpoint: Endpoint path
+    :type endpoint: str
+    """
+    log.warning("[url:{}] {}".format(url, error_message))
+    backoff = breakers.record_failure(endpoint, time.time()) if breakers is not None else None
+    if backoff is not None:
+        log.warning("[url:{}] Opening the circuit breaker of {} for {}s".format(url, endpoint, backoff))
+    elif exception is not None:
+        log.exception(exception)
+
+
+class EventLoopFetcher(object):
+    """ Fetches batches of Storm UI requests concurrently on a single tornado IOLoop.
+
+    At most `max_requests_per_host` requests are in flight per host, and no request outlives the batch deadline: the
+    requests that cannot complete by then are abandoned and their result left empty.
+    """
+
+    def __init__(self, max_requests_per_host, connect_timeout, read_timeout, log):
+        self.max_requests_per_host = max_requests_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.log = log
+        self.io_loop = ioloop.IOLoop()
+
+    def close(self):
+        self.io_loop.close(all_fds=True)
+
+    def fetch(self, fetches, deadline=None, breakers=None, health=None, timer=None):
+        """ Fetch and parse a batch of JSON requests.
+
+        Each request is sent to its first candidate server, and fails over to the next ones on errors.
+
+        :param fetches: ([(server, url), ...] candidates, error message) tuples
+        :type fetches: list
+        :param deadline: Time (as in `time.time()`) the batch must complete by, or None
+        :type deadline: float
+        :param breakers: Circuit breakers of the endpoints, or None
+        :type breakers: CircuitBreakers
+        :param health: Health of the servers, or None
+        :type health: ServerHealth
+        :param timer: Phase timer of the run, or None. Connecting is part of the transfer phase.
+        :type timer: PhaseTimer
+        :return: Parsed responses in `fetches` order, empty for the failed and abandoned requests, and `SKIPPED` for
+            the requests not sent because the deadline had passed
+        :rtype: list
+        """
+        results = [{} for _ in fetches]
+        # index -> endpoint of the requests let through by their breaker, until their outcome is recorded
+        in_flight = {}
+        queues = {}
+        for i, (candidates, _) in enumerate(fetches):
+            queues.setdefault(urlparse.urlparse(candidates[0][1]).netloc, deque()).append(i)
+        if not queues:
+            return results
+
+        num_workers = dict((host, min(self.max_requests_per_host, len(queue))) for host, queue in queues.items())
+        self.io_loop.make_current()
+        client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=sum(num_workers.values()))
+
+        @gen.coroutine
+        def _worker(queue):
+            while queue:
+                i = queue.popleft()
+                candidates, error_message = fetches[i]
+                endpoint = urlparse.urlparse(candidates[0][1]).path
+                if deadline is not None and deadline <= time.time():
+                    self.log.warning("[url:{}] {}: run deadline exceeded".format(candidates[0][1], error_message))
+                    results[i] = SKIPPED
+                    continue
+                if breakers is not None:
+                    if not breakers.allow(endpoint, time.time()):
+                        self.log.debug("Circuit breaker of %s is open, skipping %s", endpoint, candidates[0][1])
+                        continue
+                    in_flight[i] = endpoint
+
+                for n, (server, url) in enumerate(candidates):
+                    timeout = self.read_timeout
+                    if deadline is not None:
+                        timeout = min(timeout, deadline - time.time())
+                        if timeout <= 0:
+                            _log_request_failure(self.log, breakers, endpoint, url,
+                                                 "{}: run deadline exceeded".format(error_message))
+                            break
+                    request = httpclient.HTTPRequest(url, connect_timeout=min(self.connect_timeout, timeout),
+                                                     request_timeout=timeout, use_gzip=True)
+                    start = time.time()
+                    try:
+                        self.log.debug("Fetching url %s", url)
+                        response = yield client.fetch(request)
+                        if timer is None:
+                            data = json.loads(response.body.decode('utf-8'))
+                        else:
+                            transferred = time.time()
+                            data = json.loads(response.body.decode('utf-8'))
+                            timer.add('request.transfer', transferred - start)
+                            timer.add('request.decode', time.time() - transferred)
+                    except Exception as e:
+                        if health is not None:
+                            health.record_failure(server, time.time())
+                        if n + 1 < len(candidates):
+                            self.log.warning("[url:{}] {}, failing over to {}".format(url, error_message,
+                                                                                      candidates[n + 1][0]))
+                            continue
+                        _log_request_failure(self.log, breakers, endpoint, url, error_message, e)
+                        break
+                    if health is not None:
+                        health.record_success(server, time.time() - start)
+                    if 'error' in data:
+                        _log_request_failure(self.log, breakers, endpoint, url, error_message)
+                        break
+                    if breakers is not None:
+                        breakers.record_success(endpoint)
+                    results[i] = data
+                    break
+                in_flight.pop(i, None)
+
+        @gen.coroutine
+        def _run():
+            yield [_worker(queues[host]) for host in queues for _ in range(num_workers[host])]
+
+        try:
+            # every request is bounded by the deadline already, the loop timeout is only a safety net
+            self.io_loop.run_sync(_run, timeout=None if deadline is None else max(deadline - time.time(), 0) + 1)
+        except ioloop.TimeoutError:
+            self.log.warning("Abandoning the Storm UI requests still running past the run deadline")
+            # count them as failures, or a half-open breaker would wait for its lost probe
+            now = time.time()
+            for endpoint in in_flight.values():
+                breakers.record_failure(endpoint, now)
+        finally:
+            client.close()
+            ioloop.IOLoop.clear_current()
+        return results
+
+
 class StormCheck(AgentCheck):
     """
     Apache Storm 1.x.x Topology Execution Stats
@@ -197,22 +1104,398 @@ class StormCheck(AgentCheck):
     DEFAULT_STORM_SERVER = 'http://localhost:9005'
     DEFAULT_STORM_ENVIRONMENT = 'dev'
     DEFAULT_STORM_INTERVALS = [60]
+    DEFAULT_STORM_MAX_CONCURRENCY = 1
+    DEFAULT_STORM_POOL_SIZE = 10
+    DEFAULT_STORM_CONNECT_TIMEOUT = 5
+    DEFAULT_STORM_READ_TIMEOUT = 30
+    DEFAULT_STORM_HISTORY_SAMPLES = 8
+    DEFAULT_STORM_IDLE_BACKOFF = 0
+    DEFAULT_STORM_MAX_IDLE_BACKOFF = 600
+    DEFAULT_STORM_MAX_STREAM_SERIES = 0
+    OTHER_SERIES = 'other'
+    DEFAULT_STORM_COLLECTION_ENGINE = 'threads'
+    DEFAULT_STORM_MAX_REQUESTS_PER_HOST = 10
+    DEFAULT_STORM_DEADLINE = 0
+    DEFAULT_STORM_CIRCUIT_BREAKER_THRESHOLD = 0
+    DEFAULT_STORM_CIRCUIT_BREAKER_BACKOFF = 60
+    DEFAULT_STORM_CIRCUIT_BREAKER_MAX_BACKOFF = 900
+    DEFAULT_STORM_STATIC_ATTRIBUTES_HEARTBEAT = 0
+    DEFAULT_STORM_STATIC_ATTRIBUTES_CACHE_SIZE = 50000
+    DEFAULT_STORM_COMPONENT_NUM_TASKS = ('component', 'supervisor')
+    COMPONENT_NUM_TASKS_LEVELS = ('component', 'supervisor', 'worker')
+    COLLECTION_ENGINES = ('threads', 'event_loop')
+    # Summaries in priority order
+    SUMMARY_CACHE_NAMES = ('cluster', 'topology', 'nimbus', 'supervisor')
+    REQUEST_TYPES = ('summary', 'topology_info', 'topology_metrics')
+    SUMMARY_REQUESTS = {
+        'cluster': ("/api/v1/cluster/summary", "Error retrieving Storm Cluster Summary"),
+        'nimbus': ("/api/v1/nimbus/summary", "Error retrieving Storm Nimbus Summary"),
+        'supervisor': ("/api/v1/supervisor/summary", "Error retrieving Storm Supervisor Summary"),
+        'topology': ("/api/v1/topology/summary", "Error retrieving Storm Topology Summary"),
+    }
+    ALL_TIME_WINDOW = ':all-time'
+
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.fetchers = {}
+        self.circuit_breakers = {}
+        self.server_health = {}
+        self.static_series_caches = {}
+        self.phase_timer = None
+        self.archives = {}
+        self.record_path = self.replay_path = None
+        self.topology_filters = {}
+        self.sample_histories = {}
+        self.topology_activities = {}
+        self.summary_cache = {}
+        self.summary_cache_stats = {}
+        self.summary_prefetch = {}
+        self.skipped_requests = {}
+
+        # Compiled metric extraction plans
+        self.topology_stats_plan = _compile_plan(TOPOLOGY_STATS_SPEC)
+        self.bolt_stats_plan = _compile_plan(BOLT_STATS_SPEC)
+        self.spout_stats_plan = _compile_plan(SPOUT_STATS_SPEC)
+        self.worker_stats_plan = _compile_plan(WORKER_STATS_SPEC)
+        self.extract_name = _compile_extractor('unknown', str, 'name')
+        self.extract_bolt_id = _compile_extractor('unknown', str, 'boltId')
+        self.extract_spout_id = _compile_extractor('unknown', str, 'spoutId')
+        self.extract_worker_host = _compile_extractor('unknown', str, 'host')
+        self.extract_worker_port = _compile_extractor(0, _long, 'port')
+        self.extract_supervisor_id = _compile_extractor('unknown', str, 'supervisorId')
+        self.extract_component_id = _compile_extractor('unknown', str, 'id')
+        self.extract_stream_id = _compile_extractor('unknown', str, 'stream_id')
+        self.extract_stream_value = _compile_extractor(0.0, _float, 'value')
+
+        # Interned metric names keyed by (entity, interval, field), and the per interval plans built from them
+        self.metric_names = {}
+        self.interval_plans = {}
+        # Full tag sets keyed by the topology/component tags, rebuilt every run
+        self.environment_tags = []
+        self.tag_cache = {}
+
+    def get_session(self, server=None):
+        """ Get the keep-alive HTTP session for a server, creating it on first use.
+
+        Each configured server owns one session so connections to the Storm UI are pooled and reused across requests
+        and check runs.
+
+        :param server: Server, defaults to the configured server
+        :type server: str
+        :return: HTTP session
+        :rtype: requests.Session
+        """
+        key = (server or self.nimbus_server, self.pool_size, self.record_path, self.replay_path)
+        with self.sessions_lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                if self.replay_path:
+                    adapter = ReplayAdapter(self.get_response_archive())
+                elif self.record_path:
+                    adapter = RecordingAdapter(self.get_response_archive(), pool_connections=1,
+                                               pool_maxsize=self.pool_size)
+                else:
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self.sessions[key] = session
+            return session
 
-    def get_request_json(self, url_part, error_message, params=None):
-        url = "{}{}".format(self.nimbus_server, url_part)
-        try:
-            self.log.debug("Fetching url %s", url)
-            resp = requests.get(url, params=params)
-            resp.encoding = 'utf-8'
-            data = resp.json()
+    def get_response_archive(self):
+        """ Get the response archive recorded to or replayed from, if any.
+
+        :rtype: ResponseArchive
+        """
+        path = self.replay_path or self.record_path
+        if not path:
+            return None
+        # called from get_session with the sessions lock held, and from the check thread before any fetching
+        archive = self.archives.get(path)
+        if archive is None:
+            archive = self.archives[path] = ResponseArchive(path)
+        return archive
+
+    def get_connection_stats(self):
+        """ Get the connection pool counters of the configured servers' sessions.
+
+        :return: (number of connections opened, number of requests sent)
+        :rtype: tuple
+        """
+        opened = sent = 0
+        for server in self.servers:
+            for adapter in set(self.get_session(server).adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    opened += pool.num_connections
+                    sent += pool.num_requests
+        return opened, sent
+
+    def get_server_health(self):
+        """ Get the health of the configured servers.
+
+        :rtype: ServerHealth
+        """
+        health = self.server_health.get(self.nimbus_server)
+        if health is None:
+            health = self.server_health[self.nimbus_server] = ServerHealth()
+        return health
+
+    def get_servers(self, affinity=None):
+        """ Get the configured servers in the order to try them for a request.
+
+        :param affinity: Key of the request spreading it across the servers, when `spread_topologies` is enabled
+        :type affinity: str
+        :rtype: list
+        """
+        if len(self.servers) == 1:
+            return self.servers
+        return self.get_server_health().order(self.servers, time.time(),
+                                              affinity if self.spread_topologies else None)
+
+    def get_fetcher(self):
+        """ Get the event loop fetcher of the configured server, creating it on first use.
+
+        :rtype: EventLoopFetcher
+        """
+        key = (self.nimbus_server, self.max_requests_per_host, self.connect_timeout, self.read_timeout)
+        fetcher = self.fetchers.get(key)
+        if fetcher is None:
+            fetcher = self.fetchers[key] = EventLoopFetcher(self.max_requests_per_host, self.connect_timeout,
+                                                            self.read_timeout, self.log)
+        return fetcher
+
+    def stop(self):
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+            for archive in self.archives.values():
+                archive.close()
+            self.archives.clear()
+        for fetcher in self.fetchers.values():
+            fetcher.close()
+        self.fetchers.clear()
+        AgentCheck.stop(self)
+
+    def get_request_url(self, url_part, params=None, server=None):
+        """ Get the full url of a request to a server, by default the configured server.
+
+        :rtype: str
+        """
+        url = "{}{}".format(server or self.nimbus_server, url_part)
+        if params:
+            url = "{}?{}".format(url, urllib.urlencode(sorted(params.items())))
+        return url
+
+    def deadline_exceeded(self):
+        """ Whether the run deadline has passed.
+
+        :rtype: bool
+        """
+        return self.run_deadline is not None and time.time() >= self.run_deadline
+
+    def get_request_timeout(self):
+        """ Get the (connect, read) timeouts of a request, bounded by the time left before the run deadline.
+
+        :rtype: tuple
+        """
+        if self.run_deadline is None:
+            return self.connect_timeout, self.read_timeout
+        remaining = max(self.run_deadline - time.time(), 0.001)
+        return min(self.connect_timeout, remaining), min(self.read_timeout, remaining)
+
+    def skip_request(self, request_type):
+        """ Count a request not sent because the run deadline had passed.
+
+        :param request_type: Request type, one of `REQUEST_TYPES`
+        :type request_type: str
+        """
+        self.skipped_requests[request_type] = self.skipped_requests.get(request_type, 0) + 1
+
+    def get_circuit_breakers(self):
+        """ Get the endpoint circuit breakers of the configured server.
+
+        :return: Circuit breakers, or None when they are disabled
+        :rtype: CircuitBreakers
+        """
+        if not self.circuit_breaker_threshold:
+            return None
+        settings = (self.circuit_breaker_threshold, self.circuit_breaker_backoff, self.circuit_breaker_max_backoff)
+        breakers = self.circuit_breakers.get(self.nimbus_server)
+        if breakers is None or (breakers.threshold, breakers.backoff, breakers.max_backoff) != settings:
+            breakers = self.circuit_breakers[self.nimbus_server] = CircuitBreakers(*settings)
+        return breakers
+
+    def get_request_candidates(self, url_part, params=None, affinity=None):
+        """ Get the (server, url) candidates of a request, in the order to try them.
+
+        :rtype: list
+        """
+        return [(server, self.get_request_url(url_part, params, server)) for server in self.get_servers(affinity)]
+
+    def get_request_json(self, url_part, error_message, params=None, affinity=None):
+        """ Make a JSON request, failing over to the next server when a server errors.
+
+        Error responses are not failed over: every replica is backed by the same Nimbus.
+
+        :return: Parsed response, or an empty dict on error
+        :rtype: dict
+        """
+        servers = self.get_servers(affinity)
+        breakers = self.get_circuit_breakers()
+        if breakers is not None and not breakers.allow(url_part, time.time()):
+            self.log.debug("Circuit breaker of %s is open, skipping %s%s", url_part, servers[0], url_part)
+            return {}
+        for n, server in enumerate(servers):
+            url = "{}{}".format(server, url_part)
+            start = time.time()
+            try:
+                self.log.debug("Fetching url %s", url)
+                if self.phase_timer is None:
+                    resp = self.get_session(server).get(url, params=params, timeout=self.get_request_timeout())
+                    resp.encoding = 'utf-8'
+                    data = resp.json()
+                else:
+                    data = self.get_timed_request_json(server, url, params, affinity)
+            except Exception as e:
+                if len(servers) > 1:
+                    self.get_server_health().record_failure(server, time.time())
+                if n + 1 < len(servers) and not self.deadline_exceeded():
+                    self.log.warning("[url:{}] {}, failing over to {}".format(url, error_message, servers[n + 1]))
+                    continue
+                _log_request_failure(self.log, breakers, url_part, url, error_message, e)
+                return {}
+            if len(servers) > 1:
+                self.get_server_health().record_success(server, time.time() - start)
             if 'error' in data:
-                self.log.warning("[url:{}] {}".format(url, error_message))
+                _log_request_failure(self.log, breakers, url_part, url, error_message)
                 return {}
+            if breakers is not None:
+                breakers.record_success(url_part)
             return data
-        except Exception as e:
-            self.log.warning("[url:{}] {}".format(url, error_message))
-            self.log.exception(e)
+
+    def get_timed_request_json(self, server, url, params, topology=None):
+        """ Make a JSON request, adding the time spent connecting (up to the response headers), transferring the
+        body and decoding it to the phase timer.
+
+        :param topology: Topology id the request is made for, or None
+        :type topology: str
+        :rtype: dict
+        """
+        timer = self.phase_timer
+        start = time.time()
+        resp = self.get_session(server).get(url, params=params, timeout=self.get_request_timeout(), stream=True)
+        connected = time.time()
+        timer.add('request.connect', connected - start, topology)
+        # the body is streamed: reading it here times the transfer apart from the decoding
+        body = resp.content
+        transferred = time.time()
+        timer.add('request.transfer', transferred - connected, topology)
+        data = json.loads(body.decode('utf-8'))
+        timer.add('request.decode', time.time() - transferred, topology)
+        return data
+
+    def get_request_stream(self, url_part, error_message, params=None, affinity=None):
+        """ Make a streaming request, returning as soon as the response headers have arrived, failing over to the
+        next server when a server errors.
+
+        :return: Response whose body has not been read yet, or None on error
+        :rtype: requests.Response
+        """
+        servers = self.get_servers(affinity)
+        breakers = self.get_circuit_breakers()
+        if breakers is not None and not breakers.allow(url_part, time.time()):
+            self.log.debug("Circuit breaker of %s is open, skipping %s%s", url_part, servers[0], url_part)
+            return None
+        for n, server in enumerate(servers):
+            url = "{}{}".format(server, url_part)
+            start = time.time()
+            try:
+                self.log.debug("Streaming url %s", url)
+                resp = self.get_session(server).get(url, params=params, timeout=self.get_request_timeout(),
+                                                    stream=True)
+                if self.phase_timer is not None:
+                    self.phase_timer.add('request.connect', time.time() - start, affinity)
+                resp.raise_for_status()
+                resp.raw.decode_content = True
+            except Exception as e:
+                if len(servers) > 1:
+                    self.get_server_health().record_failure(server, time.time())
+                if n + 1 < len(servers) and not self.deadline_exceeded():
+                    self.log.warning("[url:{}] {}, failing over to {}".format(url, error_message, servers[n + 1]))
+                    continue
+                _log_request_failure(self.log, breakers, url_part, url, error_message, e)
+                return None
+            if len(servers) > 1:
+                self.get_server_health().record_success(server, time.time() - start)
+            if breakers is not None:
+                breakers.record_success(url_part)
+            return resp
+
+    def get_summary_from_cache(self, summary_name, timestamp):
+        """ Get a summary from the summary cache, if it is younger than its TTL at `timestamp`.
+
+        :param summary_name: Summary name, one of `SUMMARY_CACHE_NAMES`
+        :type summary_name: str
+        :return: Summary Stats Response, or None on a cache miss
+        :rtype: dict
+        """
+        ttl = self.summary_cache_ttl.get(summary_name, 0)
+        key = (self.nimbus_server, summary_name)
+        if ttl > 0 and key in self.summary_cache:
+            cached_timestamp, data = self.summary_cache[key]
+            if timestamp - cached_timestamp < ttl:
+                return data
+        return None
+
+    def prefetch_summaries(self):
+        """ Fetch the summaries missing from the summary cache concurrently on the event loop, ahead of their
+        `get_storm_*_summary` calls. """
+        now = time.time()
+        names = [name for name in StormCheck.SUMMARY_CACHE_NAMES if self.get_summary_from_cache(name, now) is None]
+        fetches = [(self.get_request_candidates(StormCheck.SUMMARY_REQUESTS[name][0]),
+                    StormCheck.SUMMARY_REQUESTS[name][1]) for name in names]
+        self.summary_prefetch = dict(zip(names, self.get_fetcher().fetch(
+            fetches, self.run_deadline, self.get_circuit_breakers(), self.get_server_health(), self.phase_timer)))
+
+    def get_cached_summary(self, summary_name):
+        """ Make a summary request, serving it from the summary cache while it is younger than its TTL.
+
+        :param summary_name: Summary name, one of `SUMMARY_CACHE_NAMES`
+        :type summary_name: str
+        :return: Summary Stats Response
+        :rtype: dict
+        """
+        ttl = self.summary_cache_ttl.get(summary_name, 0)
+        key = (self.nimbus_server, summary_name)
+        stats = self.summary_cache_stats.setdefault(summary_name, [0, 0])
+        now = time.time()
+        data = self.get_summary_from_cache(summary_name, now)
+        if data is not None:
+            stats[0] += 1
+            return data
+
+        stats[1] += 1
+        if summary_name in self.summary_prefetch:
+            data = self.summary_prefetch.pop(summary_name)
+        elif self.deadline_exceeded():
+            data = SKIPPED
+        else:
+            data = self.get_request_json(*StormCheck.SUMMARY_REQUESTS[summary_name])
+        if data is SKIPPED:
+            self.log.warning("Skipping the Storm %s summary: run deadline exceeded", summary_name)
+            self.skip_request('summary')
             return {}
+        if ttl > 0 and data:
+            self.summary_cache[key] = (now, data)
+        else:
+            self.summary_cache.pop(key, None)
+        return data
 
     def get_storm_cluster_summary(self):
         """ Make the storm cluster summary metric request.
@@ -220,7 +1503,7 @@ class StormCheck(AgentCheck):
         :return: Cluster Summary Stats Response
         :rtype: dict
         """
-        return self.get_request_json("/api/v1/cluster/summary", "Error retrieving Storm Cluster Summary")
+        return self.get_cached_summary('cluster')
 
     def get_storm_nimbus_summary(self):
         """ Make the storm nimbus summary metric request.
@@ -228,7 +1511,7 @@ class StormCheck(AgentCheck):
         :return: Nimbus Summary Stats Response
         :rtype: dict
         """
-        return self.get_request_json("/api/v1/nimbus/summary", "Error retrieving Storm Nimbus Summary")
+        return self.get_cached_summary('nimbus')
 
     def get_storm_supervisor_summary(self):
         """ Make the storm supervisor summary metric request.
@@ -236,7 +1519,7 @@ class StormCheck(AgentCheck):
         :return: Supervisor Summary Stats Response
         :rtype: dict
         """
-        return self.get_request_json("/api/v1/supervisor/summary", "Error retrieving Storm Supervisor Summary")
+        return self.get_cached_summary('supervisor')
 
     def get_storm_topology_summary(self):
         """ Make the storm topology summary metric request.
@@ -244,7 +1527,7 @@ class StormCheck(AgentCheck):
         :return: Topology Summary Stats Response
         :rtype: dict
         """
-        return self.get_request_json("/api/v1/topology/summary", "Error retrieving Storm Topology Summary")
+        return self.get_cached_summary('topology')
 
     def get_topology_info(self, topology_id, interval=60):
         """ Make the topology info metric request.
@@ -257,7 +1540,7 @@ class StormCheck(AgentCheck):
         params = {'window': interval}
         return self.get_request_json("/api/v1/topology/{}".format(topology_id),
                                      "Error retrieving Storm Topology Info for topology:{}".format(topology_id),
-                                     params=params)
+                                     params=params, affinity=topology_id)
 
     def get_topology_metrics(self, topology_id, interval=60):
         """ Make the storm topology metrics request.
@@ -273,8 +1556,378 @@ class StormCheck(AgentCheck):
         params = {'window': interval}
         return self.get_request_json("/api/v1/topology/{}/metrics".format(topology_id),
                                      "Error retrieving Storm Topology Metrics for topology:{}".format(topology_id),
-                                     params=params)
+                                     params=params, affinity=topology_id)
+
+    def iter_topology_requests(self, topology_requests):
+        """ Fetch the topology info and metrics for each (topology_id, interval) pair.
+
+        Every topology info request is sent before the topology metrics requests, so when the run deadline cuts the
+        run short the topology stats are favoured over the per stream metrics. With the `event_loop` collection
+        engine all the requests are fetched up front on the event loop. Otherwise, when `max_concurrency` is greater
+        than 1 the requests are fetched by a bounded pool of worker threads, or else they are fetched lazily one after
+        another. Either way the results are yielded in the same order as `topology_requests` so processing stays
+        deterministic and on the calling thread.
+
+        With `stream_topology_metrics`, the topology metrics streams are never fetched ahead: a callable opening the
+        stream is yielded instead, so that the calling thread only holds the stream it is reading.
+
+        :param topology_requests: (topology_id, interval) pairs to fetch
+        :type topology_requests: list
+        :return: generator of (topology info response, topology metrics response) tuples, either being `SKIPPED`
+            when the run deadline passed before it was sent
+        :rtype: generator
+        """
+        info_fetches = [(self.get_topology_info, topology_id, interval) for topology_id, interval in topology_requests]
+        if self.stream_topology_metrics:
+            metrics_fetches = [(self.get_topology_metrics_stream, topology_id, interval)
+                               for topology_id, interval in topology_requests]
+            fetches = info_fetches
+        else:
+            metrics_fetches = [(self.get_topology_metrics, topology_id, interval)
+                               for topology_id, interval in topology_requests]
+            fetches = info_fetches + metrics_fetches
+
+        def _fetch(fetch):
+            func, topology_id, interval = fetch
+            if self.deadline_exceeded():
+                return SKIPPED
+            return func(topology_id=topology_id, interval=interval)
+
+        pool = None
+        if self.collection_engine == 'event_loop':
+            batch = []
+            for topology_id, interval in topology_requests:
+                batch.append((self.get_request_candidates("/api/v1/topology/{}".format(topology_id),
+                                                          {'window': interval}, affinity=topology_id),
+                              "Error retrieving Storm Topology Info for topology:{}".format(topology_id)))
+            for topology_id, interval in topology_requests:
+                batch.append((self.get_request_candidates("/api/v1/topology/{}/metrics".format(topology_id),
+                                                          {'window': interval}, affinity=topology_id),
+                              "Error retrieving Storm Topology Metrics for topology:{}".format(topology_id)))
+            results = iter(self.get_fetcher().fetch(batch, self.run_deadline, self.get_circuit_breakers(),
+                                                    self.get_server_health(), self.phase_timer))
+        elif self.max_concurrency > 1 and len(fetches) > 1:
+            pool = ThreadPool(min(self.max_concurrency, len(fetches)))
+            results = pool.imap(_fetch, fetches)
+        else:
+            results = (_fetch(fetch) for fetch in fetches)
+
+        try:
+            infos = [next(results) for _ in topology_requests]
+            for stats, fetch in zip(infos, metrics_fetches):
+                if self.stream_topology_metrics:
+                    yield stats, functools.partial(_fetch, fetch)
+                else:
+                    yield stats, next(results)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def get_sample_history(self):
+        """ Get the all-time sample history of the configured server.
+
+        :rtype: SampleHistory
+        """
+        history = self.sample_histories.get(self.nimbus_server)
+        if history is None or history.samples_per_interval != self.history_samples:
+            history = self.sample_histories[self.nimbus_server] = SampleHistory(self.history_samples)
+        return history
+
+    def get_topology_activity(self):
+        """ Get the topology activity tracker of the configured server.
+
+        :rtype: TopologyActivity
+        """
+        activity = self.topology_activities.get(self.nimbus_server)
+        if activity is None or (activity.backoff, activity.max_backoff) != (self.idle_backoff, self.max_idle_backoff):
+            activity = self.topology_activities[self.nimbus_server] = TopologyActivity(self.idle_backoff,
+                                                                                       self.max_idle_backoff)
+        return activity
+
+    def get_topology_filter(self):
+        """ Get the topology filter of the configured server.
+
+        :rtype: TopologyFilter
+        """
+        rules = (tuple(self.included_topologies), tuple(self.excluded_topology_rules), tuple(self.excluded_topologies))
+        topology_filter = self.topology_filters.get(self.nimbus_server)
+        if topology_filter is None or topology_filter.rules != rules:
+            topology_filter = self.topology_filters[self.nimbus_server] = TopologyFilter(*rules)
+        return topology_filter
+
+    def update_topology_activity(self, topology_id, topology_stats, timestamp):
+        """ Record the activity of a polled topology from its topology info response.
+
+        :param topology_id: Topology Id
+        :type topology_id: str
+        :param topology_stats: Topology info response
+        :type topology_stats: dict
+        """
+        if not self.idle_backoff:
+            return
+        status = _get_string(topology_stats, 'unknown', 'status').upper()
+        total = None
+        for entry in _get_list(topology_stats, 'topologyStats'):
+            if entry.get('window') == StormCheck.ALL_TIME_WINDOW:
+                total = _get_long(entry, 0, 'acked') + _get_long(entry, 0, 'emitted')
+                break
+        if self.get_topology_activity().update(topology_id, status, total, timestamp):
+            self.log.debug("Backing off polling of idle topology %s", topology_id)
+
+    def derive_entries(self, history, topology_id, entries, timestamp):
+        """ Derive the per interval values of cumulative stat maps, and record their current samples.
+
+        :param history: Sample history
+        :type history: SampleHistory
+        :param topology_id: Topology Id
+        :type topology_id: str
+        :param entries: (key, stat map, counters, averages) tuples
+        :type entries: list
+        :param timestamp: Time the stat maps were fetched
+        :type timestamp: float
+        :return: interval mapped to the derived values of each entry, None where no sample is old enough
+        :rtype: dict
+        """
+        derived = dict((interval, []) for interval in self.intervals)
+        for key, stat_map, counters, averages in entries:
+            sample = _counter_sample(stat_map, counters, averages)
+            for interval in self.intervals:
+                previous_timestamp, previous = history.find(topology_id, key, interval, timestamp)
+                if previous is None:
+                    derived[interval].append(None)
+                else:
+                    derived[interval].append(_derive_window(sample, previous, timestamp - previous_timestamp,
+                                                            interval, counters, averages))
+            history.add(topology_id, key, timestamp, sample, self.intervals)
+        return derived
+
+    def derive_topology_stats(self, history, topology_id, topology_stats, timestamp):
+        """ Derive per interval Topology Stats Responses from an all-time Topology Stats Response.
+
+        :return: interval mapped to the derived response, for the intervals with enough history
+        :rtype: dict
+        """
+        if len(topology_stats) == 0:
+            return {}
+        # Storm lists the 600, 10800 and 86400 windows before the all-time one
+        all_time = {}
+        for entry in _get_list(topology_stats, 'topologyStats'):
+            if isinstance(entry, dict) and entry.get('window') == StormCheck.ALL_TIME_WINDOW:
+                all_time = entry
+                break
+        bolts = _get_list(topology_stats, 'bolts')
+        spouts = _get_list(topology_stats, 'spouts')
+
+        entries = [(('topology',), all_time, TOPOLOGY_COUNTERS, TOPOLOGY_AVERAGES)]
+        entries.extend((('bolt', self.extract_bolt_id(b)), b, BOLT_COUNTERS, BOLT_AVERAGES) for b in bolts)
+        entries.extend((('spout', self.extract_spout_id(sp)), sp, SPOUT_COUNTERS, SPOUT_AVERAGES) for sp in spouts)
+        derived = self.derive_entries(history, topology_id, entries, timestamp)
+
+        windows = {}
+        for interval, values in derived.items():
+            if values[0] is None:
+                continue
+            window_stats = dict(topology_stats)
+            window_stats['topologyStats'] = [dict(all_time, window=str(interval), **values[0])]
+            window_stats['bolts'] = []
+            for b, value in zip(bolts, values[1:1 + len(bolts)]):
+                if value is not None:
+                    value['capacity'] = value['executed'] * value['executeLatency'] / (interval * 1000.0)
+                    window_stats['bolts'].append(dict(b, **value))
+            window_stats['spouts'] = [dict(sp, **value) for sp, value in zip(spouts, values[1 + len(bolts):])
+                                      if value is not None]
+            windows[interval] = window_stats
+        return windows
+
+    def derive_topology_metrics(self, history, topology_id, topology_metrics, timestamp):
+        """ Derive per interval Topology Metrics Stats Responses from an all-time Topology Metrics Stats Response.
+
+        :return: interval mapped to the derived response, for the intervals with enough history
+        :rtype: dict
+        """
+        if len(topology_metrics) == 0:
+            return {}
+        entries = []
+        for k in TOPOLOGY_METRICS_COMPONENT_TYPES:
+            for s in _get_list(topology_metrics, k):
+                k_name = self.extract_component_id(s)
+                streams = {}
+                for sc in TOPOLOGY_METRICS_STREAM_STATS:
+                    for ks in _get_list(s, sc):
+                        stream_key = (k, k_name, self.extract_stream_id(ks), ks.get('component_id'))
+                        if stream_key not in streams:
+                            streams[stream_key] = {}
+                            entries.append((stream_key, streams[stream_key], STREAM_COUNTERS, STREAM_AVERAGES))
+                        streams[stream_key][sc] = ks.get('value')
+        derived = self.derive_entries(history, topology_id, entries, timestamp)
+
+        windows = {}
+        for interval, values in derived.items():
+            stream_values = dict((entry[0], value) for entry, value in zip(entries, values) if value is not None)
+            if not stream_values:
+                continue
+            window_metrics = dict(topology_metrics, window=str(interval))
+            for k in TOPOLOGY_METRICS_COMPONENT_TYPES:
+                window_metrics[k] = []
+                for s in _get_list(topology_metrics, k):
+                    k_name = self.extract_component_id(s)
+                    window_component = dict(s)
+                    for sc in TOPOLOGY_METRICS_STREAM_STATS:
+                        window_component[sc] = []
+                        for ks in _get_list(s, sc):
+                            value = stream_values.get((k, k_name, self.extract_stream_id(ks), ks.get('component_id')))
+                            if value is not None:
+                                window_component[sc].append(dict(ks, value=value[sc]))
+                    window_metrics[k].append(window_component)
+            windows[interval] = window_metrics
+        return windows
+
+    @_timed('process.topology_all_time')
+    def process_topology_all_time(self, topology_id, topology_name, topology_stats, topology_metrics, timestamp):
+        """ Process all-time Topology Stats and Topology Metrics Stats Responses for every configured interval.
+
+        Cumulative counters are turned into per interval values using the samples recorded on previous runs, the
+        intervals without a sample old enough are skipped until the history has warmed up.
+
+        :param topology_id: Topology Id
+        :type topology_id: str
+        :param topology_name: Topology Name
+        :type topology_name: str
+        :param topology_stats: All-time topology stats response
+        :type topology_stats: dict
+        :param topology_metrics: All-time topology metrics response
+        :type topology_metrics: dict
+        :param timestamp: Time the responses were fetched
+        :type timestamp: float
+        """
+        history = self.get_sample_history()
+        window_stats = self.derive_topology_stats(history, topology_id, topology_stats, timestamp)
+        window_metrics = self.derive_topology_metrics(history, topology_id, topology_metrics, timestamp)
+        for interval in self.intervals:
+            if interval in window_stats:
+                self.process_topology_stats(topology_stats=window_stats[interval], interval=interval)
+            if interval in window_metrics:
+                self.process_topology_metrics(topology_name, window_metrics[interval], interval=interval)
+
+    def get_metric_name(self, entity, interval, field):
+        """ Get the interned metric name of a field reported for an interval.
+
+        :param entity: Metric entity, e.g. `bolt` or `topologyStats.metrics.spouts`
+        :type entity: str
+        :param interval: Interval in seconds
+        :type interval: int
+        :param field: Field reported
+        :type field: str
+        :return: `storm.<entity>.last_<interval>.<field>`
+        :rtype: str
+        """
+        key = (entity, interval, field)
+        try:
+            return self.metric_names[key]
+        except KeyError:
+            metric_name = intern('storm.{}.last_{}.{}'.format(entity, interval, field))
+            self.metric_names[key] = metric_name
+            return metric_name
+
+    def get_interval_plan(self, entity, interval, plan):
+        """ Get a compiled extraction plan with its metric names resolved for an interval.
 
+        :param entity: Metric entity of the plan
+        :type entity: str
+        :param interval: Interval in seconds
+        :type interval: int
+        :param plan: (field, extractor) tuples
+        :type plan: tuple
+        :return: (metric name, extractor) tuples
+        :rtype: tuple
+        """
+        key = (entity, interval)
+        interval_plan = self.interval_plans.get(key)
+        if interval_plan is None:
+            interval_plan = tuple((self.get_metric_name(entity, interval, field), extract) for field, extract in plan)
+            self.interval_plans[key] = interval_plan
+        return interval_plan
+
+    def get_interval_plans(self, entity, interval, plan, static_fields):
+        """ Get a compiled extraction plan for an interval, split into its dynamic and static fields.
+
+        The static fields are only split out when `static_attributes_heartbeat` is set, otherwise every field is
+        dynamic.
+
+        :param static_fields: Static fields of the plan
+        :type static_fields: frozenset
+        :return: (dynamic (metric name, extractor) tuples, static (metric name, extractor) tuples)
+        :rtype: tuple
+        """
+        key = (entity, interval, bool(self.static_attributes_heartbeat))
+        interval_plans = self.interval_plans.get(key)
+        if interval_plans is None:
+            if self.static_attributes_heartbeat:
+                interval_plans = (
+                    tuple((self.get_metric_name(entity, interval, field), extract) for field, extract in plan
+                          if field not in static_fields),
+                    tuple((self.get_metric_name(entity, interval, field), extract) for field, extract in plan
+                          if field in static_fields))
+            else:
+                interval_plans = (self.get_interval_plan(entity, interval, plan), ())
+            self.interval_plans[key] = interval_plans
+        return interval_plans
+
+    def get_static_series_cache(self):
+        """ Get the static attribute series cache of the configured server.
+
+        :rtype: StaticSeriesCache
+        """
+        cache = self.static_series_caches.get(self.nimbus_server)
+        if cache is None or (cache.max_series, cache.heartbeat) != (self.static_attributes_cache_size,
+                                                                    self.static_attributes_heartbeat):
+            cache = self.static_series_caches[self.nimbus_server] = StaticSeriesCache(
+                self.static_attributes_cache_size, self.static_attributes_heartbeat)
+        return cache
+
+    def report_static_histograms(self, topology, plan, stat_map, tags, timestamp):
+        """ Report the static attributes of a stat map that changed, or are due for their heartbeat.
+
+        :param topology: Topology name
+        :type topology: str
+        :param plan: Static (metric name, extractor) tuples
+        :type plan: tuple
+        """
+        if not plan:
+            return
+        cache = self.get_static_series_cache()
+        for metric_name, extract in plan:
+            value = extract(stat_map)
+            if cache.should_emit(topology, metric_name, tags, value, timestamp):
+                self.report_histogram(metric_name, value, tags=tags, additional_tags=self.additional_tags)
+
+    def report_static_histogram(self, topology, metric_name, value, tags, timestamp):
+        """ Report a static attribute when it changed or is due for its heartbeat, or always without a heartbeat.
+
+        :param topology: Topology name
+        :type topology: str
+        """
+        if not self.static_attributes_heartbeat or self.get_static_series_cache().should_emit(
+                topology, metric_name, tags, value, timestamp):
+            self.report_histogram(metric_name, value, tags=tags, additional_tags=self.additional_tags)
+
+    def get_topology_metrics_stream(self, topology_id, interval=60):
+        """ Make the storm topology metrics request without reading the response body.
+
+        :param topology_id: Topology Id
+        :type topology_id: str
+        :param interval: Interval in seconds
+        :type interval: int|long
+        :return: Topology Metrics Stats Response, or None on error
+        :rtype: requests.Response
+        """
+        params = {'window': interval}
+        return self.get_request_stream("/api/v1/topology/{}/metrics".format(topology_id),
+                                       "Error retrieving Storm Topology Metrics for topology:{}".format(topology_id),
+                                       params=params, affinity=topology_id)
+
+    @_timed('process.cluster_stats')
     def process_cluster_stats(self, environment, cluster_stats):
         """ Process Cluster Stats Response
 
@@ -293,6 +1946,7 @@ class StormCheck(AgentCheck):
             tags = ['stormClusterEnvironment:{}'.format(environment), storm_version]
             if storm_version not in self.additional_tags:
                 self.additional_tags.append(storm_version)
+                self.tag_cache.clear()
 
             # Longs
             for metric_name in ['executorsTotal', 'slotsFree', 'slotsTotal', 'slotsUsed', 'supervisors', 'tasksTotal',
@@ -306,6 +1960,7 @@ class StormCheck(AgentCheck):
                                   _get_float(cluster_stats, 0.0, metric_name),
                                   tags=tags, additional_tags=self.additional_tags)
 
+    @_timed('process.nimbus_stats')
     def process_nimbus_stats(self, environment, nimbus_stats):
         """ Process Nimbus Stats Response
 
@@ -351,6 +2006,7 @@ class StormCheck(AgentCheck):
             self.report_gauge('storm.nimbus.numOffline', numOffline,
                               tags=tags, additional_tags=self.additional_tags)
 
+    @_timed('process.supervisor_stats')
     def process_supervisor_stats(self, supervisor_stats):
         """ Process Supervisor Stats Response
 
@@ -373,6 +2029,7 @@ class StormCheck(AgentCheck):
                     self.report_gauge('storm.supervisor.{}'.format(metric_name), _get_float(ss, 0, metric_name),
                                       tags=tags, additional_tags=self.additional_tags)
 
+    @_timed('process.topology_stats')
     def process_topology_stats(self, topology_stats, interval):
         """ Process Topology Stats Response
 
@@ -381,130 +2038,111 @@ class StormCheck(AgentCheck):
         :param interval: Interval of metrics reported
         :type interval: int
         """
-        def _mts(metric_name):
-            return 'storm.topologyStats.last_{}.{}'.format(interval, metric_name)
-
         if len(topology_stats) > 0:
-            name = _get_string(topology_stats, 'unknown', 'name').replace('.', '_').replace(':', '_')
-            debug_mode = _get_bool(topology_stats, False, 'debug')
+            name = self.extract_name(topology_stats).replace('.', '_').replace(':', '_')
             tags = ['topology:{}'.format(name)]
-
-            self.report_histogram(_mts('acked'), _get_long(topology_stats, 0, 'topologyStats', 0, 'acked'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('assignedCpu'), _get_float(topology_stats, 0.0, 'assignedCpu'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('assignedMemOffHeap'), _get_long(topology_stats, 0, 'assignedMemOffHeap'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('assignedMemOnHeap'), _get_long(topology_stats, 0, 'assignedMemOnHeap'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('assignedTotalMem'), _get_long(topology_stats, 0, 'assignedTotalMem'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('completeLatency'),
-                                  _get_float(topology_stats, 0.0, 'topologyStats', 0, 'completeLatency'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('debug'), 1 if debug_mode else 0,
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('emitted'), _get_long(topology_stats, 0, 'topologyStats', 0, 'emitted'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('executorsTotal'), _get_long(topology_stats, 0, 'executorsTotal'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('failed'), _get_long(topology_stats, 0, 'topologyStats', 0, 'failed'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('msgTimeout'), _get_long(topology_stats, 0, 'msgTimeout'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('numBolts'), _get_length(topology_stats, 0, 'bolts'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('numSpouts'), _get_length(topology_stats, 0, 'spouts'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('replicationCount'), _get_long(topology_stats, 0, 'replicationCount'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('requestedCpu'), _get_float(topology_stats, 0.0, 'requestedCpu'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('requestedMemOffHeap'), _get_float(topology_stats, 0.0, 'requestedMemOffHeap'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('requestedMemOnHeap'), _get_float(topology_stats, 0.0, 'requestedMemOnHeap'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('samplingPct'), _get_float(topology_stats, 0.0, 'samplingPct'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('tasksTotal'), _get_long(topology_stats, 0, 'tasksTotal'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('transferred'), _get_long(topology_stats, 0, 'topologyStats', 0, 'transferred'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('uptimeSeconds'), _get_long(topology_stats, 0, 'uptimeSeconds'),
-                                  tags=tags, additional_tags=self.additional_tags)
-            self.report_histogram(_mts('workersTotal'), _get_long(topology_stats, 0, 'workersTotal'),
-                                  tags=tags, additional_tags=self.additional_tags)
+            # Static attributes are only reported on change or heartbeat when static_attributes_heartbeat is set
+            timestamp = time.time()
+
+            topology_stats_plan, static_plan = self.get_interval_plans('topologyStats', interval,
+                                                                       self.topology_stats_plan,
+                                                                       TOPOLOGY_STATIC_FIELDS)
+            for metric_name, extract in topology_stats_plan:
+                self.report_histogram(metric_name, extract(topology_stats),
+                                      tags=tags, additional_tags=self.additional_tags)
+            self.report_static_histograms(name, static_plan, topology_stats, tags, timestamp)
 
             # Bolt Stats
-            def _mb(metric_name):
-                return 'storm.bolt.last_{}.{}'.format(interval, metric_name)
-
+            bolt_stats_plan, static_plan = self.get_interval_plans('bolt', interval, self.bolt_stats_plan,
+                                                                   BOLT_STATIC_FIELDS)
             for b in _get_list(topology_stats, 'bolts'):
-                bolt_name = _get_string(b, 'unknown', 'boltId').replace('.', '_').replace(':', '_')
+                bolt_name = self.extract_bolt_id(b).replace('.', '_').replace(':', '_')
                 bolt_tags = tags + ['bolt:{}'.format(bolt_name)]
 
-                # Longs:
-                for metric_name in ['acked', 'emitted', 'executed', 'executors', 'failed',
-                                    'requestedMemOffHeap', 'requestedMemOnHeap', 'tasks', 'transferred']:
-                    self.report_histogram(_mb(metric_name), _get_long(b, 0, metric_name),
+                for metric_name, extract in bolt_stats_plan:
+                    self.report_histogram(metric_name, extract(b),
                                           tags=bolt_tags, additional_tags=self.additional_tags)
-                # Floats
-                for metric_name in ['capacity', 'executeLatency', 'processLatency', 'requestedCpu']:
-                    self.report_histogram(_mb(metric_name), _get_float(b, 0, metric_name),
-                                          tags=bolt_tags, additional_tags=self.additional_tags)
-
-                self.report_histogram(_mb('errorLapsedSecs'), _get_float(b, 1E10, 'errorLapsedSecs'),
-                                      tags=bolt_tags, additional_tags=self.additional_tags)
+                self.report_static_histograms(name, static_plan, b, bolt_tags, timestamp)
 
             # Process Spout stats
-            def _ms(metric_name):
-                return 'storm.spout.last_{}.{}'.format(interval, metric_name)
-
+            spout_stats_plan, static_plan = self.get_interval_plans('spout', interval, self.spout_stats_plan,
+                                                                    SPOUT_STATIC_FIELDS)
             for s in _get_list(topology_stats, 'spouts'):
-                spout_name = _get_string(s, 'unknown', 'spoutId').replace('.', '_').replace(':', '_')
+                spout_name = self.extract_spout_id(s).replace('.', '_').replace(':', '_')
                 spout_tags = tags + ['spout:{}'.format(spout_name)]
 
-                # Longs:
-                for metric_name in ['acked', 'emitted', 'executors', 'failed', 'requestedMemOffHeap',
-                                    'requestedMemOnHeap', 'tasks', 'transferred']:
-                    self.report_histogram(_ms(metric_name), _get_long(s, 0, metric_name),
+                for metric_name, extract in spout_stats_plan:
+                    self.report_histogram(metric_name, extract(s),
                                           tags=spout_tags, additional_tags=self.additional_tags)
-                # Floats
-                for metric_name in ['completeLatency', 'requestedCpu']:
-                    self.report_histogram(_ms(metric_name), _get_float(s, 0, metric_name),
-                                          tags=spout_tags, additional_tags=self.additional_tags)
-
-                self.report_histogram(_ms('errorLapsedSecs'), _get_float(s, 1E10, 'errorLapsedSecs'),
-                                      tags=spout_tags, additional_tags=self.additional_tags)
+                self.report_static_histograms(name, static_plan, s, spout_tags, timestamp)
 
             # Process worker stats
-            def _mw(metric_name):
-                return 'storm.worker.last_{}.{}'.format(interval, metric_name)
-
+            worker_stats_plan, static_plan = self.get_interval_plans('worker', interval, self.worker_stats_plan,
+                                                                     WORKER_STATIC_FIELDS)
+            component_num_tasks = self.get_metric_name('worker', interval, 'componentNumTasks')
+            per_worker_tasks = 'worker' in self.component_num_tasks
+            per_component_tasks = 'component' in self.component_num_tasks
+            per_supervisor_tasks = 'supervisor' in self.component_num_tasks
+            # (supervisor id or None for the whole topology, component) -> [sum, max] of the worker task counts
+            component_tasks = {}
             for w in _get_list(topology_stats, 'workers'):
-                worker_stat = {}
-                host = _get_string(w, 'unknown', 'host')
-                port = _get_long(w, 0, 'port')
-                supervisor_id = _get_string(w, 'unknown', 'supervisorId')
+                host = self.extract_worker_host(w)
+                port = self.extract_worker_port(w)
+                supervisor_id = self.extract_supervisor_id(w)
                 worker_tags = tags + ['worker:{}:{}'.format(host, port), 'supervisor:{}'.format(supervisor_id)]
 
-                self.report_histogram(_mw('assignedCpu'), _get_float(w, 0, 'assignedCpu'),
-                                      tags=worker_tags, additional_tags=self.additional_tags)
-                self.report_histogram(_mw('assignedMemOffHeap'), _get_long(w, 0, 'assignedMemOffHeap'),
-                                      tags=worker_tags, additional_tags=self.additional_tags)
-                self.report_histogram(_mw('assignedMemOnHeap'), _get_long(w, 0, 'assignedMemOnHeap'),
-                                      tags=worker_tags, additional_tags=self.additional_tags)
-                self.report_histogram(_mw('executorsTotal'), _get_long(w, 0, 'executorsTotal'),
-                                      tags=worker_tags, additional_tags=self.additional_tags)
-                self.report_histogram(_mw('uptimeSeconds'), _get_long(w, 0, 'uptimeSeconds'),
-                                      tags=worker_tags, additional_tags=self.additional_tags)
-
-                worker_stat[_mw('componentNumTasks')] = []
+                for metric_name, extract in worker_stats_plan:
+                    self.report_histogram(metric_name, extract(w),
+                                          tags=worker_tags, additional_tags=self.additional_tags)
+                self.report_static_histograms(name, static_plan, w, worker_tags, timestamp)
+
                 for cn, cv in _get_dict(w, 'componentNumTasks').items():
-                    worker_component_tags = worker_tags + ['component:{}'.format(cn)]
-                    self.report_histogram(_mw('componentNumTasks'), _long(cv or 0),
-                                          tags=worker_component_tags, additional_tags=self.additional_tags)
+                    value = _long(cv or 0)
+                    if per_worker_tasks:
+                        self.report_static_histogram(name, component_num_tasks, value,
+                                                     worker_tags + ['component:{}'.format(cn)], timestamp)
+                    for key in ((None, cn) if per_component_tasks else None,
+                                (supervisor_id, cn) if per_supervisor_tasks else None):
+                        if key is None:
+                            continue
+                        aggregate = component_tasks.get(key)
+                        if aggregate is None:
+                            component_tasks[key] = [value, value]
+                        else:
+                            aggregate[0] += value
+                            if value > aggregate[1]:
+                                aggregate[1] = value
+
+            if component_tasks:
+                self.report_component_tasks(name, tags, interval, component_tasks, timestamp)
+
+    def report_component_tasks(self, topology_name, tags, interval, component_tasks, timestamp):
+        """ Report the task counts of the workers rolled up per component, and per supervisor and component.
+
+        :param topology_name: Topology name
+        :type topology_name: str
+        :param tags: Topology tags
+        :type tags: list
+        :param interval: Interval in seconds for reported metrics
+        :type interval: int
+        :param component_tasks: (supervisor id or None, component) -> [sum, max] of the worker task counts
+        :type component_tasks: dict
+        """
+        component_sum = self.get_metric_name('component', interval, 'numTasks')
+        component_max = self.get_metric_name('component', interval, 'maxWorkerNumTasks')
+        supervisor_sum = self.get_metric_name('supervisor', interval, 'componentNumTasks')
+        supervisor_max = self.get_metric_name('supervisor', interval, 'componentMaxWorkerNumTasks')
+        for (supervisor_id, component), (total, maximum) in sorted(component_tasks.items()):
+            if supervisor_id is None:
+                component_tags = tags + ['component:{}'.format(component)]
+                self.report_static_histogram(topology_name, component_sum, total, component_tags, timestamp)
+                self.report_static_histogram(topology_name, component_max, maximum, component_tags, timestamp)
+            else:
+                component_tags = tags + ['supervisor:{}'.format(supervisor_id), 'component:{}'.format(component)]
+                self.report_static_histogram(topology_name, supervisor_sum, total, component_tags, timestamp)
+                self.report_static_histogram(topology_name, supervisor_max, maximum, component_tags, timestamp)
 
+    @_timed('process.topology_metrics')
     def process_topology_metrics(self, topology_name, topology_stats, interval):
         """ Process Topology Metrics Stats Response
 
@@ -516,32 +2154,238 @@ class StormCheck(AgentCheck):
         :type interval: int
         """
         if len(topology_stats) > 0:
-            name = topology_name.replace('.', '_').replace(':', '_')
-            tags = ['topology:{}'.format(name)]
-            r = {'bolts': [], 'spouts': []}
-            for k in r.keys():
-                for s in _get_list(topology_stats, k):
-                    k_name = _get_string(s, 'unknown', 'id').replace('.', '_').replace(':', '_')
-                    k_tags = tags + ['{}:{}'.format(k, k_name)]
-                    for sc in ['acked', 'complete_ms_avg', 'emitted', 'executed', 'executed_ms_avg', 'failed',
-                               'process_ms_avg', 'transferred']:
-                        for ks in _get_list(s, sc):
-                            stream_id = _get_string(ks, 'unknown', 'stream_id')
-                            ks_tags = k_tags + ['stream:{}'.format(stream_id)]
-                            component_id = ks.get('component_id')
-                            if component_id:
-                                ks_tags.append('component:{}'.format(component_id))
-
-                            component_value = _get_float(ks, 0.0, 'value')
-                            if component_value is not None:
-                                # will make stats like these two examples
-                                # storm.topologyStats.metrics.spouts.last_60.emitted
-                                # storm.topologyStatus.metrics.bolts.last_60.acked
-                                self.report_histogram(
-                                    'storm.topologyStats.metrics.{}.last_{}.{}'.format(k, interval, sc),
-                                    component_value,
-                                    tags=ks_tags, additional_tags=self.additional_tags
-                                )
+            self.process_topology_metric_streams(topology_name, self.iter_topology_metric_streams(topology_stats),
+                                                 interval)
+
+    @_timed('process.topology_metrics_stream')
+    def process_topology_metrics_stream(self, topology_name, resp, interval):
+        """ Process a streamed Topology Metrics Stats Response while its body is still arriving.
+
+        :param topology_name: Topology Name
+        :type topology_name: str
+        :param resp: Topology metrics response returned by `get_topology_metrics_stream`
+        :type resp: requests.Response
+        :param interval: Interval in seconds for reported metrics
+        :type interval: int
+        """
+        if resp is None:
+            return
+        try:
+            streams = self.iter_topology_metric_streams_from_file(
+                resp.raw, "[url:{}] Error retrieving Storm Topology Metrics for topology:{}".format(resp.url,
+                                                                                                   topology_name))
+            self.process_topology_metric_streams(topology_name, streams, interval)
+        finally:
+            resp.close()
+
+    def iter_topology_metric_streams(self, topology_stats):
+        """ Iterate over the per stream values of a Topology Metrics Stats Response.
+
+        :param topology_stats: Topology metrics response
+        :type topology_stats: dict
+        :return: generator of (component type, component id, stat, stream value) tuples
+        :rtype: generator
+        """
+        for k in TOPOLOGY_METRICS_COMPONENT_TYPES:
+            for s in _get_list(topology_stats, k):
+                k_name = self.extract_component_id(s)
+                for sc in TOPOLOGY_METRICS_STREAM_STATS:
+                    for ks in _get_list(s, sc):
+                        yield k, k_name, sc, ks
+
+    def iter_topology_metric_streams_from_file(self, fileobj, error_message):
+        """ Incrementally parse a Topology Metrics Stats Response, yielding each stream value as soon as it is parsed.
+
+        Only the stream value being parsed (plus, until the component id is known, the values of the current
+        component) is held in memory, never the full document.
+
+        :param fileobj: File like object with the JSON response body
+        :param error_message: Message logged when the response is an error or cannot be parsed
+        :type error_message: str
+        :return: generator of (component type, component id, stat, stream value) tuples
+        :rtype: generator
+        """
+        component_prefixes = dict(('{}.item'.format(k), k) for k in TOPOLOGY_METRICS_COMPONENT_TYPES)
+        id_prefixes = dict(('{}.item.id'.format(k), k) for k in TOPOLOGY_METRICS_COMPONENT_TYPES)
+        stream_prefixes = dict(('{}.item.{}.item'.format(k, sc), sc)
+                               for k in TOPOLOGY_METRICS_COMPONENT_TYPES for sc in TOPOLOGY_METRICS_STREAM_STATS)
+
+        k = k_name = None
+        pending = []
+        stream = stream_key = None
+        try:
+            for prefix, event, value in ijson.parse(fileobj):
+                if stream is not None:
+                    if event == 'map_key':
+                        stream_key = value
+                    elif event == 'end_map':
+                        if k_name is None:
+                            pending.append((sc, stream))
+                        else:
+                            yield k, k_name, sc, stream
+                        stream = None
+                    else:
+                        stream[stream_key] = value
+                elif event == 'start_map':
+                    if prefix in stream_prefixes:
+                        sc = stream_prefixes[prefix]
+                        stream = {}
+                    elif prefix in component_prefixes:
+                        k = component_prefixes[prefix]
+                        k_name = None
+                elif prefix in id_prefixes:
+                    k_name = self.extract_component_id({'id': value})
+                    for sc, pending_stream in pending:
+                        yield k, k_name, sc, pending_stream
+                    pending = []
+                elif event == 'end_map' and prefix in component_prefixes:
+                    # component without an id
+                    for sc, pending_stream in pending:
+                        yield k, 'unknown', sc, pending_stream
+                    pending = []
+                elif event == 'map_key' and prefix == '' and value == 'error':
+                    self.log.warning(error_message)
+                    return
+        except Exception as e:
+            self.log.warning(error_message)
+            self.log.exception(e)
+
+    def process_topology_metric_streams(self, topology_name, streams, interval):
+        """ Process the per stream values of a Topology Metrics Stats Response
+
+        :param topology_name: Topology Name
+        :type topology_name: str
+        :param streams: (component type, component id, stat, stream value) tuples
+        :type streams: iterable
+        :param interval: Interval in seconds for reported metrics
+        :type interval: int
+        """
+        name = topology_name.replace('.', '_').replace(':', '_')
+        tags = ['topology:{}'.format(name)]
+        if self.max_stream_series:
+            streams = self.limit_topology_metric_streams(tags, streams, interval)
+        component = k_tags = None
+        for k, k_name, sc, ks in streams:
+            if component != (k, k_name):
+                component = (k, k_name)
+                k_tags = tags + ['{}:{}'.format(k, k_name.replace('.', '_').replace(':', '_'))]
+
+            stream_id = self.extract_stream_id(ks)
+            ks_tags = k_tags + ['stream:{}'.format(stream_id)]
+            component_id = ks.get('component_id')
+            if component_id:
+                ks_tags.append('component:{}'.format(component_id))
+
+            component_value = self.extract_stream_value(ks)
+            if component_value is not None:
+                # will make stats like these two examples
+                # storm.topologyStats.metrics.spouts.last_60.emitted
+                # storm.topologyStatus.metrics.bolts.last_60.acked
+                self.report_histogram(
+                    self.get_metric_name('topologyStats.metrics.{}'.format(k), interval, sc),
+                    component_value,
+                    tags=ks_tags, additional_tags=self.additional_tags
+                )
+
+    def limit_topology_metric_streams(self, tags, streams, interval):
+        """ Keep the `max_stream_series` busiest stream series of a topology, and roll the others up into an
+        `other` series per component type.
+
+        A series is the (component type, component id, stream, component) tag set of a stream value, and its traffic
+        the sum of its counters. The streams are buffered per series, then the busiest are selected with a bounded
+        heap in O(n log k). The rolled up series sums the counters and weights the averages by their counter.
+
+        :param tags: Topology tags
+        :type tags: list
+        :param streams: (component type, component id, stat, stream value) tuples
+        :type streams: iterable
+        :param interval: Interval in seconds for reported metrics
+        :type interval: int
+        :return: generator of (component type, component id, stat, stream value) tuples
+        :rtype: generator
+        """
+        series = {}
+        order = []
+        for stream in streams:
+            k, k_name, sc, ks = stream
+            key = (k, k_name, self.extract_stream_id(ks), ks.get('component_id'))
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = [0.0, []]
+                order.append(key)
+            if sc in STREAM_COUNTERS:
+                entry[0] += self.extract_stream_value(ks) or 0.0
+            entry[1].append(stream)
+
+        dropped = max(len(order) - self.max_stream_series, 0)
+        kept = set(heapq.nlargest(self.max_stream_series, order, key=lambda key: series[key][0])) if dropped else None
+        # component type -> stat -> [counter sum or weighted average sum, weight sum]
+        rollups = {}
+        for key in order:
+            if kept is None or key in kept:
+                for stream in series[key][1]:
+                    yield stream
+                continue
+            values = dict((sc, self.extract_stream_value(ks)) for _, _, sc, ks in series[key][1])
+            rollup = rollups.setdefault(key[0], {})
+            for sc, value in values.items():
+                if value is None:
+                    continue
+                total = rollup.setdefault(sc, [0.0, 0.0])
+                if sc in STREAM_AVERAGES:
+                    weight = values.get(STREAM_AVERAGES[sc]) or 0.0
+                    total[0] += value * weight
+                    total[1] += weight
+                else:
+                    total[0] += value
+
+        for k in TOPOLOGY_METRICS_COMPONENT_TYPES:
+            for sc, (total, weight) in sorted(rollups.get(k, {}).items()):
+                if sc in STREAM_AVERAGES:
+                    if not weight:
+                        continue
+                    total /= weight
+                yield k, StormCheck.OTHER_SERIES, sc, {'stream_id': StormCheck.OTHER_SERIES, 'value': total}
+
+        self.report_gauge('storm.check.series.dropped', dropped, tags=tags + ['interval:{}'.format(interval)],
+                          additional_tags=self.additional_tags)
+
+    def report_connection_stats(self):
+        """ Report the connection reuse counters of the configured server's session. """
+        opened, sent = self.get_connection_stats()
+        self.report_gauge('storm.check.http.connections', opened, tags=[], additional_tags=self.additional_tags)
+        self.report_gauge('storm.check.http.requests', sent, tags=[], additional_tags=self.additional_tags)
+        self.report_gauge('storm.check.http.reused', max(sent - opened, 0), tags=[],
+                          additional_tags=self.additional_tags)
+
+    def report_summary_cache_stats(self):
+        """ Report the summary cache hits and misses of the run. """
+        for summary_name, (hits, misses) in sorted(self.summary_cache_stats.items()):
+            tags = ['summary:{}'.format(summary_name)]
+            self.report_gauge('storm.check.cache.hits', hits, tags=tags, additional_tags=self.additional_tags)
+            self.report_gauge('storm.check.cache.misses', misses, tags=tags, additional_tags=self.additional_tags)
+
+    def get_all_tags(self, tags, additional_tags):
+        """ Get the full tag set of a metric: its tags, the environment tags and the additional tags.
+
+        Tag sets built from the instance's additional tags are cached for the run, keyed by the topology/component tags.
+
+        :param tags: Metric tags
+        :type tags: list
+        :param additional_tags: Additional tags
+        :type additional_tags: list
+        :return: Full tag set
+        :rtype: frozenset
+        """
+        if additional_tags is not self.additional_tags:
+            return frozenset(tags + self.environment_tags + additional_tags)
+
+        key = tuple(tags)
+        all_tags = self.tag_cache.get(key)
+        if all_tags is None:
+            all_tags = frozenset(tags + self.environment_tags + additional_tags)
+            self.tag_cache[key] = all_tags
+        return all_tags
 
     def report_gauge(self, metric, value, tags, additional_tags=list()):
         """ Report the Gauge Metric.
@@ -552,14 +2396,13 @@ class StormCheck(AgentCheck):
         :param additional_tags:
         :return:
         """
-        all_tags = tags + [
-            'env:{}'.format(self.environment_name),
-            'environment:{}'.format(self.environment_name)] + additional_tags
-        self.gauge(
-            metric=metric,
-            value=value,
-            tags=set(all_tags)
-        )
+        timer = self.phase_timer
+        if timer is None:
+            self.gauge(metric=metric, value=value, tags=self.get_all_tags(tags, additional_tags))
+            return
+        start = time.time()
+        self.gauge(metric=metric, value=value, tags=self.get_all_tags(tags, additional_tags))
+        timer.add('report', time.time() - start)
 
     def report_histogram(self, metric, value, tags, additional_tags=list()):
         """ Report the Histogram Metric.
@@ -570,14 +2413,13 @@ class StormCheck(AgentCheck):
         :param additional_tags:
         :return:
         """
-        all_tags = tags + [
-            'env:{}'.format(self.environment_name),
-            'environment:{}'.format(self.environment_name)] + additional_tags
-        self.histogram(
-            metric=metric,
-            value=value,
-            tags=set(all_tags)
-        )
+        timer = self.phase_timer
+        if timer is None:
+            self.histogram(metric=metric, value=value, tags=self.get_all_tags(tags, additional_tags))
+            return
+        start = time.time()
+        self.histogram(metric=metric, value=value, tags=self.get_all_tags(tags, additional_tags))
+        timer.add('report', time.time() - start)
 
     def update_from_config(self, instance):
         """ Update Configuration tunables from instance configuration.
@@ -586,13 +2428,31 @@ class StormCheck(AgentCheck):
         :return: None
         """
 
-        self.nimbus_server = instance.get('server', self.init_config.get('server', StormCheck.DEFAULT_STORM_SERVER))
+        self.servers = instance.get('servers') or [
+            instance.get('server', self.init_config.get('server', StormCheck.DEFAULT_STORM_SERVER))]
+        if not isinstance(self.servers, list):
+            raise AssertionError("Expected servers to be a list of Storm UI urls")
+        # Per server state is kept under the first server
+        self.nimbus_server = self.servers[0]
+        self.spread_topologies = _bool(instance.get('spread_topologies',
+                                                    self.init_config.get('spread_topologies', False)))
         self.environment_name = instance.get('environment',
                                              self.init_config.get('environment', StormCheck.DEFAULT_STORM_ENVIRONMENT))
+        self.environment_tags = ['env:{}'.format(self.environment_name),
+                                 'environment:{}'.format(self.environment_name)]
+        self.tag_cache = {}
         self.additional_tags = []
         self.additional_tags.extend(instance.get('tags', []))
         self.excluded_topologies = []
         self.excluded_topologies.extend(instance.get('excluded', []))
+        self.included_topologies = instance.get('include_topologies', self.init_config.get('include_topologies', []))
+        self.excluded_topology_rules = instance.get('exclude_topologies',
+                                                    self.init_config.get('exclude_topologies', []))
+        if not isinstance(self.included_topologies, (list, tuple)) or \
+                not isinstance(self.excluded_topology_rules, (list, tuple)):
+            raise AssertionError("Expected include_topologies and exclude_topologies to be lists of rules")
+        # Compiled once per set of rules, invalid rules fail the configuration
+        self.get_topology_filter()
         self.intervals = []
         intervals = instance.get('intervals', self.init_config.get('intervals', StormCheck.DEFAULT_STORM_INTERVALS))
 
@@ -601,6 +2461,129 @@ class StormCheck(AgentCheck):
         else:
             self.intervals.extend(intervals)
 
+        self.max_concurrency = int(instance.get('max_concurrency',
+                                                self.init_config.get('max_concurrency',
+                                                                     StormCheck.DEFAULT_STORM_MAX_CONCURRENCY)))
+        if self.max_concurrency < 1:
+            raise AssertionError("Expected max_concurrency to be a positive integer")
+
+        # size the pool so that every worker thread can hold a connection.
+        self.pool_size = int(instance.get('pool_size',
+                                          self.init_config.get('pool_size', max(StormCheck.DEFAULT_STORM_POOL_SIZE,
+                                                                                self.max_concurrency))))
+        if self.pool_size < 1:
+            raise AssertionError("Expected pool_size to be a positive integer")
+        self.connect_timeout = float(instance.get('connect_timeout',
+                                                  self.init_config.get('connect_timeout',
+                                                                       StormCheck.DEFAULT_STORM_CONNECT_TIMEOUT)))
+        self.read_timeout = float(instance.get('read_timeout',
+                                               self.init_config.get('read_timeout',
+                                                                    StormCheck.DEFAULT_STORM_READ_TIMEOUT)))
+
+        self.derive_intervals = _bool(instance.get('derive_intervals',
+                                                   self.init_config.get('derive_intervals', False)))
+        self.history_samples = int(instance.get('history_samples',
+                                                self.init_config.get('history_samples',
+                                                                     StormCheck.DEFAULT_STORM_HISTORY_SAMPLES)))
+        if self.history_samples < 1:
+            raise AssertionError("Expected history_samples to be a positive integer")
+
+        summary_cache_ttl = instance.get('summary_cache_ttl', self.init_config.get('summary_cache_ttl', {})) or {}
+        if not isinstance(summary_cache_ttl, dict) or \
+                not set(summary_cache_ttl.keys()).issubset(StormCheck.SUMMARY_CACHE_NAMES):
+            raise AssertionError("Expected summary_cache_ttl to map summaries in {} to seconds".format(
+                ', '.join(StormCheck.SUMMARY_CACHE_NAMES)))
+        self.idle_backoff = float(instance.get('idle_backoff', self.init_config.get(
+            'idle_backoff', StormCheck.DEFAULT_STORM_IDLE_BACKOFF)) or 0)
+        self.max_idle_backoff = float(instance.get('max_idle_backoff', self.init_config.get(
+            'max_idle_backoff', StormCheck.DEFAULT_STORM_MAX_IDLE_BACKOFF)))
+        if self.idle_backoff < 0 or self.max_idle_backoff < self.idle_backoff:
+            raise AssertionError("Expected 0 <= idle_backoff <= max_idle_backoff")
+
+        self.max_stream_series = int(instance.get('max_stream_series', self.init_config.get(
+            'max_stream_series', StormCheck.DEFAULT_STORM_MAX_STREAM_SERIES)) or 0)
+        if self.max_stream_series < 0:
+            raise AssertionError("Expected max_stream_series to be a positive integer")
+
+        self.summary_cache_ttl = dict((k, float(v or 0)) for k, v in summary_cache_ttl.items())
+        self.summary_cache_stats = {}
+
+        self.stream_topology_metrics = _bool(instance.get('stream_topology_metrics',
+                                                          self.init_config.get('stream_topology_metrics', False)))
+        if self.stream_topology_metrics and ijson is None:
+            self.log.warning("stream_topology_metrics requires the ijson module, falling back to buffered parsing.")
+            self.stream_topology_metrics = False
+        if self.stream_topology_metrics and self.derive_intervals:
+            self.log.warning("stream_topology_metrics is not supported with derive_intervals, "
+                             "falling back to buffered parsing.")
+            self.stream_topology_metrics = False
+        if self.stream_topology_metrics and self.max_stream_series:
+            # ranking the stream series by traffic needs all of them first
+            self.log.warning("stream_topology_metrics is not supported with max_stream_series, "
+                             "falling back to buffered parsing.")
+            self.stream_topology_metrics = False
+
+        self.collection_engine = instance.get('collection_engine', self.init_config.get(
+            'collection_engine', StormCheck.DEFAULT_STORM_COLLECTION_ENGINE))
+        if self.collection_engine not in StormCheck.COLLECTION_ENGINES:
+            raise AssertionError("Expected collection_engine to be one of {}".format(
+                ', '.join(StormCheck.COLLECTION_ENGINES)))
+        if self.collection_engine == 'event_loop' and ioloop is None:
+            self.log.warning("The event_loop collection engine requires the tornado module, falling back to threads.")
+            self.collection_engine = 'threads'
+        self.record_path = instance.get('record_path', self.init_config.get('record_path'))
+        self.replay_path = instance.get('replay_path', self.init_config.get('replay_path'))
+        if self.record_path and self.replay_path:
+            raise AssertionError("Expected at most one of record_path and replay_path")
+        if self.collection_engine == 'event_loop' and (self.record_path or self.replay_path):
+            self.log.warning("Recording and replaying responses is not supported with the event_loop collection "
+                             "engine, falling back to threads.")
+            self.collection_engine = 'threads'
+        if self.collection_engine == 'event_loop' and self.stream_topology_metrics:
+            self.log.warning("stream_topology_metrics is not supported with the event_loop collection engine, "
+                             "falling back to buffered parsing.")
+            self.stream_topology_metrics = False
+        self.max_requests_per_host = int(instance.get('max_requests_per_host', self.init_config.get(
+            'max_requests_per_host', StormCheck.DEFAULT_STORM_MAX_REQUESTS_PER_HOST)))
+        if self.max_requests_per_host < 1:
+            raise AssertionError("Expected max_requests_per_host to be a positive integer")
+        self.deadline = float(instance.get('deadline', self.init_config.get(
+            'deadline', StormCheck.DEFAULT_STORM_DEADLINE)) or 0)
+        self.run_deadline = time.time() + self.deadline if self.deadline > 0 else None
+        self.summary_prefetch = {}
+        self.skipped_requests = {}
+
+        self.phase_timing = _bool(instance.get('phase_timing', self.init_config.get('phase_timing', False)))
+        self.phase_timing_slowest_topologies = int(instance.get('phase_timing_slowest_topologies', self.init_config.get(
+            'phase_timing_slowest_topologies', 0)))
+        # a fresh timer per run, None keeps the timing out of the hot paths
+        self.phase_timer = PhaseTimer() if self.phase_timing else None
+
+        self.static_attributes_heartbeat = float(instance.get('static_attributes_heartbeat', self.init_config.get(
+            'static_attributes_heartbeat', StormCheck.DEFAULT_STORM_STATIC_ATTRIBUTES_HEARTBEAT)) or 0)
+        self.static_attributes_cache_size = int(instance.get('static_attributes_cache_size', self.init_config.get(
+            'static_attributes_cache_size', StormCheck.DEFAULT_STORM_STATIC_ATTRIBUTES_CACHE_SIZE)))
+        if self.static_attributes_heartbeat < 0 or self.static_attributes_cache_size < 1:
+            raise AssertionError("Expected static_attributes_heartbeat >= 0 and static_attributes_cache_size > 0")
+
+        self.component_num_tasks = instance.get('component_num_tasks', self.init_config.get(
+            'component_num_tasks', StormCheck.DEFAULT_STORM_COMPONENT_NUM_TASKS))
+        if not isinstance(self.component_num_tasks, (list, tuple)) or \
+                any(level not in StormCheck.COMPONENT_NUM_TASKS_LEVELS for level in self.component_num_tasks):
+            raise AssertionError("Expected component_num_tasks to be a list of {}".format(
+                ', '.join(StormCheck.COMPONENT_NUM_TASKS_LEVELS)))
+
+        self.circuit_breaker_threshold = int(instance.get('circuit_breaker_threshold', self.init_config.get(
+            'circuit_breaker_threshold', StormCheck.DEFAULT_STORM_CIRCUIT_BREAKER_THRESHOLD)) or 0)
+        self.circuit_breaker_backoff = float(instance.get('circuit_breaker_backoff', self.init_config.get(
+            'circuit_breaker_backoff', StormCheck.DEFAULT_STORM_CIRCUIT_BREAKER_BACKOFF)))
+        self.circuit_breaker_max_backoff = float(instance.get('circuit_breaker_max_backoff', self.init_config.get(
+            'circuit_breaker_max_backoff', StormCheck.DEFAULT_STORM_CIRCUIT_BREAKER_MAX_BACKOFF)))
+        if self.circuit_breaker_threshold < 0 or \
+                not 0 < self.circuit_breaker_backoff <= self.circuit_breaker_max_backoff:
+            raise AssertionError("Expected circuit_breaker_threshold >= 0 and "
+                                 "0 < circuit_breaker_backoff <= circuit_breaker_max_backoff")
+
     def check(self, instance):
         """ Perform the agent check.
 
@@ -608,12 +2591,21 @@ class StormCheck(AgentCheck):
         :return: None
         """
         # Setup
+        run_start = time.time()
         self.update_from_config(instance)
+        archive = self.get_response_archive()
+        if archive is not None:
+            archive.start_run(recording=not self.replay_path)
+        if self.collection_engine == 'event_loop':
+            self.prefetch_summaries()
 
         # Cluster Stats
         cluster_stats = self.get_storm_cluster_summary()
         self.process_cluster_stats(self.environment_name, cluster_stats)
 
+        # The topology summary comes second: it drives everything fetched after the summaries
+        summary = self.get_storm_topology_summary()
+
         # Nimbus Stats
         nimbus_stats = self.get_storm_nimbus_summary()
         self.process_nimbus_stats(self.environment_name, nimbus_stats)
@@ -623,29 +2615,212 @@ class StormCheck(AgentCheck):
         self.process_supervisor_stats(supervisor_stats)
 
         # Topology Stats
-        summary = self.get_storm_topology_summary()
+        topologies = []
+        idle_topologies = []
+        topology_summaries = {}
+        now = time.time()
+        topology_filter = self.get_topology_filter()
         for topology in _get_list(summary, 'topologies'):
+            topology_name = _get_string(topology, 'unknown', 'name')
+            if not topology_filter.is_included(topology_name):
+                continue
             topology_id = topology.get('id')
             if topology_id in (None, ''):
                 self.log.warning("Ignoring topology without id.")
                 continue
-            topology_name = _get_string(topology, 'unknown', 'name')
-            topology_status = None
-            if topology_name not in self.excluded_topologies:
-                for interval in self.intervals:
-                    stats = self.get_topology_info(topology_id=topology_id, interval=interval)
-                    self.process_topology_stats(topology_stats=stats, interval=interval)
-                    metric_stats = self.get_topology_metrics(topology_id=topology_id, interval=interval)
-                    self.process_topology_metrics(topology_name, metric_stats, interval=interval)
-
-                    # only report this once.
-                    if topology_status is None:
-                        topology_status = _get_string(stats, 'unknown', 'status').upper()
-                        check_status = AgentCheck.CRITICAL if topology_status != 'ACTIVE' else AgentCheck.OK
-                        self.service_check(
-                            'topology-check.{}'.format(topology_name),
-                            status=check_status,
-                            message='{} topology status marked as: {}'.format(topology_name, topology_status),
-                            tags=['env:{}'.format(self.environment_name),
-                                  'environment:{}'.format(self.environment_name)] + self.additional_tags
-                        )
+            if self.idle_backoff and not self.get_topology_activity().should_poll(topology_id, now):
+                idle_topologies.append((topology_id, topology_name, topology))
+            else:
+                topologies.append((topology_id, topology_name))
+                topology_summaries[topology_id] = topology
+        # Active topologies are fetched first
+        topologies.sort(key=lambda t: _get_string(topology_summaries[t[0]], '', 'status').upper() != 'ACTIVE')
+
+        # Idle topologies are not polled this run, but still get their status from the topology summary
+        for _, topology_name, topology in idle_topologies:
+            self.report_topology_status(topology_name, topology)
+        if self.idle_backoff:
+            self.get_topology_activity().expire(set(topology_id for topology_id, _ in topologies) |
+                                                set(topology_id for topology_id, _, _ in idle_topologies))
+            self.report_gauge('storm.check.topologies.skipped', len(idle_topologies), tags=[],
+                              additional_tags=self.additional_tags)
+
+        intervals = [StormCheck.ALL_TIME_WINDOW] if self.derive_intervals else self.intervals
+        topology_requests = [(topology_id, interval) for topology_id, _ in topologies for interval in intervals]
+        results = self.iter_topology_requests(topology_requests)
+        try:
+            self.process_topologies(topologies, results, topology_summaries)
+        finally:
+            results.close()
+
+        if self.static_attributes_heartbeat:
+            self.get_static_series_cache().expire(set(
+                topology_name.replace('.', '_').replace(':', '_') for topology_name in
+                [name for _, name in topologies] + [name for _, name, _ in idle_topologies]))
+
+        if self.derive_intervals:
+            self.get_sample_history().expire(set(topology_id for topology_id, _ in topologies) |
+                                             set(topology_id for topology_id, _, _ in idle_topologies), time.time(),
+                                             2 * max(self.intervals))
+
+        self.report_connection_stats()
+        self.report_summary_cache_stats()
+        if self.run_deadline is not None:
+            self.report_skipped_requests()
+        if self.circuit_breaker_threshold:
+            self.report_circuit_breakers()
+        if len(self.servers) > 1:
+            self.report_server_health()
+        if self.static_attributes_heartbeat:
+            self.report_static_series_stats()
+        if self.phase_timer is not None:
+            self.report_phase_timings(time.time() - run_start)
+
+    def process_topologies(self, topologies, results, topology_summaries=None):
+        """ Process the topology info and metrics responses for each topology and interval.
+
+        Responses skipped because of the run deadline are left out, and a topology whose info was skipped gets its
+        status from its topology summary instead.
+
+        :param topologies: (topology_id, topology_name) pairs in request order
+        :type topologies: list
+        :param results: (topology info response, topology metrics response) tuples in request order
+        :type results: generator
+        :param topology_summaries: Topology summaries by topology id
+        :type topology_summaries: dict
+        """
+        topology_summaries = topology_summaries or {}
+        num_responses = 1 if self.derive_intervals else len(self.intervals)
+        for topology_id, topology_name in topologies:
+            responses = [next(results) for _ in range(num_responses)]
+            timer = self.phase_timer
+            if timer is None:
+                self.process_topology(topology_id, topology_name, responses, topology_summaries.get(topology_id, {}))
+            else:
+                start = time.time()
+                self.process_topology(topology_id, topology_name, responses, topology_summaries.get(topology_id, {}))
+                timer.add_topology(topology_id, 'process', time.time() - start)
+
+    def process_topology(self, topology_id, topology_name, responses, topology_summary):
+        """ Process the topology info and metrics responses of a topology.
+
+        :param topology_id: Topology Id
+        :type topology_id: str
+        :param topology_name: Topology Name
+        :type topology_name: str
+        :param responses: (topology info response, topology metrics response) tuples, one per interval, or a single
+            all-time one when deriving the intervals
+        :type responses: list
+        :param topology_summary: Topology summary, for the status of a topology whose info was skipped
+        :type topology_summary: dict
+        """
+        if self.derive_intervals:
+            stats, metric_stats = responses[0]
+            if metric_stats is SKIPPED:
+                self.skip_request('topology_metrics')
+                metric_stats = {}
+            if stats is SKIPPED:
+                self.skip_request('topology_info')
+                self.report_topology_status(topology_name, topology_summary)
+                return
+            timestamp = time.time()
+            self.process_topology_all_time(topology_id, topology_name, stats, metric_stats, timestamp)
+            self.report_topology_status(topology_name, stats)
+            self.update_topology_activity(topology_id, stats, timestamp)
+            return
+
+        for i, (interval, (stats, metric_stats)) in enumerate(zip(self.intervals, responses)):
+            if stats is SKIPPED:
+                self.skip_request('topology_info')
+            else:
+                self.process_topology_stats(topology_stats=stats, interval=interval)
+            if self.stream_topology_metrics:
+                # open the stream only now, right before reading it
+                metric_stats = metric_stats()
+            if metric_stats is SKIPPED:
+                self.skip_request('topology_metrics')
+            elif self.stream_topology_metrics:
+                self.process_topology_metrics_stream(topology_name, metric_stats, interval=interval)
+            else:
+                self.process_topology_metrics(topology_name, metric_stats, interval=interval)
+
+            # only report this once.
+            if i == 0:
+                if stats is SKIPPED:
+                    self.report_topology_status(topology_name, topology_summary)
+                else:
+                    self.report_topology_status(topology_name, stats)
+                    self.update_topology_activity(topology_id, stats, time.time())
+
+    def report_server_health(self):
+        """ Report whether each configured server is healthy, i.e. not demoted after a failed request. """
+        health = self.get_server_health()
+        now = time.time()
+        for server in self.servers:
+            self.report_gauge('storm.check.server.healthy', 1 if health.is_healthy(server, now) else 0,
+                              tags=['server:{}'.format(server)], additional_tags=self.additional_tags)
+
+    def report_circuit_breakers(self):
+        """ Report the circuit breaker state of the endpoints with recent failures, and the number of open breakers. """
+        states = self.get_circuit_breakers().states()
+        for endpoint, state in sorted(states.items()):
+            self.report_gauge('storm.check.circuit_breaker.state', state, tags=['endpoint:{}'.format(endpoint)],
+                              additional_tags=self.additional_tags)
+        self.report_gauge('storm.check.circuit_breakers.open',
+                          len([state for state in states.values() if state != CircuitBreakers.CLOSED]), tags=[],
+                          additional_tags=self.additional_tags)
+
+    def report_skipped_requests(self):
+        """ Report the requests of the run not sent because the run deadline had passed. """
+        for request_type in StormCheck.REQUEST_TYPES:
+            self.report_gauge('storm.check.requests.skipped', self.skipped_requests.get(request_type, 0),
+                              tags=['request:{}'.format(request_type)], additional_tags=self.additional_tags)
+
+    def report_phase_timings(self, run_time):
+        """ Report the time spent in each phase of the run, and log the slowest topologies when configured.
+
+        Request phases overlap when requests are fetched concurrently, and processing phases include the reporting of
+        their metrics.
+
+        :param run_time: Duration of the run in seconds
+        :type run_time: float
+        """
+        timer = self.phase_timer
+        # the timings reported below are not part of the run
+        self.phase_timer = None
+        for phase, (seconds, calls) in sorted(timer.phases.items()):
+            phase_tags = ['phase:{}'.format(phase)]
+            self.report_gauge('storm.check.phase.time', seconds, tags=phase_tags, additional_tags=self.additional_tags)
+            self.report_gauge('storm.check.phase.calls', calls, tags=phase_tags, additional_tags=self.additional_tags)
+        self.report_gauge('storm.check.run.time', run_time, tags=[], additional_tags=self.additional_tags)
+
+        for topology_id, seconds, phases in timer.slowest_topologies(self.phase_timing_slowest_topologies):
+            self.log.info("Slowest Storm topologies: %s took %.3fs (%s)", topology_id, seconds,
+                          ', '.join('{}: {:.3f}s'.format(phase, phase_seconds)
+                                    for phase, phase_seconds in sorted(phases.items())))
+
+    def report_static_series_stats(self):
+        """ Report the static attribute points suppressed during the run and the size of the series cache. """
+        cache = self.get_static_series_cache()
+        self.report_gauge('storm.check.static.suppressed', cache.suppressed,
+                          tags=[], additional_tags=self.additional_tags)
+        self.report_gauge('storm.check.static.series', len(cache),
+                          tags=[], additional_tags=self.additional_tags)
+        cache.suppressed = 0
+
+    def report_topology_status(self, topology_name, topology_stats):
+        """ Report the topology status service check.
+
+        :param topology_name: Topology Name
+        :type topology_name: str
+        :param topology_stats: Topology stats response
+        :type topology_stats: dict
+        """
+        topology_status = _get_string(topology_stats, 'unknown', 'status').upper()
+        check_status = AgentCheck.CRITICAL if topology_status != 'ACTIVE' else AgentCheck.OK
+        self.service_check(
+            'topology-check.{}'.format(topology_name),
+            status=check_status,
+            message='{} topology status marked as: {}'.format(topology_name, topology_status),
+            tags=self.environment_tags + self.additional_tags
+        )
@@ -3,11 +3,32 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
-from collections import defaultdict
+from collections import defaultdict, deque
+import BaseHTTPServer
+import copy
+import gzip
+import json
+import os
+import resource
+import socket
+import SocketServer
+import StringIO
+import threading
+import time
+import urlparse
 from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
 
 # 3p
 import responses
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import tornado
+except ImportError:
+    tornado = None
 
 # project
 from checks import AgentCheck
@@ -608,6 +629,259 @@ TEST_STORM_TOPOLOGY_METRICS_RESP = {
     ]
 }
 
+# Topology info as Storm 1.x lists its windows: 10 minutes, 3 hours and 1 day first, all-time last
+TEST_STORM_TOPOLOGY_WINDOWS_RESP = copy.deepcopy(TEST_STORM_TOPOLOGY_RESP)
+TEST_STORM_TOPOLOGY_WINDOWS_RESP['topologyStats'] = [
+    dict(TEST_STORM_TOPOLOGY_RESP['topologyStats'][0], window=window, windowPretty=pretty,
+         acked=acked, emitted=acked * 3, transferred=acked * 3)
+    for window, pretty, acked in (('600', '10m 0s', 4200), ('10800', '3h 0m 0s', 61000),
+                                  ('86400', '1d 0h 0m 0s', 98000))
+] + TEST_STORM_TOPOLOGY_RESP['topologyStats']
+
+
+class StormUIStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the stub server's canned responses by request path, keeping connections alive."""
+    protocol_version = 'HTTP/1.1'
+    # buffer each response so headers and body leave in one segment
+    wbufsize = -1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.enter()
+        try:
+            time.sleep(self.server.latency)
+        finally:
+            self.server.exit()
+        path = urlparse.urlparse(self.path).path
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = self.server.get_body(path, gzipped)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.server.gzipped += 1
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StormUIStub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the Storm UI REST API with a fixed per-request latency."""
+    daemon_threads = True
+
+    def __init__(self, routes, latency=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StormUIStubHandler)
+        self.routes = routes
+        self.latency = latency
+        self.gzipped = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # (path, gzipped) -> encoded body, so serving large synthetic responses costs the server next to nothing
+        self.bodies = {}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def exit(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def reset_max_in_flight(self):
+        """Get the peak number of requests handled at the same time since the previous reset."""
+        with self.lock:
+            max_in_flight, self.max_in_flight = self.max_in_flight, self.in_flight
+        return max_in_flight
+
+    def get_body(self, path, gzipped):
+        body = self.bodies.get((path, gzipped))
+        if body is None:
+            body = json.dumps(self.routes.get(path, {'error': 'Not Found'}))
+            if gzipped:
+                buf = StringIO.StringIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                    f.write(body)
+                body = buf.getvalue()
+            self.bodies[(path, gzipped)] = body
+        return body
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def stub_routes(num_topologies):
+    """Build stub server routes for `num_topologies` copies of the test topology."""
+    summary = {'topologies': []}
+    routes = {
+        '/api/v1/cluster/summary': TEST_STORM_CLUSTER_SUMMARY,
+        '/api/v1/nimbus/summary': TEST_STORM_NIMBUSES_SUMMARY,
+        '/api/v1/supervisor/summary': TEST_STORM_SUPERVISOR_SUMMARY,
+        '/api/v1/topology/summary': summary
+    }
+    for i in range(num_topologies):
+        topology_id = 'my_topology_{}-1-1489183263'.format(i)
+        topology = copy.deepcopy(TEST_STORM_TOPOLOGY_SUMMARY['topologies'][0])
+        topology.update({'id': topology_id, 'encodedId': topology_id, 'name': 'my_topology_{}'.format(i)})
+        summary['topologies'].append(topology)
+        info = copy.deepcopy(TEST_STORM_TOPOLOGY_RESP)
+        info.update({'id': topology_id, 'name': topology['name']})
+        routes['/api/v1/topology/{}'.format(topology_id)] = info
+        routes['/api/v1/topology/{}/metrics'.format(topology_id)] = TEST_STORM_TOPOLOGY_METRICS_RESP
+    return routes
+
+
+def synthetic_topology_metrics(num_components, num_streams):
+    """Build a topology metrics response with `num_components` bolts and spouts of `num_streams` streams each."""
+    def _component(component_id, stats):
+        component = {'id': component_id}
+        for stat in stats:
+            component[stat] = [{'component_id': 'component_{}'.format(i % 10), 'stream_id': 'stream_{}'.format(i),
+                                'value': str(i * 1.5)} for i in range(num_streams)]
+        return component
+
+    return {
+        'window': '600',
+        'window-hint': '10m 0s',
+        'bolts': [_component('bolt_{}'.format(i), ['acked', 'emitted', 'executed', 'executed_ms_avg', 'failed',
+                                                     'process_ms_avg', 'transferred'])
+                  for i in range(num_components)],
+        'spouts': [_component('spout_{}'.format(i), ['acked', 'complete_ms_avg', 'emitted', 'failed', 'transferred'])
+                   for i in range(num_components)]
+    }
+
+
+def synthetic_storm_routes(num_topologies, num_bolts, num_spouts, num_workers, num_streams):
+    """Build stub server routes for a synthetic cluster of `num_topologies` topologies, each with `num_bolts` bolts,
+    `num_spouts` spouts and `num_workers` workers, every component emitting `num_streams` streams."""
+    num_supervisors = max(1, num_workers / 4)
+    supervisors = [{'id': 'supervisor_{}'.format(i), 'host': '10.0.0.{}'.format(i), 'uptimeSeconds': 3600,
+                    'slotsTotal': 4, 'slotsUsed': 4, 'totalMem': 8192, 'usedMem': 4096, 'totalCpu': 400,
+                    'usedCpu': 200, 'version': '1.0.3'} for i in range(num_supervisors)]
+    summary = {'topologies': []}
+    routes = {
+        '/api/v1/cluster/summary': dict(TEST_STORM_CLUSTER_SUMMARY, supervisors=num_supervisors,
+                                        topologies=num_topologies),
+        '/api/v1/nimbus/summary': TEST_STORM_NIMBUSES_SUMMARY,
+        '/api/v1/supervisor/summary': {'supervisors': supervisors},
+        '/api/v1/topology/summary': summary
+    }
+    bolt_ids = ['bolt_{}'.format(i) for i in range(num_bolts)]
+    spout_ids = ['spout_{}'.format(i) for i in range(num_spouts)]
+    components = bolt_ids + spout_ids
+    for t in range(num_topologies):
+        topology_id = 'topology_{}-1-1489183263'.format(t)
+        topology = dict(TEST_STORM_TOPOLOGY_SUMMARY['topologies'][0], id=topology_id, encodedId=topology_id,
+                        name='topology_{}'.format(t), workersTotal=num_workers)
+        summary['topologies'].append(topology)
+
+        info = dict(TEST_STORM_TOPOLOGY_RESP, id=topology_id, name=topology['name'], workersTotal=num_workers)
+        info['bolts'] = [dict(TEST_STORM_TOPOLOGY_RESP['bolts'][0], boltId=bolt_id, encodedBoltId=bolt_id)
+                         for bolt_id in bolt_ids]
+        info['spouts'] = [dict(TEST_STORM_TOPOLOGY_RESP['spouts'][0], spoutId=spout_id, encodedSpoutId=spout_id)
+                          for spout_id in spout_ids]
+        info['workers'] = [{'host': supervisors[w % num_supervisors]['host'], 'port': 6700 + w,
+                            'supervisorId': supervisors[w % num_supervisors]['id'], 'uptimeSeconds': 3600,
+                            'assignedCpu': 0.0, 'assignedMemOnHeap': 832, 'assignedMemOffHeap': 0,
+                            'executorsTotal': len(components),
+                            'componentNumTasks': dict((c, 1 + (c_i + w) % 3) for c_i, c in enumerate(components))}
+                           for w in range(num_workers)]
+        routes['/api/v1/topology/{}'.format(topology_id)] = info
+
+        metrics = synthetic_topology_metrics(0, num_streams)
+        metrics['bolts'] = [dict(component, id=bolt_id) for bolt_id, component in
+                            zip(bolt_ids, synthetic_topology_metrics(num_bolts, num_streams)['bolts'])]
+        metrics['spouts'] = [dict(component, id=spout_id) for spout_id, component in
+                             zip(spout_ids, synthetic_topology_metrics(num_spouts, num_streams)['spouts'])]
+        routes['/api/v1/topology/{}/metrics'.format(topology_id)] = metrics
+    return routes
+
+
+def measure_in_child(func):
+    """Run `func` in a forked child, and return its result along with the wall time, CPU time and peak RSS growth
+    (in KB on linux) of the child. `func` must return a JSON serializable value."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            before = resource.getrusage(resource.RUSAGE_SELF)
+            start = time.time()
+            result = func()
+            wall_time = time.time() - start
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            os.write(write_fd, json.dumps({
+                'result': result,
+                'wall_time': wall_time,
+                'cpu_time': (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime),
+                'peak_rss_kb': after.ru_maxrss - before.ru_maxrss
+            }))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+
+def measure_peak_memory(func):
+    """Run `func` in a forked child and return how much it grew the child's peak RSS (in KB on linux)."""
+    def _run():
+        func()
+    return measure_in_child(_run)['peak_rss_kb']
+
+
+class ColumnarMetricBuffer(object):
+    """Buffers metric points as (metric id, value, tag set id) columns, interning the metrics and full tag sets, to
+    submit them in bulk once per run. The check submits each point instead, this buffer measures the alternative."""
+    def __init__(self, get_all_tags):
+        self.get_all_tags = get_all_tags
+        self.metric_ids = []
+        self.values = []
+        self.tag_set_ids = []
+        self.metrics = []
+        self.metric_ids_by_metric = {}
+        self.tag_sets = []
+        self.tag_set_ids_by_tag_set = {}
+
+    def add(self, submit, metric, value, tags, additional_tags):
+        metric_id = self.metric_ids_by_metric.get((submit, metric))
+        if metric_id is None:
+            metric_id = self.metric_ids_by_metric[(submit, metric)] = len(self.metrics)
+            self.metrics.append((submit, metric))
+        tag_set = self.get_all_tags(tags, additional_tags)
+        tag_set_id = self.tag_set_ids_by_tag_set.get(tag_set)
+        if tag_set_id is None:
+            tag_set_id = self.tag_set_ids_by_tag_set[tag_set] = len(self.tag_sets)
+            self.tag_sets.append(tag_set)
+        self.metric_ids.append(metric_id)
+        self.values.append(value)
+        self.tag_set_ids.append(tag_set_id)
+
+    def flush(self):
+        metrics, tag_sets = self.metrics, self.tag_sets
+        for metric_id, value, tag_set_id in zip(self.metric_ids, self.values, self.tag_set_ids):
+            submit, metric = metrics[metric_id]
+            submit(metric=metric, value=value, tags=tag_sets[tag_set_id])
+        self.__init__(self.get_all_tags)
+
 
 @attr(requires='storm')
 class TestStorm(AgentCheckTest):
@@ -643,9 +917,67 @@ class TestStorm(AgentCheckTest):
         self.assertEqual('test', self.check.environment_name)
         self.assertListEqual([], self.check.additional_tags)
         self.assertListEqual([], self.check.excluded_topologies)
+        self.assertListEqual([], self.check.included_topologies)
+        self.assertListEqual([], self.check.excluded_topology_rules)
         print type(self.check.intervals), self.check.intervals
         self.assertListEqual([60], self.check.intervals)
 
+    @attr('config')
+    def test_load_max_concurrency_from_config(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        self.assertEqual(1, self.check.max_concurrency)
+        self.check.update_from_config({'server': 'http://localhost:9005', 'max_concurrency': 8})
+        self.assertEqual(8, self.check.max_concurrency)
+        self.assertRaises(AssertionError, self.check.update_from_config, {'max_concurrency': 0})
+
+    @attr('config')
+    def test_load_http_settings_from_config(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        self.assertEqual(10, self.check.pool_size)
+        self.assertEqual(5, self.check.connect_timeout)
+        self.assertEqual(30, self.check.read_timeout)
+        self.check.update_from_config({'max_concurrency': 16, 'connect_timeout': 1, 'read_timeout': 2.5})
+        self.assertEqual(16, self.check.pool_size)
+        self.assertEqual(1, self.check.connect_timeout)
+        self.assertEqual(2.5, self.check.read_timeout)
+
+    @attr('config')
+    def test_load_collection_engine_from_config(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        self.assertEqual('threads', self.check.collection_engine)
+        self.assertEqual(10, self.check.max_requests_per_host)
+        self.assertIsNone(self.check.run_deadline)
+        self.check.update_from_config({'collection_engine': 'event_loop', 'max_requests_per_host': 4, 'deadline': 10})
+        self.assertEqual('event_loop' if tornado else 'threads', self.check.collection_engine)
+        self.assertEqual(4, self.check.max_requests_per_host)
+        self.assertAlmostEqual(time.time() + 10, self.check.run_deadline, delta=1)
+        self.assertRaises(AssertionError, self.check.update_from_config, {'collection_engine': 'asyncio'})
+        self.assertRaises(AssertionError, self.check.update_from_config, {'max_requests_per_host': 0})
+
+    @attr('config', 'stream')
+    def test_load_stream_topology_metrics_from_config(self):
+        if ijson is None:
+            raise SkipTest("ijson is not installed")
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config({'stream_topology_metrics': True})
+        self.assertTrue(self.check.stream_topology_metrics)
+        # incompatible modes fall back to buffered parsing
+        for option in ({'derive_intervals': True}, {'max_stream_series': 100}):
+            self.check.update_from_config(dict(option, stream_topology_metrics=True))
+            self.assertFalse(self.check.stream_topology_metrics)
+
+    @attr('config')
+    def test_load_summary_cache_ttl_from_config(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        self.assertEqual({}, self.check.summary_cache_ttl)
+        self.check.update_from_config({'summary_cache_ttl': {'topology': 300, 'supervisor': '60'}})
+        self.assertEqual({'topology': 300.0, 'supervisor': 60.0}, self.check.summary_cache_ttl)
+        self.assertRaises(AssertionError, self.check.update_from_config, {'summary_cache_ttl': {'bogus': 60}})
+
     @attr('helper')
     def test_g(self):
         self.load_check(self.STORM_CHECK_CONFIG, {})
@@ -703,6 +1035,55 @@ class TestStorm(AgentCheckTest):
                 self.assertEqual(expected, result,
                                  "Expected value to match for test case: {} but got {}".format(test_case, result))
 
+    @attr('helper')
+    def test_compiled_extractors_match_g(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+
+        for spec, stat_maps in [
+            (module.TOPOLOGY_STATS_SPEC, [TEST_STORM_TOPOLOGY_RESP, {}, {'topologyStats': []}]),
+            (module.BOLT_STATS_SPEC, TEST_STORM_TOPOLOGY_RESP['bolts'] + [{}]),
+            (module.SPOUT_STATS_SPEC, TEST_STORM_TOPOLOGY_RESP['spouts'] + [{}]),
+            (module.WORKER_STATS_SPEC, [{'assignedCpu': '0.5', 'assignedMemOnHeap': 832, 'uptimeSeconds': None}, {}])
+        ]:
+            plan = module._compile_plan(spec)
+            for stat_map in stat_maps:
+                for (metric_name, extract), entry in zip(plan, spec):
+                    try:
+                        expected = module._g(stat_map, *entry[1:])
+                    except IndexError:
+                        # _g does not guard against empty lists
+                        expected = entry[1]
+                    self.assertEqual(expected, extract(stat_map),
+                                     "Expected {} to match _g for {}".format(metric_name, stat_map))
+
+    @attr('helper', 'benchmark', requires='benchmark')
+    def test_compiled_extractors_benchmark(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        bolts = [dict(TEST_STORM_TOPOLOGY_RESP['bolts'][i % 6], boltId='Bolt{}'.format(i)) for i in range(500)]
+        spec = module.BOLT_STATS_SPEC
+        plan = module._compile_plan(spec)
+
+        def _helpers():
+            return [[module._g(b, *entry[1:]) for entry in spec] for b in bolts]
+
+        def _compiled():
+            return [[extract(b) for _, extract in plan] for b in bolts]
+
+        timings = {}
+        for name, func in [('helpers', _helpers), ('compiled', _compiled)]:
+            start = time.clock()
+            for _ in range(20):
+                result = func()
+            timings[name] = time.clock() - start
+            timings[name + '_result'] = result
+
+        print '500 bolts x 20 runs: _g helpers {:.3f}s cpu, compiled plan {:.3f}s cpu'.format(timings['helpers'],
+                                                                                          timings['compiled'])
+        self.assertEqual(timings['helpers_result'], timings['compiled_result'])
+        self.assertLess(timings['compiled'], timings['helpers'])
+
     @attr('helper')
     def test_try_float(self):
         self.load_check(self.STORM_CHECK_CONFIG, {})
@@ -947,6 +1328,186 @@ class TestStorm(AgentCheckTest):
         self.assertEquals(8, results['storm.spout.last_60.executors'][0][0])
         self.assertEquals(38737, results['storm.spout.last_60.errorLapsedSecs'][0][0])
 
+    def process_component_num_tasks(self, topology_stats, component_num_tasks):
+        """Process `topology_stats` with `component_num_tasks` levels, and return the reported task count points."""
+        self.check.update_from_config({'server': 'http://localhost:9005', 'environment': 'test',
+                                       'component_num_tasks': component_num_tasks})
+        results = defaultdict(list)
+
+        def report_histogram(metric, value, tags, additional_tags):
+            if metric.endswith(('numTasks', 'NumTasks')):
+                results[metric].append((value, sorted(tags)))
+
+        self.check.report_histogram = report_histogram
+        self.check.process_topology_stats(topology_stats, interval=60)
+        return results
+
+    @attr('process', 'topology')
+    def test_process_topology_stats_component_num_tasks(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        info = synthetic_storm_routes(1, 2, 1, 8, 1)['/api/v1/topology/topology_0-1-1489183263']
+        tags = ['topology:topology_0']
+
+        # per component and per supervisor by default
+        results = self.process_component_num_tasks(info, ['component', 'supervisor'])
+        self.assertEqual(['storm.component.last_60.maxWorkerNumTasks', 'storm.component.last_60.numTasks',
+                          'storm.supervisor.last_60.componentMaxWorkerNumTasks',
+                          'storm.supervisor.last_60.componentNumTasks'], sorted(results))
+        self.assertEqual([(15, sorted(tags + ['component:bolt_0'])), (16, sorted(tags + ['component:spout_0'])),
+                          (17, sorted(tags + ['component:bolt_1']))],
+                         sorted(results['storm.component.last_60.numTasks']))
+        self.assertEqual([3, 3, 3], [value for value, _ in results['storm.component.last_60.maxWorkerNumTasks']])
+        # workers 0, 2, 4 and 6 run on supervisor_0, with 1, 3, 2 and 1 tasks of bolt_0
+        self.assertIn((7, sorted(tags + ['supervisor:supervisor_0', 'component:bolt_0'])),
+                      results['storm.supervisor.last_60.componentNumTasks'])
+        self.assertIn((3, sorted(tags + ['supervisor:supervisor_0', 'component:bolt_0'])),
+                      results['storm.supervisor.last_60.componentMaxWorkerNumTasks'])
+        self.assertEqual(6, len(results['storm.supervisor.last_60.componentNumTasks']))
+
+        # per worker detail is opt-in
+        results = self.process_component_num_tasks(info, ['worker'])
+        self.assertEqual(['storm.worker.last_60.componentNumTasks'], sorted(results))
+        self.assertEqual(24, len(results['storm.worker.last_60.componentNumTasks']))
+
+        self.assertRaises(AssertionError, self.process_component_num_tasks, info, ['executor'])
+
+    @attr('process', 'benchmark', requires='benchmark')
+    def test_component_num_tasks_benchmark(self):
+        """
+        Compare the task count points reported for a large topology per worker and rolled up.
+        """
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        info = synthetic_storm_routes(1, 50, 10, 200, 1)['/api/v1/topology/topology_0-1-1489183263']
+        points = {}
+        for levels in (['worker'], ['component', 'supervisor'], ['component']):
+            results = self.process_component_num_tasks(info, levels)
+            points[','.join(levels)] = sum(len(values) for values in results.values())
+        print json.dumps(points, sort_keys=True)
+        # 200 workers x 60 components, vs 2 aggregates of 60 components x (1 + 50 supervisors)
+        self.assertEqual(12000, points['worker'])
+        self.assertEqual(6120, points['component,supervisor'])
+        self.assertEqual(120, points['component'])
+
+    @attr('process', 'tags')
+    def test_report_tags_are_cached_per_run(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config({'server': 'http://localhost:9005', 'environment': 'test', 'tags': ['a:b']})
+
+        results = []
+
+        def histogram(metric, value, tags):
+            results.append((metric, tags))
+
+        self.check.histogram = histogram
+        self.check.process_topology_stats(TEST_STORM_TOPOLOGY_RESP, interval=60)
+
+        bolt_tags = [tags for metric, tags in results if 'bolt:Bolt1' in tags]
+        self.assertEqual(14, len(bolt_tags))
+        self.assertEqual(frozenset(['topology:my_topology', 'bolt:Bolt1', 'env:test', 'environment:test', 'a:b']),
+                         bolt_tags[0])
+        self.assertTrue(all(tags is bolt_tags[0] for tags in bolt_tags))
+        self.assertIs(self.check.get_metric_name('bolt', 60, 'acked'), self.check.get_metric_name('bolt', 60, 'acked'))
+
+        # the storm version tag invalidates the cached tag sets
+        self.check.process_cluster_stats('test', TEST_STORM_CLUSTER_SUMMARY)
+        del results[:]
+        self.check.process_topology_stats(TEST_STORM_TOPOLOGY_RESP, interval=60)
+        self.assertIn('stormVersion:1.0.3', results[0][1])
+
+    @attr('process', 'benchmark', requires='benchmark')
+    def test_report_allocation_benchmark(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        module = __import__(self.check.__class__.__module__)
+        additional_tags = self.check.additional_tags
+        fields = [entry[0] for entry in module.BOLT_STATS_SPEC]
+        workload = [['topology:my_topology', 'bolt:Bolt{}'.format(i)] for i in range(500)]
+
+        def _legacy():
+            # metric name and tag set built on every call, as report_histogram used to
+            points = []
+            for tags in workload:
+                for field in fields:
+                    points.append(('storm.{}.last_{}.{}'.format('bolt', 60, field),
+                                   set(tags + ['env:{}'.format('test'), 'environment:{}'.format('test')] +
+                                       additional_tags)))
+            return points
+
+        def _cached():
+            points = []
+            for tags in workload:
+                for field in fields:
+                    points.append((self.check.get_metric_name('bolt', 60, field),
+                                   self.check.get_all_tags(tags, additional_tags)))
+            return points
+
+        results = {}
+        for name, func in [('legacy', _legacy), ('cached', _cached)]:
+            start = time.clock()
+            points = func()
+            cpu = time.clock() - start
+            results[name] = {
+                'cpu': cpu,
+                'objects': len(set(id(p[0]) for p in points)) + len(set(id(p[1]) for p in points)),
+                'points': [(m, frozenset(t)) for m, t in points]
+            }
+            print '{}: {:.3f}s cpu, {} distinct name/tag objects'.format(name, cpu, results[name]['objects'])
+
+        self.assertEqual(results['legacy']['points'], results['cached']['points'])
+        self.assertEqual(500 * 14 * 2, results['legacy']['objects'])
+        self.assertEqual(14 + 500, results['cached']['objects'])
+
+    @attr('process', 'benchmark', requires='benchmark')
+    def test_bulk_submission_benchmark(self):
+        """
+        Compare the points per second of submitting each point, as the check does, and of buffering the points in
+        columns to submit them in bulk once per run, on a large topology.
+        """
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        routes = synthetic_storm_routes(1, 100, 20, 50, 20)
+        info = routes['/api/v1/topology/topology_0-1-1489183263']
+        metrics = routes['/api/v1/topology/topology_0-1-1489183263/metrics']
+        submitted = {}
+
+        def _sink(metric, value, tags):
+            submitted[bulk].append((metric, value, tags))
+
+        def _run():
+            for _ in range(3):
+                self.check.process_topology_stats(info, 60)
+                self.check.process_topology_metrics('topology_0', metrics, 60)
+                if buf is not None:
+                    buf.flush()
+
+        self.check.gauge = self.check.histogram = _sink
+        results = {}
+        for bulk in (False, True):
+            submitted[bulk] = []
+            buf = None
+            if bulk:
+                buf = ColumnarMetricBuffer(self.check.get_all_tags)
+                self.check.report_gauge = lambda metric, value, tags, additional_tags=list(): buf.add(
+                    self.check.gauge, metric, value, tags, additional_tags)
+                self.check.report_histogram = lambda metric, value, tags, additional_tags=list(): buf.add(
+                    self.check.histogram, metric, value, tags, additional_tags)
+            try:
+                start = time.clock()
+                _run()
+                results[bulk] = time.clock() - start
+            finally:
+                self.check.__dict__.pop('report_gauge', None)
+                self.check.__dict__.pop('report_histogram', None)
+            print '{}: {} points in {:.3f}s cpu, {:.0f} points/s'.format(
+                'bulk' if bulk else 'direct', len(submitted[bulk]), results[bulk],
+                len(submitted[bulk]) / max(results[bulk], 1e-6))
+
+        def _points(points):
+            return sorted((metric, value, sorted(tags)) for metric, value, tags in points)
+
+        self.assertEqual(_points(submitted[False]), _points(submitted[True]))
+        self.assertGreater(len(submitted[False]), 10000)
+
     @attr('process', 'topology_metrics')
     def test_process_topology_metrics(self):
         self.load_check(self.STORM_CHECK_CONFIG, {})
@@ -996,6 +1557,200 @@ class TestStorm(AgentCheckTest):
         self.assertEqual(0, len(results['storm.topologyStats.metrics.spouts.last_60.executed']))
         self.assertEquals(920.497, results['storm.topologyStats.metrics.spouts.last_60.complete_ms_avg'][0][0])
 
+    def _record_report_histogram(self):
+        results = []
+
+        def report_histogram(metric, value, tags, additional_tags):
+            results.append((metric, value, sorted(tags)))
+
+        self.check.report_histogram = report_histogram
+        return results
+
+    @attr('process', 'topology_metrics', 'cardinality')
+    def test_process_topology_metrics_max_stream_series(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config({'max_stream_series': 2})
+        results = self._record_report_histogram()
+        gauges = []
+        self.check.report_gauge = lambda metric, value, tags, additional_tags: gauges.append((metric, value, tags))
+
+        def _streams(stat, values):
+            return [{'component_id': 'spout', 'stream_id': 's{}'.format(i), 'value': v} for i, v in enumerate(values)]
+
+        self.check.process_topology_metrics('my.topology', {
+            'bolts': [{
+                'id': 'split',
+                'acked': _streams('acked', [10, 1000, 30, 5]),
+                'executed': _streams('executed', [10, 1000, 30, 15]),
+                'executed_ms_avg': _streams('executed_ms_avg', ['1.0', '9.0', '2.0', '3.0'])
+            }]
+        }, interval=60)
+
+        topology_tags = ['topology:my_topology']
+        kept = [(m, v, t) for m, v, t in results if 'bolts:split' in t]
+        self.assertEqual(6, len(kept))
+        self.assertEqual(set(['stream:s1', 'stream:s2']), set(t[2] for _, _, t in kept))
+        self.assertEqual(sorted([
+            ('storm.topologyStats.metrics.bolts.last_60.acked', 15.0,
+             sorted(topology_tags + ['bolts:other', 'stream:other'])),
+            ('storm.topologyStats.metrics.bolts.last_60.executed', 25.0,
+             sorted(topology_tags + ['bolts:other', 'stream:other'])),
+            # weighted by executed: (10 * 1.0 + 15 * 3.0) / 25
+            ('storm.topologyStats.metrics.bolts.last_60.executed_ms_avg', 2.2,
+             sorted(topology_tags + ['bolts:other', 'stream:other'])),
+        ]), sorted((m, round(v, 6), t) for m, v, t in results if 'bolts:other' in t))
+        self.assertEqual([('storm.check.series.dropped', 2, topology_tags + ['interval:60'])], gauges)
+
+    @attr('process', 'topology_metrics', 'cardinality')
+    def test_process_topology_metrics_max_stream_series_wide(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config({'max_stream_series': 100})
+        results = self._record_report_histogram()
+        gauges = []
+        self.check.report_gauge = lambda metric, value, tags, additional_tags: gauges.append((metric, value))
+
+        start = time.time()
+        self.check.process_topology_metrics('wide', synthetic_topology_metrics(20, 500), interval=600)
+        print 'max_stream_series=100 over 20000 series: {:.3f}s'.format(time.time() - start)
+
+        series = set(tuple(t) for _, _, t in results)
+        # 100 kept series, plus one rolled up series per component type
+        self.assertEqual(102, len(series))
+        self.assertIn(('bolts:other', 'stream:other', 'topology:wide'), series)
+        self.assertIn(('spouts:other', 'stream:other', 'topology:wide'), series)
+        self.assertEqual([('storm.check.series.dropped', 40 * 500 - 100)], gauges)
+        # the busiest series are kept: bolts count 5 counters per stream against 4 for spouts
+        kept = set((t[0].split('_')[0], t[2]) for t in series if t[2].startswith('stream:'))
+        self.assertEqual(set(('bolts:bolt', 'stream:stream_{}'.format(i)) for i in range(495, 500)), kept)
+
+    @attr('process', 'topology_metrics', 'stream')
+    def test_process_topology_metrics_stream(self):
+        if ijson is None:
+            raise SkipTest("ijson is not installed")
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        results = self._record_report_histogram()
+
+        self.check.process_topology_metrics('test', TEST_STORM_TOPOLOGY_METRICS_RESP, 60)
+        expected = sorted(results)
+        del results[:]
+
+        streams = self.check.iter_topology_metric_streams_from_file(
+            StringIO.StringIO(json.dumps(TEST_STORM_TOPOLOGY_METRICS_RESP)), 'error')
+        self.check.process_topology_metric_streams('test', streams, 60)
+        self.assertEqual(expected, sorted(results))
+
+        # component ids serialized after their streams are still applied
+        del results[:]
+        body = '{"bolts": [{"acked": [{"stream_id": "default", "value": 3}], "id": "split"}, {"acked": [' \
+               '{"stream_id": "default", "value": 5}]}], "spouts": []}'
+        streams = self.check.iter_topology_metric_streams_from_file(StringIO.StringIO(body), 'error')
+        self.check.process_topology_metric_streams('test', streams, 60)
+        self.assertEqual([
+            ('storm.topologyStats.metrics.bolts.last_60.acked', 3.0, ['bolts:split', 'stream:default', 'topology:test']),
+            ('storm.topologyStats.metrics.bolts.last_60.acked', 5.0, ['bolts:unknown', 'stream:default',
+                                                                      'topology:test'])
+        ], results)
+
+        # error responses and truncated bodies stop the stream
+        del results[:]
+        for body in ['{"error": "Not Found", "bolts": [{"id": "a", "acked": [{"value": 1}]}]}', '{"bolts": [{"id']:
+            streams = self.check.iter_topology_metric_streams_from_file(StringIO.StringIO(body), 'error')
+            self.check.process_topology_metric_streams('test', streams, 60)
+        self.assertEqual([], results)
+
+    @attr('process', 'topology_metrics', 'stream', 'benchmark', requires='benchmark')
+    def test_process_topology_metrics_stream_memory(self):
+        if ijson is None or not hasattr(os, 'fork'):
+            raise SkipTest("requires ijson and fork")
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        self.check.update_from_config(self.STORM_CHECK_CONFIG['instances'][0])
+        self.check.report_histogram = lambda metric, value, tags, additional_tags: None
+
+        fixture = os.path.join(os.environ.get('VOLATILE_DIR', '/tmp'), 'storm_topology_metrics.json')
+        with open(fixture, 'w') as f:
+            json.dump(synthetic_topology_metrics(100, 60), f)
+        size = os.path.getsize(fixture) / 1024.0 / 1024.0
+        try:
+            def _buffered():
+                with open(fixture) as f:
+                    self.check.process_topology_metrics('test', json.load(f), 60)
+
+            def _streamed():
+                with open(fixture) as f:
+                    self.check.process_topology_metric_streams(
+                        'test', self.check.iter_topology_metric_streams_from_file(f, 'error'), 60)
+
+            buffered = measure_peak_memory(_buffered)
+            streamed = measure_peak_memory(_streamed)
+        finally:
+            os.remove(fixture)
+
+        print '{:.1f}MB fixture: buffered peak +{}KB, streamed peak +{}KB'.format(
+            size, buffered, streamed)
+        self.assertLess(streamed, buffered)
+
+    @attr('check', 'stream')
+    def test_check_stream_topology_metrics(self):
+        if ijson is None:
+            raise SkipTest("ijson is not installed")
+        emitted = {}
+        with StormUIStub(stub_routes(2)) as server:
+            for stream in (False, True):
+                config = {'instances': [{'server': server.url, 'environment': 'test', 'max_concurrency': 4,
+                                         'stream_topology_metrics': stream}]}
+                self.load_check(config, {})
+                self.run_check(config)
+                self.check.stop()
+                emitted[stream] = sorted((m[0], m[2], sorted(m[3].get('tags') or [])) for m in self.metrics
+                                         if m[0].startswith('storm.topologyStats.metrics.'))
+        self.assertTrue(emitted[False])
+        self.assertEqual(emitted[False], emitted[True])
+
+    @attr('check', 'stream')
+    def test_check_stream_topology_metrics_concurrency(self):
+        """
+        With a worker pool, topology metrics streams are still opened one at a time, by the processing thread.
+        """
+        if ijson is None:
+            raise SkipTest("ijson is not installed")
+        streams = {'open': 0, 'max_open': 0, 'opened': 0, 'threads': set()}
+        with StormUIStub(stub_routes(40)) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'max_concurrency': 4,
+                                     'pool_size': 4, 'stream_topology_metrics': True}]}
+            self.load_check(config, {})
+            get_stream = self.check.get_topology_metrics_stream
+            process_stream = self.check.process_topology_metrics_stream
+
+            def _get_stream(*args, **kwargs):
+                streams['open'] += 1
+                streams['opened'] += 1
+                streams['max_open'] = max(streams['max_open'], streams['open'])
+                streams['threads'].add(threading.current_thread().name)
+                return get_stream(*args, **kwargs)
+
+            def _process_stream(*args, **kwargs):
+                try:
+                    return process_stream(*args, **kwargs)
+                finally:
+                    streams['open'] -= 1
+
+            self.check.get_topology_metrics_stream = _get_stream
+            self.check.process_topology_metrics_stream = _process_stream
+            try:
+                self.run_check(config)
+            finally:
+                del self.check.get_topology_metrics_stream
+                del self.check.process_topology_metrics_stream
+                self.check.stop()
+
+        self.assertEqual(40, streams['opened'])
+        self.assertEqual(1, streams['max_open'])
+        self.assertEqual(set([threading.current_thread().name]), streams['threads'])
+        connections = [m[2] for m in self.metrics if m[0] == 'storm.check.http.connections']
+        self.assertTrue(connections)
+        self.assertLessEqual(connections[0], 4)
+
     @attr('check')
     @responses.activate
     def test_check(self):
@@ -1219,6 +1974,782 @@ class TestStorm(AgentCheckTest):
         # Raises when COVERAGE=true and coverage < 100%
         self.coverage_report()
 
+    @attr('helper', 'history')
+    def test_sample_history(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        history = module.SampleHistory(4)
+
+        for t in range(0, 300, 10):
+            history.add('t1', ('bolt', 'b'), t, {'acked': t}, [60, 120])
+        # spaced at least 15s and 30s apart, 5 samples each
+        self.assertEqual([200, 220, 240, 260, 280], [ts for ts, _ in history.topologies['t1'][('bolt', 'b')][1][60]])
+        self.assertEqual([150, 180, 210, 240, 270], [ts for ts, _ in history.topologies['t1'][('bolt', 'b')][1][120]])
+        self.assertEqual((240, {'acked': 240}), history.find('t1', ('bolt', 'b'), 60, 300))
+        self.assertEqual((180, {'acked': 180}), history.find('t1', ('bolt', 'b'), 120, 300))
+        self.assertEqual((None, None), history.find('t1', ('bolt', 'b'), 120, 200))
+        self.assertEqual((None, None), history.find('t2', ('bolt', 'b'), 60, 300))
+
+        history.add('t1', ('bolt', 'c'), 0, {'acked': 0}, [60])
+        history.add('t2', ('bolt', 'b'), 290, {'acked': 0}, [60])
+        history.expire(set(['t1']), 300, 120)
+        self.assertEqual(1, len(history))
+        self.assertEqual(['t1'], history.topologies.keys())
+
+    @attr('process', 'history')
+    def test_process_topology_all_time(self):
+        config = {'instances': [{'server': 'http://localhost:9005', 'environment': 'test', 'intervals': [60, 600],
+                                 'derive_intervals': True}]}
+        self.load_check(config, {})
+        self.check.update_from_config(config['instances'][0])
+        results = self._record_report_histogram()
+
+        self.check.process_topology_all_time('my_topology-1', 'my_topology', TEST_STORM_TOPOLOGY_RESP,
+                                             TEST_STORM_TOPOLOGY_METRICS_RESP, 1000)
+        self.assertEqual([], results)
+
+        later_stats = copy.deepcopy(TEST_STORM_TOPOLOGY_RESP)
+        later_stats['topologyStats'][0].update({'acked': 104673 + 600, 'completeLatency': '300.0'})
+        later_stats['bolts'][0].update({'executed': 106311 + 1200, 'executeLatency': '0.011', 'acked': 212282})
+        later_metrics = copy.deepcopy(TEST_STORM_TOPOLOGY_METRICS_RESP)
+        for stream in later_metrics['bolts'][0]['acked']:
+            stream['value'] += 30
+        self.check.process_topology_all_time('my_topology-1', 'my_topology', later_stats, later_metrics, 1120)
+
+        reported = defaultdict(list)
+        for metric, value, tags in results:
+            reported[metric].append((value, tags))
+        self.assertFalse([m for m in reported if 'last_600' in m])
+
+        # deltas over 120s, scaled to the 60s interval
+        self.assertEqual([(300, ['topology:my_topology'])], reported['storm.topologyStats.last_60.acked'])
+        expected_latency = (105273 * 300.0 - 104673 * 285.950) / 600
+        self.assertAlmostEqual(expected_latency, reported['storm.topologyStats.last_60.completeLatency'][0][0])
+        self.assertEqual(33, reported['storm.topologyStats.last_60.tasksTotal'][0][0])
+        bolt1 = dict((m, v) for m, values in reported.items() for v, tags in values if 'bolt:Bolt1' in tags)
+        self.assertEqual(600, bolt1['storm.bolt.last_60.executed'])
+        self.assertEqual(0, bolt1['storm.bolt.last_60.acked'])
+        self.assertAlmostEqual((107511 * 0.011 - 106311 * 0.001) / 1200, bolt1['storm.bolt.last_60.executeLatency'])
+        self.assertAlmostEqual(600 * bolt1['storm.bolt.last_60.executeLatency'] / 60000.0,
+                               bolt1['storm.bolt.last_60.capacity'])
+        bolts = TEST_STORM_TOPOLOGY_METRICS_RESP['bolts']
+        self.assertEqual([15] * len(bolts[0]['acked']) + [0] * sum(len(b.get('acked', [])) for b in bolts[1:]),
+                         [v for v, _ in reported['storm.topologyStats.metrics.bolts.last_60.acked']])
+
+    @attr('process', 'history')
+    def test_process_topology_all_time_windows(self):
+        """
+        Intervals are derived from the all-time window, wherever Storm lists it.
+        """
+        config = {'instances': [{'server': 'http://localhost:9005', 'environment': 'test', 'intervals': [60],
+                                 'derive_intervals': True}]}
+        self.load_check(config, {})
+        self.check.update_from_config(config['instances'][0])
+        results = self._record_report_histogram()
+
+        self.check.process_topology_all_time('my_topology-1', 'my_topology', TEST_STORM_TOPOLOGY_WINDOWS_RESP,
+                                             {}, 1000)
+        later_stats = copy.deepcopy(TEST_STORM_TOPOLOGY_WINDOWS_RESP)
+        self.assertEqual(':all-time', later_stats['topologyStats'][-1]['window'])
+        later_stats['topologyStats'][-1]['acked'] += 6000
+        self.check.process_topology_all_time('my_topology-1', 'my_topology', later_stats, {}, 1120)
+
+        reported = dict((metric, value) for metric, value, tags in results)
+        self.assertEqual(3000, reported['storm.topologyStats.last_60.acked'])
+        self.assertEqual(0, reported['storm.topologyStats.last_60.emitted'])
+
+    @attr('check', 'history')
+    def test_check_derive_intervals(self):
+        with StormUIStub(stub_routes(2)) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'intervals': [60, 600],
+                                     'derive_intervals': True}]}
+            self.load_check(config, {})
+            self.run_check(config)
+            self.check.stop()
+
+        topology_requests = [path for path in server.requests if '/api/v1/topology/my_topology' in path]
+        self.assertEqual(4, len(topology_requests))
+        self.assertTrue(all('window=%3Aall-time' in path for path in topology_requests))
+        self.assertServiceCheck('topology-check.my_topology_0', status=AgentCheck.OK, count=1)
+        self.assertEqual(2, len(self.check.get_sample_history().topologies))
+
+    @attr('check', 'connection_pool')
+    def test_check_reuses_connections(self):
+        """
+        Every request of a serial run goes through a single keep-alive, gzip encoded connection.
+        """
+        with StormUIStub(stub_routes(3)) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test'}]}
+            self.load_check(config, {})
+            for _ in range(2):
+                self.run_check(config)
+            self.check.stop()
+
+        # 4 summaries plus 3 topologies x (info + metrics), twice
+        self.assertEqual(20, server.gzipped)
+        self.assertMetric('storm.check.http.connections', value=1, count=1)
+        self.assertMetric('storm.check.http.requests', value=20, count=1)
+        self.assertMetric('storm.check.http.reused', value=19, count=1)
+
+    @attr('check')
+    def test_check_summary_cache(self):
+        """
+        Summaries with a TTL are served from the cache until it expires, the others are fetched every run.
+        """
+        cache_tags = ['env:test', 'environment:test', 'stormVersion:1.0.3']
+        with StormUIStub(stub_routes(1)) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test',
+                                     'summary_cache_ttl': {'topology': 300, 'supervisor': 300}}]}
+            self.load_check(config, {})
+            self.run_check(config)
+            self.assertMetric('storm.check.cache.misses', value=1, tags=cache_tags + ['summary:topology'])
+            self.assertMetric('storm.check.cache.hits', value=0, tags=cache_tags + ['summary:topology'])
+
+            self.run_check(config)
+            self.assertMetric('storm.check.cache.misses', value=0, tags=cache_tags + ['summary:topology'])
+            self.assertMetric('storm.check.cache.hits', value=1, tags=cache_tags + ['summary:topology'])
+            self.assertMetric('storm.check.cache.misses', value=1, tags=cache_tags + ['summary:cluster'])
+            self.assertMetric('storm.check.cache.hits', value=0, tags=cache_tags + ['summary:cluster'])
+            self.assertServiceCheck('topology-check.my_topology_0', status=AgentCheck.OK, count=1)
+
+            # Expire the cached summaries
+            for key, (timestamp, data) in self.check.summary_cache.items():
+                self.check.summary_cache[key] = (timestamp - 300, data)
+            self.run_check(config)
+            self.assertMetric('storm.check.cache.misses', value=1, tags=cache_tags + ['summary:topology'])
+            self.check.stop()
+
+        paths = [urlparse.urlparse(path).path for path in server.requests]
+        self.assertEqual(3, paths.count('/api/v1/cluster/summary'))
+        self.assertEqual(2, paths.count('/api/v1/supervisor/summary'))
+        self.assertEqual(2, paths.count('/api/v1/topology/summary'))
+
+    @attr('helper', 'activity')
+    def test_topology_activity(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        activity = module.TopologyActivity(30, 100)
+
+        self.assertTrue(activity.should_poll('t1', 0))
+        self.assertFalse(activity.update('t1', 'ACTIVE', 10, 0))
+        self.assertTrue(activity.should_poll('t1', 0))
+        # no progress since the previous poll: 30s, 60s then 100s (capped) back-off
+        for timestamp, next_poll in ((10, 40), (40, 100), (100, 200), (200, 300)):
+            self.assertTrue(activity.update('t1', 'ACTIVE', 10, timestamp))
+            self.assertFalse(activity.should_poll('t1', next_poll - 1))
+            self.assertTrue(activity.should_poll('t1', next_poll))
+        # progress resets the back-off
+        self.assertFalse(activity.update('t1', 'ACTIVE', 11, 300))
+        self.assertTrue(activity.should_poll('t1', 300))
+        # inactive topologies are idle on their first poll
+        self.assertTrue(activity.update('t2', 'INACTIVE', 11, 300))
+        self.assertFalse(activity.should_poll('t2', 329))
+
+        activity.expire(set(['t2']))
+        self.assertEqual(['t2'], activity.topologies.keys())
+
+    @attr('check', 'activity')
+    def test_check_idle_backoff(self):
+        """
+        Idle topologies are polled on an exponential back-off, and their status is still reported every run.
+        """
+        routes = stub_routes(2)
+        routes['/api/v1/topology/summary']['topologies'][1]['status'] = 'INACTIVE'
+        routes['/api/v1/topology/my_topology_1-1-1489183263']['status'] = 'INACTIVE'
+        with StormUIStub(routes) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'idle_backoff': 300}]}
+            self.load_check(config, {})
+            for run in range(3):
+                self.run_check(config)
+                self.assertServiceCheck('topology-check.my_topology_0', status=AgentCheck.OK, count=1)
+                self.assertServiceCheck('topology-check.my_topology_1', status=AgentCheck.CRITICAL, count=1)
+                # my_topology_1 is inactive from the first run, my_topology_0 stops moving after its second
+                self.assertMetric('storm.check.topologies.skipped', value=[0, 1, 2][run], count=1)
+            self.check.stop()
+
+        paths = [urlparse.urlparse(path).path for path in server.requests]
+        self.assertEqual(2, paths.count('/api/v1/topology/my_topology_0-1-1489183263'))
+        self.assertEqual(1, paths.count('/api/v1/topology/my_topology_1-1-1489183263'))
+        self.assertEqual(3, paths.count('/api/v1/topology/summary'))
+
+    @attr('helper', 'static')
+    def test_static_series_cache(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        cache = module.StaticSeriesCache(3, 600)
+
+        self.assertTrue(cache.should_emit('t1', 'm1', ['a'], 1, 0))
+        self.assertFalse(cache.should_emit('t1', 'm1', ['a'], 1, 599))
+        # changes and heartbeats are emitted
+        self.assertTrue(cache.should_emit('t1', 'm1', ['a'], 2, 599))
+        self.assertFalse(cache.should_emit('t1', 'm1', ['a'], 2, 1198))
+        self.assertTrue(cache.should_emit('t1', 'm1', ['a'], 2, 1199))
+        self.assertEqual(2, cache.suppressed)
+        # the least recently seen series are evicted past the cache size
+        self.assertTrue(cache.should_emit('t1', 'm1', ['b'], 1, 1200))
+        self.assertTrue(cache.should_emit('t2', 'm1', ['a'], 1, 1200))
+        self.assertTrue(cache.should_emit('t2', 'm2', ['a'], 1, 1200))
+        self.assertEqual(3, len(cache))
+        self.assertTrue(cache.should_emit('t1', 'm1', ['a'], 2, 1201))
+
+        cache.expire(set(['t1']))
+        self.assertEqual([('t1', 'm1', ('a',))], cache.series.keys())
+
+    @attr('check', 'static')
+    def test_check_static_attributes_heartbeat(self):
+        """
+        Static topology attributes are only reported when they change or on their heartbeat.
+        """
+        routes = stub_routes(2)
+        with StormUIStub(routes) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'static_attributes_heartbeat': 600}]}
+            self.load_check(config, {})
+            self.run_check(config)
+            self.assertMetric('storm.topologyStats.last_60.replicationCount.count', value=1, count=2)
+            self.assertMetric('storm.bolt.last_60.tasks.count', value=1)
+            self.assertMetric('storm.check.static.suppressed', value=0, count=1)
+            series = [m[2] for m in self.metrics if m[0] == 'storm.check.static.series'][0]
+            self.assertGreater(series, 0)
+
+            self.run_check(config)
+            self.assertMetric('storm.topologyStats.last_60.replicationCount.count', count=0)
+            self.assertMetric('storm.bolt.last_60.tasks.count', count=0)
+            self.assertMetric('storm.worker.last_60.componentNumTasks.count', count=0)
+            self.assertMetric('storm.topologyStats.last_60.acked.count', value=1, count=2)
+            self.assertMetric('storm.check.static.suppressed', value=series, count=1)
+
+            # a changed value is reported right away, the others on their heartbeat
+            routes['/api/v1/topology/my_topology_0-1-1489183263']['replicationCount'] = 3
+            server.bodies.clear()
+            self.run_check(config)
+            self.assertMetric('storm.topologyStats.last_60.replicationCount.max', value=3, count=1)
+            self.assertMetric('storm.topologyStats.last_60.replicationCount.count', count=1)
+            for entry in self.check.get_static_series_cache().series.values():
+                entry[1] -= 600
+            self.run_check(config)
+            self.assertMetric('storm.topologyStats.last_60.replicationCount.count', count=2)
+            self.assertMetric('storm.check.static.suppressed', value=0, count=1)
+
+            # the series of disappeared topologies are evicted
+            del routes['/api/v1/topology/summary']['topologies'][1]
+            server.bodies.clear()
+            self.run_check(config)
+            self.check.stop()
+        self.assertEqual(set(['my_topology_0']),
+                         set(key[0] for key in self.check.get_static_series_cache().series))
+
+    @attr('helper', 'filter')
+    def test_topology_filter(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        TopologyFilter = module.TopologyFilter
+
+        self.assertTrue(TopologyFilter().is_included('anything'))
+        topology_filter = TopologyFilter(include=['prod_*', 're:^etl-'], exclude=['*_tmp', 're:adhoc'],
+                                         excluded=['prod_old'], max_names=4)
+        self.assertTrue(topology_filter.is_included('prod_orders'))
+        self.assertTrue(topology_filter.is_included('etl-daily'))
+        self.assertFalse(topology_filter.is_included('dev_orders'))
+        self.assertFalse(topology_filter.is_included('xprod_orders'))
+        self.assertFalse(topology_filter.is_included('prod_orders_tmp'))
+        self.assertFalse(topology_filter.is_included('etl-adhoc-1'))
+        self.assertFalse(topology_filter.is_included('prod_old'))
+        # decisions are memoized up to max_names names
+        self.assertEqual(['etl-adhoc-1', 'prod_old', 'prod_orders_tmp'], sorted(topology_filter.decisions))
+        self.assertRaises(AssertionError, TopologyFilter, ['re:('])
+
+    @attr('check', 'filter')
+    def test_check_topology_filter(self):
+        """
+        Topologies are filtered by the include and exclude rules, and excluded topologies are not reported at all.
+        """
+        with StormUIStub(stub_routes(4)) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'excluded': ['my_topology_0'],
+                                     'include_topologies': ['my_topology_*'], 'exclude_topologies': ['re:_3$']}]}
+            self.load_check(config, {})
+            self.run_check(config)
+            self.check.stop()
+
+        for i, status in enumerate([None, AgentCheck.OK, AgentCheck.OK, None]):
+            if status is None:
+                self.assertServiceCheck('topology-check.my_topology_{}'.format(i), count=0)
+            else:
+                self.assertServiceCheck('topology-check.my_topology_{}'.format(i), status=status, count=1)
+        paths = [urlparse.urlparse(path).path for path in server.requests]
+        self.assertEqual(['/api/v1/topology/my_topology_1-1-1489183263', '/api/v1/topology/my_topology_2-1-1489183263'],
+                         [path for path in paths if path.startswith('/api/v1/topology/my_')][:2])
+        self.assertEqual(4, len([path for path in paths if path.startswith('/api/v1/topology/my_')]))
+
+    @attr('check', 'timing')
+    def test_check_phase_timing(self):
+        """
+        Phase timings are reported as self metrics when enabled, and the slowest topologies are logged.
+        """
+        with StormUIStub(stub_routes(3)) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test'}]}
+            self.load_check(config, {})
+            self.run_check(config)
+            untimed = sorted((m[0], m[2], sorted(m[3]['tags'])) for m in self.metrics
+                             if not m[0].startswith('storm.check.'))
+            self.assertFalse([m for m in self.metrics if m[0].startswith('storm.check.phase.')])
+
+            config['instances'][0].update({'phase_timing': True, 'phase_timing_slowest_topologies': 2})
+            logged = []
+            self.check.log.info = lambda *args: logged.append(args)
+            try:
+                self.run_check(config)
+            finally:
+                del self.check.log.info
+            self.check.stop()
+
+        # the timings do not change the reported metrics
+        self.assertEqual(untimed, sorted((m[0], m[2], sorted(m[3]['tags'])) for m in self.metrics
+                                         if not m[0].startswith('storm.check.')))
+        tags = ['env:test', 'environment:test', 'stormVersion:1.0.3']
+        # 4 summaries, then the info and metrics of 3 topologies
+        for phase in ('request.connect', 'request.transfer', 'request.decode'):
+            self.assertMetric('storm.check.phase.calls', value=10, tags=tags + ['phase:{}'.format(phase)], count=1)
+        for phase in ('process.topology_stats', 'process.topology_metrics'):
+            self.assertMetric('storm.check.phase.calls', value=3, tags=tags + ['phase:{}'.format(phase)], count=1)
+        self.assertMetric('storm.check.phase.calls', value=1, tags=tags + ['phase:process.cluster_stats'], count=1)
+        self.assertMetric('storm.check.phase.time', tags=tags + ['phase:report'], count=1)
+        self.assertMetric('storm.check.run.time', tags=tags, count=1)
+        slowest = [args for args in logged if args[0] == 'Slowest Storm topologies: %s took %.3fs (%s)']
+        self.assertEqual(2, len(slowest))
+        self.assertIn('process: ', slowest[0][3])
+        self.assertIn('request.transfer: ', slowest[0][3])
+
+    @attr('helper', 'replay')
+    def test_response_archive(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        path = os.path.join(os.environ.get('VOLATILE_DIR', '/tmp'), 'storm_response_archive.gz')
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            archive = module.ResponseArchive(path)
+            archive.start_run(recording=True)
+            archive.record('http://a:9005/api/v1/x?window=60&b=1', 200, 'application/json', '{"run": 1}')
+            archive.record('http://a:9005/api/v1/y', 500, None, 'error\n')
+            archive.start_run(recording=True)
+            archive.record('http://a:9005/api/v1/x?b=1&window=60', 200, 'application/json', '{"run": 2}')
+            archive.close()
+
+            archive = module.ResponseArchive(path)
+            for run in (1, 2, 1):
+                archive.start_run(recording=False)
+                if run == 1:
+                    # read ahead of the earlier entries
+                    self.assertEqual((500, None, 'error\n'), archive.replay('http://b/api/v1/y'))
+                    self.assertEqual({'/api/v1/x?b=1&window=60': deque([(200, 'application/json', '{"run": 1}')])},
+                                     archive.pending)
+                self.assertEqual((200, 'application/json', '{"run": %d}' % run),
+                                 archive.replay('http://b/api/v1/x?window=60&b=1'))
+                self.assertIsNone(archive.replay('http://b/api/v1/x?window=60&b=1'))
+            archive.close()
+        finally:
+            os.remove(path)
+
+    @attr('check', 'replay')
+    def test_check_record_replay(self):
+        """
+        Replaying a recorded run reports the same metrics without any network.
+        """
+        path = os.path.join(os.environ.get('VOLATILE_DIR', '/tmp'), 'storm_check_archive.gz')
+        if os.path.exists(path):
+            os.remove(path)
+
+        def _metrics():
+            return sorted((m[0], m[2], sorted(m[3]['tags'])) for m in self.metrics if not m[0].startswith('storm.check.'))
+
+        try:
+            with StormUIStub(stub_routes(3)) as server:
+                config = {'instances': [{'server': server.url, 'environment': 'test', 'record_path': path,
+                                         'max_concurrency': 4}]}
+                self.load_check(config, {})
+                self.run_check(config)
+                self.check.stop()
+            recorded = _metrics()
+            self.assertGreater(len(recorded), 0)
+
+            # the stub server is gone, and the streaming parser reads the archived bodies too
+            for stream in (False, True):
+                config = {'instances': [{'server': server.url, 'environment': 'test', 'replay_path': path,
+                                         'stream_topology_metrics': stream}]}
+                self.load_check(config, {})
+                for _ in range(2):
+                    self.run_check(config)
+                    self.assertEqual(recorded, _metrics())
+                self.check.stop()
+        finally:
+            os.remove(path)
+
+    @attr('check', 'deadline')
+    def test_check_request_priorities(self):
+        """
+        Summaries are fetched first, then the topology info of the active topologies, and the topology metrics last.
+        """
+        routes = stub_routes(3)
+        routes['/api/v1/topology/summary']['topologies'][0]['status'] = 'INACTIVE'
+        with StormUIStub(routes) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test'}]}
+            self.load_check(config, {})
+            self.run_check(config)
+            self.check.stop()
+
+        self.assertEqual([
+            '/api/v1/cluster/summary',
+            '/api/v1/topology/summary',
+            '/api/v1/nimbus/summary',
+            '/api/v1/supervisor/summary',
+            '/api/v1/topology/my_topology_1-1-1489183263',
+            '/api/v1/topology/my_topology_2-1-1489183263',
+            '/api/v1/topology/my_topology_0-1-1489183263',
+            '/api/v1/topology/my_topology_1-1-1489183263/metrics',
+            '/api/v1/topology/my_topology_2-1-1489183263/metrics',
+            '/api/v1/topology/my_topology_0-1-1489183263/metrics',
+        ], [urlparse.urlparse(path).path for path in server.requests])
+
+    @attr('check', 'deadline')
+    def test_check_deadline(self):
+        """
+        Past the run deadline the remaining requests are skipped, and what was fetched before it is still reported.
+        """
+        with StormUIStub(stub_routes(3)) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'deadline': 600}]}
+            self.load_check(config, {})
+            # the deadline passes once the 4 summaries and 3 topology infos were requested
+            self.check.deadline_exceeded = lambda: len(server.requests) >= 7
+            try:
+                self.run_check(config)
+            finally:
+                del self.check.deadline_exceeded
+                self.check.stop()
+
+        self.assertEqual(7, len(server.requests))
+        for i in range(3):
+            self.assertServiceCheck('topology-check.my_topology_{}'.format(i), status=AgentCheck.OK, count=1)
+        self.assertMetric('storm.topologyStats.last_60.acked.count', value=1, count=3)
+        self.assertFalse([m for m in self.metrics if m[0].startswith('storm.topologyStats.metrics.')])
+        skipped_tags = ['env:test', 'environment:test', 'stormVersion:1.0.3']
+        self.assertMetric('storm.check.requests.skipped', value=0, tags=skipped_tags + ['request:summary'])
+        self.assertMetric('storm.check.requests.skipped', value=0, tags=skipped_tags + ['request:topology_info'])
+        self.assertMetric('storm.check.requests.skipped', value=3, tags=skipped_tags + ['request:topology_metrics'])
+
+    @attr('helper', 'circuit_breaker')
+    def test_circuit_breakers(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        CircuitBreakers = module.CircuitBreakers
+        breakers = CircuitBreakers(2, 10, 25)
+
+        self.assertIsNone(breakers.record_failure('/a', 0))
+        self.assertTrue(breakers.allow('/a', 0))
+        self.assertEqual(10, breakers.record_failure('/a', 0))
+        self.assertFalse(breakers.allow('/a', 9))
+        # half-open: a single probe goes through, its failure doubles the back-off
+        self.assertTrue(breakers.allow('/a', 10))
+        self.assertFalse(breakers.allow('/a', 10))
+        self.assertEqual({'/a': CircuitBreakers.HALF_OPEN}, breakers.states())
+        self.assertEqual(20, breakers.record_failure('/a', 10))
+        self.assertFalse(breakers.allow('/a', 29))
+        self.assertTrue(breakers.allow('/a', 30))
+        self.assertEqual(25, breakers.record_failure('/a', 30))
+        self.assertTrue(breakers.allow('/a', 55))
+        breakers.record_success('/a')
+        self.assertTrue(breakers.allow('/a', 55))
+
+        breakers.record_failure('/b', 55)
+        # the recovered endpoint is reported closed once, then forgotten
+        self.assertEqual({'/a': CircuitBreakers.CLOSED, '/b': CircuitBreakers.CLOSED}, breakers.states())
+        self.assertEqual({'/b': CircuitBreakers.CLOSED}, breakers.states())
+
+    @attr('helper', 'circuit_breaker')
+    def test_circuit_breakers_lost_probe(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        CircuitBreakers = module.CircuitBreakers
+        breakers = CircuitBreakers(1, 10, 25)
+
+        self.assertEqual(10, breakers.record_failure('/a', 0))
+        self.assertTrue(breakers.allow('/a', 10))
+        # the probe's outcome is never recorded: another one goes through once the back-off elapsed again
+        self.assertFalse(breakers.allow('/a', 19))
+        self.assertTrue(breakers.allow('/a', 20))
+        self.assertFalse(breakers.allow('/a', 20))
+        self.assertEqual(20, breakers.record_failure('/a', 20))
+
+    @attr('check', 'circuit_breaker', 'event_loop')
+    def test_event_loop_abandoned_probe(self):
+        """
+        A probe given up on at the run deadline counts as a failure, rather than leaving its breaker half-open.
+        """
+        if tornado is None:
+            raise SkipTest("tornado is not installed")
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        breakers = module.CircuitBreakers(1, 10, 25)
+        path = '/api/v1/cluster/summary'
+        breakers.record_failure(path, time.time() - 10)
+        fetcher = module.EventLoopFetcher(2, 5, 5, self.check.log)
+        try:
+            with StormUIStub(stub_routes(1), latency=0.5) as slow:
+                with StormUIStub(stub_routes(1)) as fast:
+                    # the slow replica eats the whole deadline, leaving no time to fail over to the fast one
+                    candidates = [(slow.url, slow.url + path), (fast.url, fast.url + path)]
+                    results = fetcher.fetch([(candidates, 'error')], time.time() + 0.3, breakers)
+        finally:
+            fetcher.close()
+
+        self.assertEqual([{}], results)
+        self.assertEqual([], fast.requests)
+        self.assertEqual({path: module.CircuitBreakers.OPEN}, breakers.states())
+        self.assertFalse(breakers.allow(path, time.time()))
+
+    @attr('check', 'circuit_breaker')
+    def test_check_circuit_breaker(self):
+        """
+        A failing endpoint stops being requested once its breaker opens, and is probed again after the back-off.
+        """
+        metrics_path = '/api/v1/topology/my_topology_0-1-1489183263/metrics'
+        routes = stub_routes(2)
+        routes[metrics_path] = {'error': 'Internal Server Error'}
+        breaker_tags = ['env:test', 'environment:test', 'stormVersion:1.0.3', 'endpoint:{}'.format(metrics_path)]
+        with StormUIStub(routes) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'circuit_breaker_threshold': 2}]}
+            self.load_check(config, {})
+            for _ in range(4):
+                self.run_check(config)
+            self.assertMetric('storm.check.circuit_breaker.state', value=2, tags=breaker_tags, count=1)
+            self.assertMetric('storm.check.circuit_breakers.open', value=1, count=1)
+            self.assertEqual(2, [urlparse.urlparse(path).path for path in server.requests].count(metrics_path))
+
+            # the endpoint recovers, and the probe sent once the back-off has elapsed closes the breaker
+            routes[metrics_path] = TEST_STORM_TOPOLOGY_METRICS_RESP
+            server.bodies.clear()
+            breakers = self.check.get_circuit_breakers()
+            breakers.endpoints[metrics_path][3] = time.time()
+            self.run_check(config)
+            self.assertMetric('storm.check.circuit_breaker.state', value=0, tags=breaker_tags, count=1)
+            self.assertMetric('storm.check.circuit_breakers.open', value=0, count=1)
+            self.run_check(config)
+            self.assertMetric('storm.check.circuit_breaker.state', count=0)
+            self.check.stop()
+
+        self.assertEqual(4, [urlparse.urlparse(path).path for path in server.requests].count(metrics_path))
+        for i in range(2):
+            self.assertServiceCheck('topology-check.my_topology_{}'.format(i), status=AgentCheck.OK, count=1)
+
+    @attr('helper', 'servers')
+    def test_server_health(self):
+        self.load_check(self.STORM_CHECK_CONFIG, {})
+        module = __import__(self.check.__class__.__module__)
+        health = module.ServerHealth()
+        servers = ['http://a', 'http://b', 'http://c']
+
+        self.assertEqual(servers, health.order(servers, 0))
+        health.record_success('http://a', 0.3)
+        health.record_success('http://b', 0.1)
+        health.record_success('http://c', 0.2)
+        self.assertEqual(['http://b', 'http://c', 'http://a'], health.order(servers, 0))
+        # affinity keys stick to a server
+        self.assertEqual(health.order(servers, 0, 'topology-1'), health.order(servers, 10, 'topology-1'))
+        self.assertEqual(set(servers), set(health.order(servers, 0, 'topology-{}'.format(i))[0] for i in range(30)))
+        # topology ids decoded from the JSON responses are unicode, and hash as their UTF-8 bytes
+        self.assertEqual(health.order(servers, 0, 'caf\xc3\xa9-1-2'), health.order(servers, 0, u'caf\xe9-1-2'))
+
+        # failed servers are demoted, for longer on each consecutive failure
+        health.record_failure('http://b', 0)
+        self.assertEqual(['http://c', 'http://a', 'http://b'], health.order(servers, 29))
+        self.assertFalse(health.is_healthy('http://b', 29))
+        self.assertEqual('http://b', health.order(servers, 30)[0])
+        health.record_failure('http://b', 30)
+        self.assertFalse(health.is_healthy('http://b', 89))
+        self.assertTrue(health.is_healthy('http://b', 90))
+        health.record_success('http://b', 0.1)
+        self.assertTrue(health.is_healthy('http://b', 31))
+
+    @attr('check', 'servers')
+    def test_check_servers_failover(self):
+        """
+        Requests fail over from a server that is down to the next one within the same run.
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        down_server = 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+        sock.close()
+
+        engines = ['threads'] + (['event_loop'] if tornado else [])
+        with StormUIStub(stub_routes(2)) as server:
+            for engine in engines:
+                config = {'instances': [{'servers': [down_server, server.url], 'environment': 'test',
+                                         'collection_engine': engine}]}
+                self.load_check(config, {})
+                self.run_check(config)
+                for i in range(2):
+                    self.assertServiceCheck('topology-check.my_topology_{}'.format(i), status=AgentCheck.OK, count=1)
+                self.assertMetric('storm.cluster.supervisors', count=1)
+                self.assertMetric('storm.check.server.healthy', value=0, count=1,
+                                  tags=['env:test', 'environment:test', 'stormVersion:1.0.3',
+                                        'server:{}'.format(down_server)])
+                self.assertMetric('storm.check.server.healthy', value=1, count=1,
+                                  tags=['env:test', 'environment:test', 'stormVersion:1.0.3',
+                                        'server:{}'.format(server.url)])
+                self.check.stop()
+
+        # every request reached the live server exactly once
+        self.assertEqual(len(engines) * 8, len(server.requests))
+
+    @attr('check', 'servers')
+    def test_check_spread_topologies(self):
+        """
+        With spread_topologies, each topology sticks to one replica and the topologies are spread across replicas.
+        """
+        routes = stub_routes(8)
+        with StormUIStub(routes) as server_a, StormUIStub(routes) as server_b:
+            config = {'instances': [{'servers': [server_a.url, server_b.url], 'environment': 'test',
+                                     'spread_topologies': True}]}
+            self.load_check(config, {})
+            for _ in range(2):
+                self.run_check(config)
+            self.check.stop()
+
+        topologies = {}
+        for name, server in (('a', server_a), ('b', server_b)):
+            for path in server.requests:
+                parts = urlparse.urlparse(path).path.split('/')
+                if parts[3] == 'topology' and parts[4] != 'summary':
+                    topologies.setdefault(parts[4], set()).add(name)
+        self.assertEqual(8, len(topologies))
+        self.assertTrue(all(len(names) == 1 for names in topologies.values()))
+        self.assertEqual(set(['a', 'b']), set().union(*topologies.values()))
+
+    @attr('check', 'event_loop')
+    def test_check_event_loop_engine(self):
+        """
+        The event loop engine emits the same metrics as the thread engine.
+        """
+        if tornado is None:
+            raise SkipTest("tornado is not installed")
+        emitted = {}
+        with StormUIStub(stub_routes(3)) as server:
+            for engine in ('threads', 'event_loop'):
+                config = {'instances': [{'server': server.url, 'environment': 'test', 'intervals': [60, 600],
+                                         'collection_engine': engine, 'summary_cache_ttl': {'topology': 300}}]}
+                self.load_check(config, {})
+                for _ in range(2):
+                    self.run_check(config)
+                self.check.stop()
+                self.assertEqual(3, len([sc for sc in self.service_checks if sc['status'] == AgentCheck.OK]))
+                emitted[engine] = sorted((m[0], m[2], sorted(m[3].get('tags') or [])) for m in self.metrics
+                                         if not m[0].startswith('storm.check.http.'))
+
+        self.assertEqual(emitted['threads'], emitted['event_loop'])
+        paths = [urlparse.urlparse(path).path for path in server.requests]
+        # per engine: the uncached summaries on both runs, the cached topology summary once, and 2 intervals per run
+        self.assertEqual(2 * 2, paths.count('/api/v1/cluster/summary'))
+        self.assertEqual(2 * 1, paths.count('/api/v1/topology/summary'))
+        self.assertEqual(2 * 2 * 2, paths.count('/api/v1/topology/my_topology_0-1-1489183263/metrics'))
+
+    @attr('check', 'event_loop')
+    def test_check_event_loop_deadline(self):
+        """
+        Requests still running at the run deadline are abandoned, and the check returns on time.
+        """
+        if tornado is None:
+            raise SkipTest("tornado is not installed")
+        with StormUIStub(stub_routes(4), latency=0.3) as server:
+            config = {'instances': [{'server': server.url, 'environment': 'test', 'collection_engine': 'event_loop',
+                                     'max_requests_per_host': 2, 'deadline': 1}]}
+            self.load_check(config, {})
+            self.run_check(config)
+            self.check.stop()
+
+        # 2 at a time, the 4 summaries and 4 topology infos alone take at least 4 rounds of 0.3s: whatever the load,
+        # none of the topology metrics requests can complete before the deadline
+        self.assertMetric('storm.cluster.supervisors')
+        self.assertFalse([m for m in self.metrics if m[0].startswith('storm.topologyStats.metrics.')])
+        self.assertServiceCheck('topology-check.my_topology_3', status=AgentCheck.CRITICAL, count=1)
+        paths = [urlparse.urlparse(path).path for path in server.requests]
+        self.assertLess(len([path for path in paths if path.endswith('/metrics')]), 4)
+
+    @attr('check')
+    def test_check_concurrency(self):
+        """
+        Concurrent topology fetching emits the same metrics as serial fetching, with up to max_concurrency requests
+        in flight.
+        """
+        emitted = {}
+        in_flight = {}
+        with StormUIStub(stub_routes(20), latency=0.02) as server:
+            for max_concurrency in (1, 8):
+                config = {'instances': [{'server': server.url, 'environment': 'test', 'intervals': [60, 600],
+                                         'max_concurrency': max_concurrency}]}
+                self.load_check(config, {})
+                self.run_check(config)
+                in_flight[max_concurrency] = server.reset_max_in_flight()
+                self.check.stop()
+                emitted[max_concurrency] = sorted((m[0], m[2], sorted(m[3].get('tags') or [])) for m in self.metrics
+                                                  if not m[0].startswith('storm.check.'))
+                self.assertEqual(20, len([sc for sc in self.service_checks if sc['status'] == AgentCheck.OK]))
+
+        self.assertEqual(emitted[1], emitted[8])
+        # requests in flight at the same time, as seen by the stub server
+        self.assertEqual(1, in_flight[1])
+        self.assertGreater(in_flight[8], 1)
+        self.assertLessEqual(in_flight[8], 8)
+
+    # (name, topologies, bolts, spouts, workers, streams)
+    BENCHMARK_SCENARIOS = (
+        ('small', 2, 4, 2, 4, 4),
+        ('wide', 2, 20, 4, 8, 50),
+        ('many', 20, 8, 2, 8, 8),
+    )
+
+    def run_check_benchmark(self, config, runs=2):
+        """Run the check `runs` times against `config` in a forked child, and measure the last run."""
+        def _run():
+            self.load_check(config, {})
+            for _ in range(runs - 1):
+                self.run_check(config)
+            start = time.time()
+            self.run_check(config)
+            self.check.stop()
+            return {'metrics': len(self.metrics), 'run_wall_time': time.time() - start,
+                    'ok': len([sc for sc in self.service_checks if sc['status'] == AgentCheck.OK])}
+        return measure_in_child(_run)
+
+    @attr('check', 'benchmark', requires='benchmark')
+    def test_check_scale_benchmark(self):
+        """
+        Measure the wall time, CPU time, peak memory and metrics emitted of the check against synthetic clusters.
+
+        Results are printed as one JSON line per scenario, and appended to $STORM_BENCHMARK_OUTPUT when it is set, so
+        runs on different commits can be compared. $STORM_BENCHMARK_LABEL labels the results, e.g. with a commit id.
+        """
+        label = os.environ.get('STORM_BENCHMARK_LABEL', '')
+        rows = []
+        for name, num_topologies, num_bolts, num_spouts, num_workers, num_streams in self.BENCHMARK_SCENARIOS:
+            routes = synthetic_storm_routes(num_topologies, num_bolts, num_spouts, num_workers, num_streams)
+            with StormUIStub(routes) as server:
+                config = {'instances': [{'server': server.url, 'environment': 'test'}]}
+                measured = self.run_check_benchmark(config)
+
+            result = measured.pop('result')
+            self.assertEqual(num_topologies, result['ok'])
+            self.assertGreater(result['metrics'], 0)
+            rows.append(dict(measured, label=label, scenario=name, topologies=num_topologies, bolts=num_bolts,
+                             spouts=num_spouts, workers=num_workers, streams=num_streams, metrics=result['metrics'],
+                             run_wall_time=result['run_wall_time']))
+
+        for row in rows:
+            print json.dumps(row, sort_keys=True)
+        output = os.environ.get('STORM_BENCHMARK_OUTPUT')
+        if output:
+            with open(output, 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(row, sort_keys=True) + '\n')
+
     @attr('integration', 'check')
     def test_integration_with_ci_cluster(self):
         self.load_check(self.STORM_CHECK_INTEGRATION_CONFIG, {})